@@ -0,0 +1,255 @@
+# Copyright 2020 The Johns Hopkins University Applied Physics Laboratory LLC
+# All rights reserved.
+# Distributed under the terms of the MIT License.
+
+
+import argparse
+import json
+import os
+import sys
+import time
+from threading import Thread, Event
+
+import zmq
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from simon_common import Metrics
+
+
+def status_message(model, count):
+    """
+    :param model: the model's ID
+    :param count: the number of the status message
+    :return: a status message like the outer wrappers send, with a metrics snapshot
+    """
+
+    metrics = Metrics()
+    for queue in ["pub", "control", "action", "frame"]:
+        metrics.set("simon_queue_depth", 0, queue=queue)
+    for signal in ["status", "data", "increment"]:
+        metrics.inc("simon_messages_received_total", 100, signal=signal)
+        metrics.inc("simon_messages_sent_total", 100, signal=signal)
+    for phase in ["wait for pulse", "model", "translate output", "send"]:
+        metrics.observe("simon_phase_seconds", 0.01, phase=phase)
+    return {
+        "source": model,
+        "id": count,
+        "time": time.time(),
+        "date": time.ctime(),
+        "signal": "status",
+        "incstep": 1,
+        "year": 2017,
+        "status": "waiting",
+        "backlog": 0,
+        "metrics": metrics.snapshot(),
+    }
+
+
+def forward(frontend, backend, event):
+    """
+    relays every frame from the frontend to the backend, like the broker's forwarder
+    """
+
+    while not event.is_set():
+        if frontend.poll(100):
+            backend.send(frontend.recv())
+
+
+def receive(socks, expected, timeout):
+    """
+    receives and decodes messages from each socket until it has received the expected number
+    :param socks: the sockets
+    :param expected: the number of messages to receive from each socket
+    :param timeout: the number of seconds to wait for them
+    :return: the number of messages and bytes received
+    """
+
+    poller = zmq.Poller()
+    for sock in socks:
+        poller.register(sock, zmq.POLLIN)
+    remaining = {sock: expected for sock in socks}
+    messages = size = 0
+    deadline = time.perf_counter() + timeout
+    while remaining and time.perf_counter() < deadline:
+        for sock, _ in poller.poll(100):
+            while sock in remaining:
+                try:
+                    frame = sock.recv(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                json.loads(frame)
+                messages += 1
+                size += len(frame)
+                remaining[sock] -= 1
+                if remaining[sock] == 0:
+                    del remaining[sock]
+                    poller.unregister(sock)
+    return messages, size
+
+
+def broadcast(context, models, rounds, timeout):
+    """
+    the status messages of every model are published through the forwarder, and received by every model and the
+    broker
+    :return: the mean time, messages, and bytes of a round of status messages
+    """
+
+    event = Event()
+    frontend = context.socket(zmq.SUB)
+    frontend.setsockopt(zmq.SUBSCRIBE, b"")
+    frontend_port = frontend.bind_to_random_port("tcp://127.0.0.1")
+    backend = context.socket(zmq.PUB)
+    backend_port = backend.bind_to_random_port("tcp://127.0.0.1")
+    forwarder = Thread(target=forward, args=(frontend, backend, event))
+    forwarder.start()
+
+    pubs, subs = [], []
+    for _ in range(models):
+        pub = context.socket(zmq.PUB)
+        pub.connect(f"tcp://127.0.0.1:{frontend_port}")
+        pubs.append(pub)
+    for _ in range(models + 1):
+        sub = context.socket(zmq.SUB)
+        sub.setsockopt(zmq.SUBSCRIBE, b"")
+        sub.connect(f"tcp://127.0.0.1:{backend_port}")
+        subs.append(sub)
+    time.sleep(1 + models / 100)
+
+    def heartbeats(count):
+        for model, pub in enumerate(pubs):
+            pub.send_json(status_message(f"model{model}", count))
+        return receive(subs, models, timeout)
+
+    results = measure(heartbeats, rounds)
+    event.set()
+    forwarder.join()
+    for sock in pubs + subs + [frontend, backend]:
+        sock.close(linger=0)
+    return results
+
+
+def push(context, models, rounds, timeout):
+    """
+    the status messages of every model are pushed to the broker only, which publishes one aggregated state message
+    to every model
+    :return: the mean time, messages, and bytes of a round of status messages
+    """
+
+    pull = context.socket(zmq.PULL)
+    pull_port = pull.bind_to_random_port("tcp://127.0.0.1")
+    pub = context.socket(zmq.PUB)
+    pub_port = pub.bind_to_random_port("tcp://127.0.0.1")
+
+    pushes, subs = [], []
+    for _ in range(models):
+        sock = context.socket(zmq.PUSH)
+        sock.connect(f"tcp://127.0.0.1:{pull_port}")
+        pushes.append(sock)
+    for _ in range(models):
+        sub = context.socket(zmq.SUB)
+        sub.setsockopt(zmq.SUBSCRIBE, b"")
+        sub.connect(f"tcp://127.0.0.1:{pub_port}")
+        subs.append(sub)
+    time.sleep(1 + models / 100)
+
+    def heartbeats(count):
+        for model, sock in enumerate(pushes):
+            sock.send_json(status_message(f"model{model}", count))
+        state = {}
+        messages = size = 0
+        for _ in range(models):
+            if not pull.poll(timeout * 1000):
+                break
+            frame = pull.recv()
+            message = json.loads(frame)
+            state[message["source"]] = {
+                "status": message["status"],
+                "incstep": message["incstep"],
+            }
+            messages += 1
+            size += len(frame)
+        pub.send_json(
+            {
+                "source": "broker",
+                "time": time.time(),
+                "signal": "status",
+                "status": "booted",
+                "incstep": 1,
+                "models": state,
+            }
+        )
+        received, received_size = receive(subs, 1, timeout)
+        return messages + received, size + received_size
+
+    results = measure(heartbeats, rounds)
+    for sock in pushes + subs + [pull, pub]:
+        sock.close(linger=0)
+    return results
+
+
+def measure(heartbeats, rounds):
+    """
+    :param heartbeats: a function that sends and receives a round of status messages, and returns the number of
+            messages and bytes received
+    :param rounds: the number of rounds to measure, after a warm-up round
+    :return: the mean time, messages, and bytes of a round
+    """
+
+    heartbeats(0)
+    start = time.perf_counter()
+    messages = size = 0
+    for count in range(1, rounds + 1):
+        round_messages, round_size = heartbeats(count)
+        messages += round_messages
+        size += round_size
+    return (
+        (time.perf_counter() - start) / rounds,
+        messages / rounds,
+        size / rounds,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="measure the cost of a round of heartbeats, when every model receives every status message, "
+        "and when only the broker does"
+    )
+    parser.add_argument(
+        "--models",
+        type=int,
+        nargs="+",
+        default=[5, 50, 200],
+        help="the numbers of simulated models",
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=5,
+        help="the number of rounds of status messages",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30,
+        help="the number of seconds to wait for a round's messages",
+    )
+    args = parser.parse_args()
+
+    context = zmq.Context()
+    print(
+        f"{'models':>8}{'mode':>12}{'round':>12}{'messages':>12}{'received':>12}"
+    )
+    for models in args.models:
+        for mode, function in [("broadcast", broadcast), ("push", push)]:
+            duration, messages, size = function(
+                context, models, args.rounds, args.timeout
+            )
+            print(
+                f"{models:>8}{mode:>12}{duration * 1e3:>9.1f} ms{messages:>12.0f}"
+                f"{size / 2**20:>8.1f} MiB"
+            )
+    context.term()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# Copyright 2020 The Johns Hopkins University Applied Physics Laboratory LLC
+# All rights reserved.
+# Distributed under the terms of the MIT License.
+
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from outer_wrapper import log_missing_instances
+from simon_common import Envelope
+
+
+def data_message(instances, variables):
+    """
+    :param instances: the number of instances of each variable
+    :param variables: the number of variables
+    :return: a data message like the models publish
+    """
+
+    return {
+        "schema": "benchmark",
+        "signal": "data",
+        "source": "benchmark",
+        "incstep": 1,
+        "year": 2017,
+        "payload": {
+            f"variable{v}": {
+                "data": {f"{i:05}": i * 1.000001 for i in range(instances)},
+                "granularity": "county",
+                "unit": "",
+            }
+            for v in range(variables)
+        },
+    }
+
+
+def measure(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="measure the cost of logging in the message path, before and after lazy envelope logging"
+    )
+    parser.add_argument(
+        "--instances",
+        type=int,
+        default=50000,
+        help="the number of instances of each variable of the data message",
+    )
+    parser.add_argument(
+        "--variables",
+        type=int,
+        default=3,
+        help="the number of variables of the data message",
+    )
+    parser.add_argument(
+        "--missing",
+        type=int,
+        default=1000,
+        help="the number of instances of a translation that aren't in the instance graph",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=20, help="the number of repetitions"
+    )
+    args = parser.parse_args()
+
+    # log to /dev/null, so that the cost of writing the logs is included, but not of the terminal
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(
+        logging.Formatter(
+            "%(asctime)s - %(levelname)s - %(filename)s:%(funcName)s:%(lineno)d - %(message)s"
+        )
+    )
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+    root = logging.getLogger()
+
+    message = data_message(args.instances, args.variables)
+    frame_size = len(json.dumps(message))
+    missing = [f"missing{i}" for i in range(args.missing)]
+
+    def per_instance_warnings():
+        for instance in missing:
+            logging.warning(f"instance {instance} not in instance graph")
+
+    cases = [
+        (
+            "debug message, DEBUG off",
+            lambda: logging.debug(json.dumps(message)),
+            lambda: logging.debug("received %s", Envelope(message)),
+            logging.INFO,
+        ),
+        (
+            "debug message, DEBUG on",
+            lambda: logging.debug(json.dumps(message)),
+            lambda: logging.debug("received %s", Envelope(message)),
+            logging.DEBUG,
+        ),
+        (
+            f"{args.missing} missing instances",
+            per_instance_warnings,
+            lambda: log_missing_instances(missing, "county"),
+            logging.INFO,
+        ),
+        (
+            "per-variable translation logs",
+            lambda: [
+                logging.info(
+                    f"validating input: message from benchmark, translating variable {item}, county -> state"
+                )
+                for item in message["payload"]
+            ],
+            lambda: [
+                logging.debug(
+                    "validating input: message from %s, translating variable %s, %s -> %s",
+                    "benchmark",
+                    item,
+                    "county",
+                    "state",
+                )
+                for item in message["payload"]
+            ],
+            logging.INFO,
+        ),
+    ]
+
+    print(
+        f"data message: {args.variables} variables x {args.instances} instances, {frame_size / 2**20:.1f} MiB of JSON"
+    )
+    width = max(len(case[0]) for case in cases) + 2
+    print(f"{'':{width}}{'before':>14}{'after':>14}{'speedup':>10}")
+    for name, before, after, level in cases:
+        root.setLevel(level)
+        before_time = measure(before, args.repeat)
+        after_time = measure(after, args.repeat)
+        print(
+            f"{name:{width}}{before_time * 1e6:>11.1f} us{after_time * 1e6:>11.1f} us"
+            f"{before_time / after_time:>9.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
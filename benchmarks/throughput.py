@@ -0,0 +1,546 @@
+# Copyright 2020 The Johns Hopkins University Applied Physics Laboratory LLC
+# All rights reserved.
+# Distributed under the terms of the MIT License.
+
+
+import argparse
+import json
+import math
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from threading import Thread, Event
+
+import numpy as np
+import zmq
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "broker"))
+from outer_wrapper import OuterWrapper
+from handler import Broker, ENDPOINTS
+
+# the grid of each granularity over a unit square, in columns and rows per county scale k. States nest counties, and
+# the other granularities are offset grids that overlap both, so that every translation route has meet nodes
+GRIDS = {
+    "usa48": lambda k: (1, 1),
+    "state": lambda k: (8, 6),
+    "county": lambda k: (8 * k, 6 * k),
+    "nerc": lambda k: (5, 4),
+    "huc8": lambda k: (7 * k, 5 * k),
+    "latlon": lambda k: (6 * k, 4 * k),
+}
+
+
+def overlaps(a, b):
+    """
+    :param a: the number of equal intervals that split [0, 1]
+    :param b: the number of equal intervals of another split
+    :return: the index of each pair of overlapping intervals, and the length of their overlap
+    """
+
+    pairs = []
+    for i in range(a):
+        low, high = i / a, (i + 1) / a
+        for j in range(int(low * b), min(b, int(math.ceil(high * b)))):
+            length = min(high, (j + 1) / b) - max(low, j / b)
+            if length > 1e-12:
+                pairs.append((i, j, length))
+    return pairs
+
+
+def synthetic_graphs(graph_dir, counties):
+    """
+    writes the abstract graph, and a synthetic instance graph of grid granularities, to a directory
+    :param graph_dir: the directory
+    :param counties: the approximate number of counties
+    :return: the instances of each granularity
+    """
+
+    abstract_path = os.path.join(
+        ROOT, "graphs", "out", "abstract-graph.geojson"
+    )
+    shutil.copy(abstract_path, graph_dir)
+    with open(abstract_path) as abstract_file:
+        abstract = json.load(abstract_file)
+
+    k = max(1, int(round(math.sqrt(counties / 48))))
+    grids = {granularity: grid(k) for granularity, grid in GRIDS.items()}
+
+    def instance(granularity, column, row):
+        return f"{granularity}{column}-{row}"
+
+    nodes, links = [], []
+    instances = {}
+    for granularity, (columns, rows) in grids.items():
+        instances[granularity] = []
+        for column in range(columns):
+            for row in range(rows):
+                node = instance(granularity, column, row)
+                instances[granularity].append(node)
+                nodes.append(
+                    {
+                        "id": node,
+                        "type": granularity,
+                        "area": 1 / (columns * rows),
+                    }
+                )
+                if granularity == "county":
+                    parent = instance("state", column // k, row // k)
+                elif granularity != "usa48":
+                    parent = "usa480-0"
+                else:
+                    continue
+                links.append({"source": parent, "target": node})
+
+    for meet in [
+        node["id"] for node in abstract["nodes"] if "^" in node["id"]
+    ]:
+        a, b = meet.split("^")
+        (a_columns, a_rows), (b_columns, b_rows) = grids[a], grids[b]
+        for a_column, b_column, width in overlaps(a_columns, b_columns):
+            for a_row, b_row, height in overlaps(a_rows, b_rows):
+                a_node = instance(a, a_column, a_row)
+                b_node = instance(b, b_column, b_row)
+                node = f"{a_node}^{b_node}"
+                nodes.append(
+                    {"id": node, "type": meet, "area": width * height}
+                )
+                links.append({"source": a_node, "target": node})
+                links.append({"source": b_node, "target": node})
+
+    with open(
+        os.path.join(graph_dir, "instance-graph.geojson"), "w"
+    ) as graph_file:
+        json.dump(
+            {
+                "directed": True,
+                "multigraph": False,
+                "graph": {},
+                "nodes": nodes,
+                "links": links,
+            },
+            graph_file,
+        )
+    return instances
+
+
+def schema(variables, granularity):
+    """
+    :param variables: the names of the variables
+    :param granularity: the granularity of every variable
+    :return: a schema of the variables, like the models' input and output schemas
+    """
+
+    return {
+        "type": "object",
+        "properties": {
+            variable: {
+                "type": "object",
+                "properties": {
+                    "data": {"type": "object"},
+                    "granularity": {"type": "string", "value": granularity},
+                },
+            }
+            for variable in variables
+        },
+        "required": list(variables),
+    }
+
+
+def variables(model, count):
+    """
+    :return: the names of a model's output variables
+    """
+
+    return [f"{model}_v{v}" for v in range(count)]
+
+
+def model_dir(root, model, sources, args):
+    """
+    writes a synthetic model's directory, with an output schema, and an input schema for each of its sources
+    :param root: the directory of the models' directories
+    :param model: the model's ID
+    :param sources: the models that the model receives data from
+    :param args: the benchmark's arguments
+    :return: the model's directory
+    """
+
+    path = os.path.join(root, model)
+    for directory in ["config", "schemas/input", "schemas/output"]:
+        os.makedirs(os.path.join(path, directory))
+    with open(
+        os.path.join(path, "schemas", "output", f"{model}.json"), "w"
+    ) as schema_file:
+        json.dump(
+            schema(variables(model, args.variables), args.granularity),
+            schema_file,
+        )
+    for source in sources:
+        with open(
+            os.path.join(path, "schemas", "input", f"{source}.json"), "w"
+        ) as schema_file:
+            json.dump(
+                schema(
+                    variables(source, args.variables), args.input_granularity
+                ),
+                schema_file,
+            )
+    return path
+
+
+class SyntheticModel(OuterWrapper):
+    def __init__(self, model_id, sources, data, args, **kwargs):
+        """
+        a model that publishes the same outputs every increment, after computing for a fixed time
+        :param model_id: the model's ID
+        :param sources: the models that the model receives data from
+        :param data: a dict mapping each instance of the output granularity to its value
+        :param args: the benchmark's arguments
+        :param kwargs: the outer wrapper's arguments
+        """
+
+        super().__init__(
+            model_id=model_id,
+            num_expected_inputs=len(sources),
+            execution=args.execution,
+            translation_workers=args.translation_workers,
+            translation_pool=args.translation_pool,
+            **kwargs,
+        )
+        self.compute = args.compute
+        self.outputs = {
+            model_id: {
+                variable: {"data": data, "granularity": args.granularity}
+                for variable in variables(model_id, args.variables)
+            }
+        }
+
+    def configure(self, **kwargs):
+        pass
+
+    def increment(self, **kwargs):
+        # hold the CPU, like a model's calculations
+        end = time.perf_counter() + self.compute
+        while time.perf_counter() < end:
+            pass
+        return self.outputs
+
+
+class MemoryCollection:
+    def __init__(self):
+        """
+        an in-memory stand-in for a Mongo collection, that counts the inserted documents
+        """
+
+        self.count = 0
+
+    def insert_one(self, document):
+        self.count += 1
+
+
+class CpuAccounting:
+    def __init__(self):
+        """
+        the CPU time of every thread, by component and by the thread's function. A thread belongs to the component
+        of the thread that created it, so the threads of a model's translation pool count towards the models
+        """
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.cpu = defaultdict(float)
+        self.original = None
+
+    def install(self):
+        accounting = self
+        init, run = Thread.__init__, Thread.run
+        self.original = init, run
+
+        def accounted_init(thread, *args, **kwargs):
+            init(thread, *args, **kwargs)
+            thread.component = getattr(
+                accounting.local, "component", "benchmark"
+            )
+
+        def accounted_run(thread):
+            accounting.local.component = thread.component
+            function = getattr(thread, "_target", None)
+            name = getattr(function, "__name__", type(thread).__name__).strip(
+                "_"
+            )
+            try:
+                run(thread)
+            finally:
+                cpu = time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+                with accounting.lock:
+                    accounting.cpu[(thread.component, name)] += cpu
+
+        Thread.__init__ = accounted_init
+        Thread.run = accounted_run
+
+    def uninstall(self):
+        Thread.__init__, Thread.run = self.original
+
+
+def counter(snapshots, name, **labels):
+    """
+    :return: the sum of a counter over the metrics snapshots, for the series that match the labels
+    """
+
+    return sum(
+        value
+        for snapshot in snapshots
+        for counter_name, counter_labels, value in snapshot["counters"]
+        if counter_name == name
+        and all(
+            counter_labels.get(key) == expected
+            for key, expected in labels.items()
+        )
+    )
+
+
+def phase_totals(snapshots):
+    """
+    :return: the total time of each phase over the metrics snapshots
+    """
+
+    totals = defaultdict(float)
+    for snapshot in snapshots:
+        for name, labels, counts, total in snapshot["histograms"]:
+            if name == "simon_phase_seconds":
+                totals[labels["phase"]] += total
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="run the broker and synthetic models in one process, and measure the step latency, throughput, "
+        "and CPU of each component"
+    )
+    parser.add_argument(
+        "--models", type=int, default=5, help="the number of synthetic models"
+    )
+    parser.add_argument(
+        "--inputs",
+        type=int,
+        default=2,
+        help="the number of models that each model receives data from (its fan-in, and also its fan-out)",
+    )
+    parser.add_argument(
+        "--increments", type=int, default=20, help="the number of increments"
+    )
+    parser.add_argument(
+        "--variables",
+        type=int,
+        default=2,
+        help="the number of variables of each data message",
+    )
+    parser.add_argument(
+        "--counties",
+        type=int,
+        default=1000,
+        help="the approximate number of counties of the synthetic instance graph. The other granularities scale "
+        "with it",
+    )
+    parser.add_argument(
+        "--granularity",
+        default="county",
+        choices=list(GRIDS),
+        help="the granularity of the models' outputs, which sets the size of the data messages",
+    )
+    parser.add_argument(
+        "--input-granularity",
+        default="state",
+        choices=list(GRIDS),
+        help="the granularity of the models' inputs. The outputs are translated to it",
+    )
+    parser.add_argument(
+        "--compute",
+        type=float,
+        default=0.01,
+        help="the seconds of CPU of each increment",
+    )
+    parser.add_argument(
+        "--transport",
+        default="inproc",
+        choices=["inproc", "tcp"],
+        help="the zmq transport",
+    )
+    parser.add_argument(
+        "--execution", default="thread", choices=["thread", "process"]
+    )
+    parser.add_argument("--translation-workers", type=int, default=1)
+    parser.add_argument(
+        "--translation-pool", default="thread", choices=["thread", "process"]
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    if not 0 <= args.inputs < args.models:
+        parser.error("--inputs must be less than --models")
+    if args.translation_pool == "process":
+        # each pool starts a management thread, and the pools' workers find their model through one module-level
+        # variable, so the pools of several models in one process can't be forked safely
+        parser.error(
+            "--translation-pool process needs a process per model, and isn't supported by the benchmark"
+        )
+
+    os.environ["SIMON_LOG_LEVEL"] = args.log_level
+    if args.transport == "inproc":
+        endpoints = {
+            channel: f"inproc://simon-{channel}" for channel in ENDPOINTS
+        }
+    else:
+        endpoints = {
+            channel: endpoint.replace("tcp://broker:", "tcp://127.0.0.1:")
+            for channel, endpoint in ENDPOINTS.items()
+        }
+
+    directory = tempfile.mkdtemp(prefix="simon-throughput-")
+    try:
+        start = time.perf_counter()
+        instances = synthetic_graphs(directory, args.counties)
+        data = {
+            instance: float(value)
+            for instance, value in zip(
+                instances[args.granularity],
+                np.random.default_rng(0).random(
+                    len(instances[args.granularity])
+                ),
+            )
+        }
+        print(
+            f"synthetic instance graph of {len(instances['county'])} counties in "
+            f"{time.perf_counter() - start:.1f} s; {args.variables} variables x {len(data)} {args.granularity} "
+            f"instances per data message, translated to {args.input_granularity}"
+        )
+
+        # a ring of models: each receives data from the models before it
+        names = [f"model{m}" for m in range(args.models)]
+        models = []
+        for m, name in enumerate(names):
+            sources = [
+                names[(m - i) % args.models] for i in range(1, args.inputs + 1)
+            ]
+            models.append(
+                SyntheticModel(
+                    name,
+                    sources,
+                    data,
+                    args,
+                    endpoints=endpoints,
+                    model_dir=model_dir(directory, name, sources, args),
+                    graph_dir=directory,
+                )
+            )
+        store = defaultdict(MemoryCollection)
+        broker = Broker(
+            config={
+                "models": names,
+                "boot_timer": 60,
+                "watchdog_timer": 60,
+                "max_incstep": args.increments,
+                "initial_year": 2016,
+            },
+            endpoints=endpoints,
+            store=store,
+        )
+
+        # fork every model's worker process before any threads or zmq sockets exist, so that no worker inherits a
+        # lock held by another thread, e.g., the logging lock
+        if args.execution == "process":
+            for model in models:
+                model.start_model_process()
+
+        accounting = CpuAccounting()
+        accounting.install()
+        context = zmq.Context()
+        shutdown = Event()
+        start = time.perf_counter()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        broker_thread = Thread(target=broker.run, args=(context,))
+        broker_thread.component = "broker"
+        model_threads = []
+        for model in models:
+            thread = Thread(target=model.run, args=(context, shutdown))
+            thread.component = "models"
+            model_threads.append(thread)
+        broker_thread.start()
+        for thread in model_threads:
+            thread.start()
+
+        broker_thread.join()
+        shutdown.set()
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join()
+        wall = time.perf_counter() - start
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        context.term()
+        accounting.uninstall()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    durations = np.array(
+        [
+            broker.critical_paths[incstep]["duration"]
+            for incstep in sorted(broker.critical_paths)
+        ]
+    )
+    if len(durations) < args.increments:
+        print(
+            f"only {len(durations)} of {args.increments} increments finished"
+        )
+    if not len(durations):
+        return
+
+    snapshots = [model.metrics.snapshot() for model in models]
+    messages = counter(snapshots, "simon_messages_sent_total", signal="data")
+    size = counter(snapshots, "simon_bytes_sent_total", signal="data")
+    gaps = counter(
+        snapshots + [broker.metrics.snapshot()], "simon_data_gaps_total"
+    )
+    steps = durations.sum()
+
+    print(f"\nstep latency over {len(durations)} increments")
+    for name, value in [
+        ("p50", np.percentile(durations, 50)),
+        ("p90", np.percentile(durations, 90)),
+        ("p99", np.percentile(durations, 99)),
+        ("max", durations.max()),
+    ]:
+        print(f"  {name:<6}{value * 1e3:>10.1f} ms")
+
+    print("\nthroughput")
+    print(f"  {'increments':<16}{len(durations) / steps:>10.1f} /s")
+    print(f"  {'data messages':<16}{messages / steps:>10.1f} /s")
+    print(f"  {'data':<16}{size / 2**20 / steps:>10.1f} MiB/s")
+    print(f"  {'stored':<16}{store['sub'].count:>10} data messages")
+    print(f"  {'lost':<16}{gaps:>10} data messages")
+
+    print(f"\ncpu over {wall:.1f} s")
+    total = (end_usage.ru_utime + end_usage.ru_stime) - (
+        usage.ru_utime + usage.ru_stime
+    )
+    for (component, name), cpu in sorted(
+        accounting.cpu.items(), key=lambda item: -item[1]
+    ):
+        if cpu >= 0.01:
+            print(
+                f"  {component + '.' + name:<36}{cpu:>8.2f} s{cpu / wall:>8.0%}"
+            )
+    print(f"  {'process':<36}{total:>8.2f} s{total / wall:>8.0%}")
+
+    print("\nmodel phases, summed over models")
+    for phase, seconds in sorted(
+        phase_totals(snapshots).items(), key=lambda item: -item[1]
+    ):
+        print(f"  {phase:<36}{seconds:>8.2f} s")
+
+
+if __name__ == "__main__":
+    main()
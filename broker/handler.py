@@ -6,21 +6,183 @@
 import zmq
 import time
 import json
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from queue import Queue, Empty
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
 import pymongo
 import sys
+import os
 import logging
 
+# the modules shared with the outer wrapper are in the broker's parent directory: the repository's root, or / in the
+# container
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from simon_common import (
+    Metrics,
+    Envelope,
+    configure_logging,
+    offer,
+    track_sequence,
+)
+
+
+# the forwarder's ports: the models publish to the frontends, and subscribe to the backends. Control messages have
+# their own channel, so that they aren't queued behind bulk data messages
+DATA_FRONTEND_PORT = 5555
+DATA_BACKEND_PORT = 5556
+CONTROL_FRONTEND_PORT = 5557
+CONTROL_BACKEND_PORT = 5558
+
+# the broker's heartbeat port: the models push their status messages to the broker only, and the broker publishes
+# one aggregated state of all of the models in its own status message
+HEARTBEAT_PORT = 5559
+
+# the broker's registration port: each model registers with a request at startup, and the broker boots as soon as
+# the last one has registered
+REGISTRATION_PORT = 5560
+
+# the address of each of the broker's channels, as the models and the broker's own sockets connect to them.
+# A benchmark that runs the broker and the models in one process passes its own, e.g., inproc:// addresses
+ENDPOINTS = {
+    "data_frontend": f"tcp://broker:{DATA_FRONTEND_PORT}",
+    "data_backend": f"tcp://broker:{DATA_BACKEND_PORT}",
+    "control_frontend": f"tcp://broker:{CONTROL_FRONTEND_PORT}",
+    "control_backend": f"tcp://broker:{CONTROL_BACKEND_PORT}",
+    "heartbeat": f"tcp://broker:{HEARTBEAT_PORT}",
+    "registration": f"tcp://broker:{REGISTRATION_PORT}",
+}
+
+
+def bind_address(endpoint):
+    """
+    :param endpoint: the address that sockets connect to
+    :return: the address that the broker's socket binds to: every interface, for a TCP endpoint
+    """
+
+    transport, address = endpoint.split("://", 1)
+    if transport == "tcp":
+        return f"tcp://*:{address.rsplit(':', 1)[1]}"
+    return endpoint
+
+
+def prometheus_text(snapshots):
+    """
+    renders metrics in the Prometheus text exposition format
+    :param snapshots: a list of (labels, snapshot) pairs, where the labels are added to every metric of the snapshot
+    :return: the metrics, grouped by name
+    """
+
+    def label_text(labels):
+        if not labels:
+            return ""
+        pairs = ",".join(
+            '{}="{}"'.format(
+                key,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for key, value in sorted(labels.items())
+        )
+        return f"{{{pairs}}}"
+
+    samples = {}
+    for extra_labels, snapshot in snapshots:
+        for kind in ["counters", "gauges"]:
+            metric_type = "counter" if kind == "counters" else "gauge"
+            for name, labels, value in snapshot.get(kind, []):
+                samples.setdefault((name, metric_type), []).append(
+                    f"{name}{label_text(dict(labels, **extra_labels))} {value}"
+                )
+        buckets = snapshot.get("buckets", [])
+        for name, labels, counts, total in snapshot.get("histograms", []):
+            labels = dict(labels, **extra_labels)
+            lines = samples.setdefault((name, "histogram"), [])
+            cumulative = 0
+            for bound, count in zip(buckets + ["+Inf"], counts):
+                cumulative += count
+                lines.append(
+                    f"{name}_bucket{label_text(dict(labels, le=bound))} {cumulative}"
+                )
+            lines.append(f"{name}_sum{label_text(labels)} {total}")
+            lines.append(f"{name}_count{label_text(labels)} {cumulative}")
+
+    text = []
+    for (name, metric_type), lines in sorted(samples.items()):
+        text.append(f"# TYPE {name} {metric_type}")
+        text.extend(lines)
+    return "\n".join(text) + "\n"
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    # Python 3.6 has no ThreadingHTTPServer
+    daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlparse(self.path).path != "/metrics":
+            self.send_error(404)
+            return
+        self.respond(
+            200,
+            self.server.broker.metrics_text(),
+            "text/plain; version=0.0.4",
+        )
+
+    def do_POST(self):
+        """
+        POST /profile?model=<model>&increments=<n>&interval=<seconds> publishes a profile signal
+        """
+
+        url = urlparse(self.path)
+        if url.path != "/profile":
+            self.send_error(404)
+            return
+        query = {
+            key: values[-1] for key, values in parse_qs(url.query).items()
+        }
+        try:
+            message = self.server.broker.send_profile(
+                model=query.get("model"),
+                increments=int(query.get("increments", 1)),
+                interval=float(query.get("interval", 0.01)),
+            )
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self.respond(202, json.dumps(message) + "\n", "application/json")
+
+    def respond(self, code, text, content_type):
+        body = text.encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
 
 class Broker:
-    def __init__(self):
+    def __init__(self, config=None, endpoints=None, store=None):
         """
         constructor for the broker
+        :param config: the broker's config. Defaults to the contents of /opt/config.json
+        :param endpoints: the address of each of the broker's channels, by channel name. Defaults to ENDPOINTS
+        :param store: the database that messages are inserted into, e.g., an in-memory stand-in for a benchmark.
+                Each collection must have an insert_one method, like pymongo's. Defaults to the SIMoN Mongo instance
         """
 
-        with open("/opt/config.json") as models_file:
-            config = json.load(models_file)
+        if config is None:
+            with open("/opt/config.json") as models_file:
+                config = json.load(models_file)
+        self.endpoints = endpoints or ENDPOINTS
+        self.store = store
         self.models = {model: {} for model in config["models"]}
         self.boot_timer = config["boot_timer"]  # units: seconds
         self.watchdog_timer = config["watchdog_timer"]  # units: seconds
@@ -30,24 +192,52 @@ class Broker:
         self.initial_year = config[
             "initial_year"
         ]  # the year that corresponds to incstep 0 (the data in the config directory)
-        self.mongo_port = config[
+        self.mongo_port = config.get(
             "mongo_port"
-        ]  # the port for the SIMoN Mongo instance (needs to be the same port as in the build/docker-compose.yml file)
+        )  # the port for the SIMoN Mongo instance (needs to be the same port as in the build/docker-compose.yml file)
+        self.metrics_port = config.get(
+            "metrics_port"
+        )  # the port of the broker's Prometheus metrics endpoint, if any
+        self.data_hwm = config.get(
+            "data_hwm", 1000
+        )  # the number of data messages the forwarder queues per socket before dropping new ones
+        self.mongo_watermark = config.get(
+            "mongo_watermark", 100
+        )  # the number of messages waiting for Mongo above which the next pulse is held back
+        self.model_watermark = config.get(
+            "model_watermark", 10
+        )  # the number of messages a model may have waiting before the next pulse is held back
+        self.mongo_drain_timer = config.get(
+            "mongo_drain_timer", 60
+        )  # the number of seconds to wait at shutdown for the messages waiting for Mongo to be written
 
         self.status = "booting"
-        self.pub_queue = Queue()
+        self.pub_queue = Queue(config.get("pub_queue_size", 1000))
         self.model_tracker = set()
+        self.registered = set()
+        self.booted = Event()
+        self.status_changed = Event()
+        self.start_time = time.time()
         self.incstep = 1
         self.client = None
-        self.mongo_queue = Queue()
+        self.mongo_queue = Queue(config.get("mongo_queue_size", 10000))
+        self.mongo_thread = None
+        self.data_seqs = {}
         self.broker_id = "broker"
 
-        logging.basicConfig(
-            level=logging.INFO,
-            stream=sys.stdout,
-            format="%(asctime)s - %(levelname)s - %(filename)s:%(funcName)s:%(lineno)d - %(message)s",
-        )
-        logging.info(f"looking for models: {list(self.models.keys())}")
+        # the timeline of each incstep, as seen by the broker: when its pulse was sent, when each model published
+        # its data, and when each model became ready for the next increment
+        self.timeline = {}
+        self.timeline_lock = Lock()
+        self.critical_paths = {}
+        self.summary_written = False
+
+        # the broker's metrics, and the latest metrics snapshot of each model
+        self.metrics = Metrics()
+        self.model_metrics = {}
+
+        configure_logging(model=self.broker_id)
+        logging.info("looking for models: %s", list(self.models.keys()))
 
     def insert_into_mongodb(self, event):
         """
@@ -56,167 +246,705 @@ class Broker:
         :return: runs continuously until the shutdown event is set
         """
 
-        try:
-            self.client = pymongo.MongoClient(
-                f"mongodb://simon_mongodb:{self.mongo_port}/"
-            )
-            logging.info("connected to Mongo DB")
-        except Exception as e:
-            logging.error("failed to connect to Mongo DB")
-            return False
+        if self.store is not None:
+            metadata_db = self.store
+        else:
+            try:
+                self.client = pymongo.MongoClient(
+                    f"mongodb://simon_mongodb:{self.mongo_port}/"
+                )
+                logging.info("connected to Mongo DB")
+            except Exception as e:
+                logging.error("failed to connect to Mongo DB")
+                return False
+            metadata_db = self.client[self.broker_id]
 
-        metadata_db = self.client[self.broker_id]
         while not event.is_set():
             try:
                 message = self.mongo_queue.get(timeout=0.1)
                 collection = message[0]
                 messages_col = metadata_db[collection]
                 payload = message[1]
-                messages_col.insert_one(payload)
             except Empty:
                 continue
+            try:
+                start = time.monotonic()
+                messages_col.insert_one(payload)
+                self.metrics.observe(
+                    "simon_mongo_write_seconds",
+                    time.monotonic() - start,
+                    collection=collection,
+                )
+            except Exception as e:
+                # a failed write loses the message, but not the thread, so the queue keeps draining
+                self.metrics.inc(
+                    "simon_mongo_errors_total", collection=collection
+                )
+                logging.error(f"failed to insert into {collection}: {e}")
+            finally:
+                self.mongo_queue.task_done()
+
+    def drain_mongo(self):
+        """
+        waits for the messages in the Mongo queue to be written, until the Mongo thread has stopped or the drain
+        timer runs out
+        :return: the number of messages that weren't written
+        """
+
+        deadline = time.monotonic() + self.mongo_drain_timer
+        with self.mongo_queue.all_tasks_done:
+            while (
+                self.mongo_queue.unfinished_tasks
+                and self.mongo_thread is not None
+                and self.mongo_thread.is_alive()
+            ):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # wake up at least every second to check that the Mongo thread is still running
+                self.mongo_queue.all_tasks_done.wait(min(remaining, 1))
+            return self.mongo_queue.unfinished_tasks
+
+    def system_state(self):
+        """
+        :return: the latest status and incstep of each model, compact enough to publish to every model each second
+        """
+
+        return {
+            model: {
+                "status": status.get("status"),
+                "incstep": status.get("incstep"),
+            }
+            for model, status in list(self.models.items())
+        }
+
+    def status_message(self):
+        """
+        :return: a status message, with the aggregated state of the models
+        """
+
+        message = {}
+        message["source"] = self.broker_id
+        message["time"] = time.time()
+        message["signal"] = "status"
+        message["status"] = self.status
+        message["incstep"] = self.incstep
+        message["max_incstep"] = self.max_incstep
+        message["initial_year"] = self.initial_year
+        message["current_year"] = self.incstep + self.initial_year
+        message["models"] = self.system_state()
+        return message
 
     def send_status(self, event):
         """
-        creates a status message and puts it into the publish queue
+        puts a status message into the publish queue every second. It is the only status message the models receive
         :param event: the shutdown event for managing threads
         :return: runs continuously until the shutdown event is set
         """
 
         while not event.is_set():
             time.sleep(1)
-            message = {}
-            message["source"] = self.broker_id
-            message["time"] = time.time()
-            message["signal"] = "status"
-            message["status"] = self.status
-            message["incstep"] = self.incstep
-            message["initial_year"] = self.initial_year
-            message["current_year"] = self.incstep + self.initial_year
-            self.pub_queue.put(message)
+            message = self.status_message()
+            if not offer(self.pub_queue, message, self.metrics, "pub"):
+                logging.warning(
+                    "publish queue is full, dropped status message"
+                )
 
     def pub(self, event, context):
         """
-        publishes messages to the models, via the forwarder's SUB
+        publishes messages to the models, via the forwarder's control channel. The broker only sends control
+        messages: status messages, increment pulses, and profile signals
         :param event: the shutdown event for managing threads
         :return: runs continuously until the shutdown event is set, then closes its zmq socket
         """
 
         sock = context.socket(zmq.PUB)
         sock.setsockopt(zmq.LINGER, 1000)
-        sock.connect("tcp://broker:5555")
+        sock.connect(self.endpoints["control_frontend"])
         while not event.is_set():
             try:
                 message = self.pub_queue.get(timeout=0.1)
             except Empty:
                 continue
-            logging.debug(json.dumps(message))
+            logging.debug("sending %s", Envelope(message))
             sock.send_json(message)
+            self.metrics.inc(
+                "simon_messages_sent_total", signal=message.get("signal")
+            )
 
         sock.close()
 
     def sub(self, event, context):
         """
-        receives messages from the models, via the forwarder's PUB
+        receives the models' status messages on the heartbeat port, and their other messages via the forwarder's
+        PUBs. Status and control messages are handled before each data message
         :param event: the shutdown event for managing threads
-        :return: runs continuously until the shutdown event is set, then closes its zmq socket
+        :return: runs continuously until the shutdown event is set, then closes its zmq sockets
         """
 
-        sock = context.socket(zmq.SUB)
-        sock.setsockopt(zmq.SUBSCRIBE, b"")
-        sock.setsockopt(zmq.RCVTIMEO, 0)
-        sock.setsockopt(zmq.LINGER, 1000)
-        sock.connect("tcp://broker:5556")
+        control = context.socket(zmq.SUB)
+        control.setsockopt(zmq.SUBSCRIBE, b"")
+        control.setsockopt(zmq.LINGER, 1000)
+        control.connect(self.endpoints["control_backend"])
+
+        heartbeat = context.socket(zmq.PULL)
+        heartbeat.setsockopt(zmq.LINGER, 0)
+        heartbeat.bind(bind_address(self.endpoints["heartbeat"]))
+
+        data = context.socket(zmq.SUB)
+        data.setsockopt(zmq.SUBSCRIBE, b"")
+        data.setsockopt(zmq.LINGER, 1000)
+        data.setsockopt(zmq.RCVHWM, self.data_hwm)
+        data.connect(self.endpoints["data_backend"])
+
+        poller = zmq.Poller()
+        poller.register(control, zmq.POLLIN)
+        poller.register(heartbeat, zmq.POLLIN)
+        poller.register(data, zmq.POLLIN)
+
         while not event.is_set():
-            try:
-                message = sock.recv_json()
-            except zmq.ZMQError:
+            if not poller.poll(100):
                 continue
-            logging.debug(json.dumps(message))
-            if (
-                message.get("source") in self.models
-                and message.get("signal") == "status"
-            ):
-                self.models[message.get("source")] = message
-                self.model_tracker.add(message.get("source"))
-            if message.get("signal") == "data":
-                self.mongo_queue.put(("sub", message))
 
-        sock.close()
+            # drain the status and control messages, then take one data message at a time, checking for status and
+            # control messages between
+            while True:
+                for sock in (heartbeat, control):
+                    while True:
+                        try:
+                            self.receive(sock.recv(zmq.NOBLOCK))
+                        except zmq.Again:
+                            break
+                try:
+                    self.receive(data.recv(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+
+        control.close()
+        heartbeat.close()
+        data.close()
+
+    def receive(self, frame):
+        """
+        handles a message from a model: tracks its status, persists its data, spans, and profiles, and keeps its
+        metrics
+        :param frame: the received frame
+        """
+
+        try:
+            message = json.loads(frame)
+        except ValueError:
+            logging.warning("json decode error")
+            return
+        logging.debug("received %s", Envelope(message))
+        self.metrics.inc(
+            "simon_messages_received_total",
+            source=message.get("source"),
+            signal=message.get("signal"),
+        )
+        self.metrics.inc(
+            "simon_bytes_received_total",
+            len(frame),
+            source=message.get("source"),
+        )
+        if message.get("source") in self.models:
+            self.record_event(message)
+        if (
+            message.get("source") in self.models
+            and message.get("signal") == "status"
+        ):
+            # keep the model's latest metrics, to serve with the broker's
+            metrics = message.pop("metrics", None)
+            if metrics:
+                self.model_metrics[message.get("source")] = metrics
+
+            # persist the model's span summaries, by incstep and phase
+            spans = message.pop("spans", None)
+            if spans:
+                offer(
+                    self.mongo_queue,
+                    (
+                        "spans",
+                        {
+                            "source": message.get("source"),
+                            "time": message.get("time"),
+                            "incstep": message.get("incstep"),
+                            "spans": spans,
+                        },
+                    ),
+                    self.metrics,
+                    "mongo",
+                )
+            self.models[message.get("source")] = message
+            self.model_tracker.add(message.get("source"))
+            self.status_changed.set()
+        if message.get("signal") == "data":
+            track_sequence(self.data_seqs, message, self.metrics)
+            if not offer(
+                self.mongo_queue, ("sub", message), self.metrics, "mongo"
+            ):
+                logging.error(
+                    "Mongo queue is full, dropped %s", Envelope(message)
+                )
+        if message.get("signal") == "profile_result":
+            logging.info(
+                f"received profile of {message.get('samples')} samples from {message.get('source')}"
+            )
+            offer(
+                self.mongo_queue, ("profiles", message), self.metrics, "mongo"
+            )
 
     def forwarder(self, event, context):
         """
-        acts as a proxy between models by pushing messages received by the broker's SUB to the broker's PUB
+        acts as a proxy between models by pushing messages received by the broker's SUBs to the broker's PUBs.
+        There are two channels: control messages (the broker's status messages, increment pulses, profile signals),
+        and data messages. The models' status messages bypass the forwarder, on the heartbeat port. Every waiting
+        control message is forwarded before each data message, so that a burst of large data messages doesn't delay
+        the heartbeats and pulses. The frames are forwarded without decoding them
         :param event: the shutdown event for managing threads
         :return: runs continuously until the shutdown event is set, then closes its zmq sockets
         """
 
         logging.info("started forwarder")
 
-        frontend = context.socket(zmq.SUB)
-        frontend.setsockopt(zmq.SUBSCRIBE, b"")
-        frontend.setsockopt(zmq.RCVTIMEO, 0)
-        frontend.setsockopt(zmq.LINGER, 1000)
-        frontend.bind("tcp://*:5555")
+        control_frontend = context.socket(zmq.SUB)
+        control_frontend.setsockopt(zmq.SUBSCRIBE, b"")
+        control_frontend.setsockopt(zmq.LINGER, 1000)
+        control_frontend.bind(bind_address(self.endpoints["control_frontend"]))
+
+        control_backend = context.socket(zmq.PUB)
+        control_backend.setsockopt(zmq.LINGER, 1000)
+        control_backend.bind(bind_address(self.endpoints["control_backend"]))
+
+        data_frontend = context.socket(zmq.SUB)
+        data_frontend.setsockopt(zmq.SUBSCRIBE, b"")
+        data_frontend.setsockopt(zmq.LINGER, 1000)
+        data_frontend.setsockopt(zmq.RCVHWM, self.data_hwm)
+        data_frontend.bind(bind_address(self.endpoints["data_frontend"]))
+
+        data_backend = context.socket(zmq.PUB)
+        data_backend.setsockopt(zmq.LINGER, 1000)
+        data_backend.setsockopt(zmq.SNDHWM, self.data_hwm)
+        data_backend.bind(bind_address(self.endpoints["data_backend"]))
 
-        backend = context.socket(zmq.PUB)
-        backend.setsockopt(zmq.LINGER, 1000)
-        backend.bind("tcp://*:5556")
+        poller = zmq.Poller()
+        poller.register(control_frontend, zmq.POLLIN)
+        poller.register(data_frontend, zmq.POLLIN)
 
         logging.info("listening in forwarder")
         while not event.is_set():
-            try:
-                message = frontend.recv_json()
-                logging.debug("received message in forwarder")
-                backend.send_json(message)
-                logging.debug("sent message in forwarder")
-            except zmq.ZMQError:
+            if not poller.poll(100):
                 continue
 
+            while True:
+                while True:
+                    try:
+                        control_backend.send(
+                            control_frontend.recv(zmq.NOBLOCK)
+                        )
+                    except zmq.Again:
+                        break
+                    self.metrics.inc(
+                        "simon_messages_forwarded_total", channel="control"
+                    )
+                try:
+                    data_backend.send(data_frontend.recv(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+                self.metrics.inc(
+                    "simon_messages_forwarded_total", channel="data"
+                )
+
         logging.critical("forwarder is shutting down")
-        frontend.close()
-        backend.close()
+        control_frontend.close()
+        control_backend.close()
+        data_frontend.close()
+        data_backend.close()
+
+    def registrar(self, event, context):
+        """
+        replies to the models' registration requests with the broker's status. Once every model has registered,
+        sets the broker's status to 'booted' and publishes it right away, instead of at the next status message.
+        A model that registers again, e.g., after a restart, is told that the broker has booted
+        :param event: the shutdown event for managing threads
+        :return: runs continuously until the shutdown event is set, then closes its zmq socket
+        """
+
+        sock = context.socket(zmq.ROUTER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.bind(bind_address(self.endpoints["registration"]))
+        while not event.is_set():
+            if not sock.poll(100):
+                continue
+            identity, empty, frame = sock.recv_multipart()
+            try:
+                model = json.loads(frame).get("source")
+            except ValueError:
+                logging.warning("json decode error")
+                model = None
+
+            if model not in self.models:
+                logging.error(
+                    "rejected registration of unknown model %s", model
+                )
+                reply = {
+                    "source": self.broker_id,
+                    "signal": "status",
+                    "status": "rejected",
+                }
+                sock.send_multipart(
+                    [identity, empty, json.dumps(reply).encode("utf8")]
+                )
+                continue
+
+            self.registered.add(model)
+            logging.info(
+                "registered %s (%d of %d models)",
+                model,
+                len(self.registered),
+                len(self.models),
+            )
+            if self.status == "booting" and self.registered == set(
+                self.models
+            ):
+                self.status = "booted"
+                self.booted.set()
+                self.pub_queue.put(self.status_message())
+                logging.info(
+                    "booted %.2f s after starting",
+                    time.time() - self.start_time,
+                )
+            reply = self.status_message()
+            sock.send_multipart(
+                [identity, empty, json.dumps(reply).encode("utf8")]
+            )
+
+        sock.close()
 
     def watchdog(self, event):
         """
-        verifies that every model is running by receiving its status messages. Sets the broker's status to 'booted'
-        once it has received a status message from every model, and sets the shutdown event if it does not hear from
-        one of the models within the timeout interval
+        waits for every model to register, and sets the shutdown event if they don't within the boot timer. Then
+        verifies that every model is running by receiving its status messages, and sets the shutdown event if it does
+        not hear from one of the models within the timeout interval
         :param event: the shutdown event for managing threads
         :return: runs continuously until the shutdown event is set
         """
 
+        if not self.booted.wait(self.boot_timer):
+            missing_models = set(self.models.keys()) - self.registered
+            logging.critical(
+                f"Timed out waiting for {missing_models} to initialize"
+            )
+            logging.critical(
+                f"Broker will shut down now, current time: {time.ctime()}"
+            )
+            event.set()
+            return
+        self.model_tracker.clear()
+
         while not event.is_set():
-            for i in range(
-                self.boot_timer
-                if self.status == "booting"
-                else self.watchdog_timer
-            ):
-                time.sleep(1)
+            for i in range(self.watchdog_timer):
+                if event.wait(1):
+                    return
                 if self.model_tracker == set(self.models.keys()):
-                    self.status = "booted"
                     self.model_tracker.clear()
                     break
             else:
                 missing_models = set(self.models.keys()) - self.model_tracker
-                logging.critical(
-                    f"Timed out waiting for {missing_models}{' to initialize' if self.status == 'booting' else ''}"
-                )
+                logging.critical(f"Timed out waiting for {missing_models}")
                 logging.critical(
                     f"Broker will shut down now, current time: {time.ctime()}"
                 )
                 event.set()
 
+    def increment_timeline(self, incstep):
+        """
+        :param incstep: the increment step
+        :return: the timeline of the incstep, which the caller must hold the timeline lock to use
+        """
+
+        return self.timeline.setdefault(
+            incstep, {"pulse": None, "data": {}, "ready": {}}
+        )
+
+    def record_event(self, message):
+        """
+        records a model's message in the timeline. A data message at incstep n is the output of increment n, and a
+        ready status at incstep n + 1 means the model has all of its inputs for the increment after n
+        :param message: a status or data message from a model
+        """
+
+        now = time.time()
+        source = message.get("source")
+        incstep = message.get("incstep")
+        if not isinstance(incstep, int):
+            return
+        with self.timeline_lock:
+            if message.get("signal") == "data":
+                # the last data message marks the end of the model's increment
+                self.increment_timeline(incstep)["data"][source] = now
+            elif (
+                message.get("signal") == "status"
+                and message.get("status") == "ready"
+                and incstep > 1
+            ):
+                self.increment_timeline(incstep - 1)["ready"].setdefault(
+                    source, now
+                )
+
+    def critical_path(self, incstep, end):
+        """
+        analyzes the timeline of an increment: which model gated the next pulse, and how much slack the others had.
+        For each model:
+            compute: from the pulse until the model published its last data message
+            wait: from publishing its data until the broker saw it ready, that is, waiting for inputs from other
+                models, plus the delay until its next status message
+            slack: how much later the model could have become ready without delaying the next pulse
+        :param incstep: the increment step
+        :param end: when the next pulse was sent, or when the run finished
+        :return: the critical path of the increment, or None if its pulse wasn't recorded
+        """
+
+        with self.timeline_lock:
+            timeline = self.timeline.pop(incstep, None)
+        if timeline is None or timeline["pulse"] is None:
+            return None
+
+        pulse = timeline["pulse"]
+        models = {}
+        for model in self.models:
+            published = timeline["data"].get(model)
+            ready = timeline["ready"].get(model, end)
+            models[model] = {
+                "compute": published - pulse if published else None,
+                "wait": ready - published if published else ready - pulse,
+                "ready": ready - pulse,
+            }
+        gating_ready = max(stats["ready"] for stats in models.values())
+        for stats in models.values():
+            stats["slack"] = gating_ready - stats["ready"]
+        gate = max(models, key=lambda model: models[model]["ready"])
+
+        # the path to the gating model: if it became ready after it published, it waited on the model whose data
+        # arrived last before it was ready (the broker doesn't know the input schemas, so this is an inference)
+        path = [gate]
+        published = timeline["data"].get(gate)
+        upstream = [
+            (time_published, model)
+            for model, time_published in timeline["data"].items()
+            if model != gate
+            and (published is None or time_published > published)
+            and time_published <= pulse + gating_ready
+        ]
+        if upstream:
+            path.insert(0, max(upstream)[1])
+
+        return {
+            "incstep": incstep,
+            "year": incstep + self.initial_year,
+            "duration": end - pulse,
+            "gate": gate,
+            "path": path,
+            "pulse_delay": end - pulse - gating_ready,
+            "models": models,
+        }
+
+    def finish_increment(self, incstep, end):
+        """
+        computes the critical path of an increment and puts it into the Mongo queue
+        :param incstep: the increment step
+        :param end: when the next pulse was sent, or when the run finished
+        """
+
+        result = self.critical_path(incstep, end)
+        if result is None:
+            return
+        self.critical_paths[incstep] = result
+        logging.info(
+            f"incstep {incstep} took {result['duration']:.2f} s, gated by {' -> '.join(result['path'])}, "
+            f"pulse delay {result['pulse_delay']:.2f} s"
+        )
+        if not offer(
+            self.mongo_queue,
+            ("critical_path", dict(result)),
+            self.metrics,
+            "mongo",
+        ):
+            logging.warning(
+                f"Mongo queue is full, dropped the critical path of incstep {incstep}"
+            )
+
+    def write_summary(self):
+        """
+        summarizes the critical paths of the run by model, logs the summary table, and puts it into the Mongo queue
+        """
+
+        if not self.critical_paths:
+            return
+
+        summary = {}
+        for model in self.models:
+            stats = [
+                result["models"][model]
+                for result in self.critical_paths.values()
+            ]
+            computes = [
+                s["compute"] for s in stats if s["compute"] is not None
+            ]
+            summary[model] = {
+                "gated": sum(
+                    result["gate"] == model
+                    for result in self.critical_paths.values()
+                ),
+                "on_path": sum(
+                    model in result["path"]
+                    for result in self.critical_paths.values()
+                ),
+                "compute": sum(computes),
+                "mean_compute": sum(computes) / len(computes)
+                if computes
+                else None,
+                "wait": sum(s["wait"] for s in stats),
+                "slack": sum(s["slack"] for s in stats),
+                "min_slack": min(s["slack"] for s in stats),
+            }
+        total = sum(
+            result["duration"] for result in self.critical_paths.values()
+        )
+        pulse_delay = sum(
+            result["pulse_delay"] for result in self.critical_paths.values()
+        )
+
+        width = max(len(model) for model in self.models) + 2
+        lines = [
+            f"critical path summary of {len(self.critical_paths)} increments, {total:.2f} s, "
+            f"{pulse_delay:.2f} s of pulse delay",
+            "model".ljust(width)
+            + f"{'gated':>7}{'on path':>9}{'compute':>11}{'wait':>11}{'slack':>11}{'min slack':>11}",
+        ]
+        for model, stats in sorted(
+            summary.items(), key=lambda item: -item[1]["gated"]
+        ):
+            lines.append(
+                model.ljust(width)
+                + f"{stats['gated']:>7}{stats['on_path']:>9}{stats['compute']:>9.2f} s"
+                f"{stats['wait']:>9.2f} s{stats['slack']:>9.2f} s{stats['min_slack']:>9.2f} s"
+            )
+        logging.info("\n".join(lines))
+
+        if not offer(
+            self.mongo_queue,
+            (
+                "critical_path_summary",
+                {
+                    "time": time.time(),
+                    "increments": len(self.critical_paths),
+                    "duration": total,
+                    "pulse_delay": pulse_delay,
+                    "models": summary,
+                },
+            ),
+            self.metrics,
+            "mongo",
+        ):
+            logging.warning(
+                "Mongo queue is full, dropped the critical path summary"
+            )
+
+    def metrics_text(self):
+        """
+        :return: the metrics of the broker, and the latest metrics of each model, in the Prometheus text format
+        """
+
+        self.metrics.set(
+            "simon_queue_depth", self.pub_queue.qsize(), queue="pub"
+        )
+        self.metrics.set(
+            "simon_queue_depth", self.mongo_queue.qsize(), queue="mongo"
+        )
+        self.metrics.set("simon_incstep", self.incstep)
+        for model, status in list(self.models.items()):
+            if "backlog" in status:
+                self.metrics.set(
+                    "simon_model_backlog", status["backlog"], model=model
+                )
+        snapshots = [({"model": self.broker_id}, self.metrics.snapshot())]
+        for model, snapshot in list(self.model_metrics.items()):
+            snapshots.append(({"model": model}, snapshot))
+        return prometheus_text(snapshots)
+
+    def send_profile(self, model=None, increments=1, interval=0.01):
+        """
+        publishes a profile signal, which starts a sampling profiler in one or all of the models for a number of
+        increments. Each model publishes its collapsed stacks when it finishes, and the broker stores them in the
+        profiles collection
+        :param model: the model to profile, or None to profile all of them
+        :param increments: the number of increments to profile
+        :param interval: the sampling interval in seconds
+        :return: the profile message
+        """
+
+        if model is not None and model not in self.models:
+            raise ValueError(f"unknown model {model}")
+        if increments < 1 or interval <= 0:
+            raise ValueError("increments and interval must be positive")
+
+        message = {}
+        message["source"] = self.broker_id
+        message["time"] = time.time()
+        message["signal"] = "profile"
+        message["model"] = model
+        message["incstep"] = self.incstep
+        message["increments"] = increments
+        message["interval"] = interval
+        self.pub_queue.put(message)
+        logging.info(
+            f"profiling {model or 'all models'} for {increments} increments"
+        )
+        return message
+
+    def serve_metrics(self, event):
+        """
+        serves the metrics over HTTP, at /metrics on the metrics port. Also accepts profile requests, at /profile
+        :param event: the shutdown event for managing threads
+        :return: runs continuously until the shutdown event is set, then closes the server
+        """
+
+        server = MetricsServer(("", self.metrics_port), MetricsHandler)
+        server.broker = self
+        server.timeout = 0.5
+        logging.info(f"serving metrics on port {self.metrics_port}")
+        while not event.is_set():
+            server.handle_request()
+        server.server_close()
+
+    def backpressure(self):
+        """
+        :return: why the next increment pulse should be held back, or None. A pulse is held back while the Mongo
+                queue is above its watermark, or while a model has more than its watermark of messages waiting to be
+                received or sent, so that a slow consumer slows the run down instead of its queues growing
+        """
+
+        if self.mongo_queue.qsize() > self.mongo_watermark:
+            return f"{self.mongo_queue.qsize()} messages waiting for Mongo"
+        for model, status in self.models.items():
+            if status.get("backlog", 0) > self.model_watermark:
+                return f"{status['backlog']} messages waiting in {model}"
+        return None
+
     def send_increment_pulse(self, event):
         """
         continuously checks the statuses of the models, then puts an increment pulse message into the publish queue
-        once all of the models are ready to receive it
+        once all of the models are ready to receive it, and nothing is backed up
         :param event: the shutdown event for managing threads
         :return: runs continuously until the shutdown event is set
         """
 
+        held_since = None
         while not event.is_set():
-            time.sleep(1)
+            # check again as soon as a model's status changes, or every second
+            self.status_changed.wait(1)
+            self.status_changed.clear()
 
             # check to send an increment pulse
             for model, status in self.models.items():
@@ -226,10 +954,17 @@ class Broker:
                 ):
                     break
             else:
-                if (
-                    self.incstep > self.max_incstep
-                    and self.mongo_queue.empty()
-                ):
+                if self.incstep > self.max_incstep:
+                    # analyze the last increment, and write the summary before shutting down
+                    if not self.summary_written:
+                        self.finish_increment(self.incstep - 1, time.time())
+                        self.write_summary()
+                        self.summary_written = True
+                    unwritten = self.drain_mongo()
+                    if unwritten:
+                        logging.error(
+                            f"shutting down with {unwritten} messages not written to Mongo"
+                        )
                     logging.critical(
                         f"successfully finished last increment {self.max_incstep}"
                     )
@@ -238,7 +973,29 @@ class Broker:
                     )
                     event.set()
                 else:
+                    reason = self.backpressure()
+                    if reason is not None:
+                        if held_since is None:
+                            held_since = time.monotonic()
+                            logging.warning(
+                                "holding back increment pulse %d: %s",
+                                self.incstep,
+                                reason,
+                            )
+                        self.metrics.inc("simon_pulse_holds_total")
+                        continue
+                    if held_since is not None:
+                        self.metrics.observe(
+                            "simon_pulse_hold_seconds",
+                            time.monotonic() - held_since,
+                        )
+                        held_since = None
                     logging.info(f"sending increment pulse {self.incstep}")
+                    now = time.time()
+                    if self.incstep > 1:
+                        self.finish_increment(self.incstep - 1, now)
+                    with self.timeline_lock:
+                        self.increment_timeline(self.incstep)["pulse"] = now
                     message = {}
                     message["source"] = self.broker_id
                     message["time"] = time.time()
@@ -249,14 +1006,20 @@ class Broker:
                     self.pub_queue.put(message)
                     self.incstep += 1
 
-    def run(self):
+    def run(self, context=None, shutdown=None):
         """
         the main thread of the broker. Launches all sub threads
+        :param context: the zmq context, shared with the models to use inproc:// endpoints in one process.
+                A context created here is terminated at shutdown
+        :param shutdown: the shutdown event, to stop the broker from another thread
         :return: runs continuously until the shutdown event is set
         """
 
-        shutdown = Event()
-        context = zmq.Context()
+        if shutdown is None:
+            shutdown = Event()
+        own_context = context is None
+        if own_context:
+            context = zmq.Context()
 
         forwarder_thread = Thread(
             target=self.forwarder, args=(shutdown, context,)
@@ -266,6 +1029,11 @@ class Broker:
         subscribe_thread = Thread(target=self.sub, args=(shutdown, context,))
         subscribe_thread.start()
 
+        registrar_thread = Thread(
+            target=self.registrar, args=(shutdown, context,)
+        )
+        registrar_thread.start()
+
         publish_thread = Thread(target=self.pub, args=(shutdown, context,))
         publish_thread.start()
 
@@ -280,10 +1048,16 @@ class Broker:
         )
         increment_pulse_thread.start()
 
-        mongo_thread = Thread(
+        self.mongo_thread = Thread(
             target=self.insert_into_mongodb, args=(shutdown,)
         )
-        mongo_thread.start()
+        self.mongo_thread.start()
+
+        if self.metrics_port:
+            metrics_thread = Thread(
+                target=self.serve_metrics, args=(shutdown,)
+            )
+            metrics_thread.start()
 
         try:
             while not shutdown.is_set():
@@ -291,7 +1065,8 @@ class Broker:
         except Exception as e:
             logging.critical(e)
         finally:
-            context.term()
+            if own_context:
+                context.term()
             shutdown.set()
             logging.critical("broker has shut down")
 
@@ -0,0 +1,500 @@
+# Copyright 2020 The Johns Hopkins University Applied Physics Laboratory LLC
+# All rights reserved.
+# Distributed under the terms of the MIT License.
+
+
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from geopandas import GeoDataFrame
+import numpy as np
+from shapely.geometry import Polygon, box
+
+from build import GraphBuilder, PhaseTimer
+from cache import IntersectionCache
+from streaming import MeetNodeStore
+
+# the extent of the synthetic layers, in meters. Roughly the size of the contiguous United States
+WIDTH = 4e6
+HEIGHT = 2.5e6
+
+# the synthetic layers use the same coordinate reference system as the provided shapefiles
+PROJECTION = 3085
+
+ROOT = "world"
+
+
+def layer(IDs, shapes, parent_IDs=None):
+    """
+    :param IDs: the ID of each polygon
+    :param shapes: the shapely polygons
+    :param parent_IDs: the ID of each polygon's parent, or None if the parent is the root
+    :return: a GeoDataFrame with the ID, NAME, parent_ID, and geometry columns that the graph build expects
+    """
+
+    return GeoDataFrame(
+        {
+            "ID": IDs,
+            "NAME": IDs,
+            "parent_ID": parent_IDs or [ROOT] * len(IDs),
+        },
+        geometry=shapes,
+        crs=f"epsg:{PROJECTION}",
+    )
+
+
+def grid_shape(count):
+    """
+    :param count: the approximate number of squares in a grid over the extent
+    :return: the number of columns and rows of the grid
+    """
+
+    columns = max(1, int(round(math.sqrt(count * WIDTH / HEIGHT))))
+    rows = max(1, int(math.ceil(count / columns)))
+    return columns, rows
+
+
+def nested_grids(regions, subdivisions):
+    """
+    generates two nested granularities: a grid of regions, and a finer grid that splits each region into subregions
+    :param regions: the approximate number of regions
+    :param subdivisions: the number of subregions along each side of a region
+    :return: the region and subregion layers
+    """
+
+    columns, rows = grid_shape(regions)
+    width = WIDTH / columns
+    height = HEIGHT / rows
+
+    region_IDs, region_shapes = [], []
+    subregion_IDs, subregion_shapes, parent_IDs = [], [], []
+    for column in range(columns):
+        for row in range(rows):
+            region = f"r{column}-{row}"
+            x, y = column * width, row * height
+            region_IDs.append(region)
+            region_shapes.append(box(x, y, x + width, y + height))
+            for i in range(subdivisions):
+                for j in range(subdivisions):
+                    subregion_IDs.append(f"{region}-s{i}-{j}")
+                    subregion_shapes.append(
+                        box(
+                            x + i * width / subdivisions,
+                            y + j * height / subdivisions,
+                            x + (i + 1) * width / subdivisions,
+                            y + (j + 1) * height / subdivisions,
+                        )
+                    )
+                    parent_IDs.append(region)
+
+    return (
+        layer(region_IDs, region_shapes),
+        layer(subregion_IDs, subregion_shapes, parent_IDs),
+    )
+
+
+def offset_grid(prefix, count, offset):
+    """
+    generates a grid that overlaps the nested grids, clipped to the extent
+    :param prefix: the prefix of the polygon IDs
+    :param count: the approximate number of squares in the grid
+    :param offset: the fraction of a square that the grid is shifted by, in both directions
+    :return: the grid layer
+    """
+
+    columns, rows = grid_shape(count)
+    width = WIDTH / columns
+    height = HEIGHT / rows
+    extent = box(0, 0, WIDTH, HEIGHT)
+
+    IDs, shapes = [], []
+    for column in range(-1, columns):
+        for row in range(-1, rows):
+            x = (column + offset) * width
+            y = (row + offset) * height
+            shape = box(x, y, x + width, y + height).intersection(extent)
+            if shape.area > 0:
+                IDs.append(f"{prefix}{column + 1}-{row + 1}")
+                shapes.append(shape)
+
+    return layer(IDs, shapes)
+
+
+def clip(polygon, point, normal):
+    """
+    clips a convex polygon to a half-plane (Sutherland-Hodgman)
+    :param polygon: a list of (x, y) vertices
+    :param point: a point on the boundary of the half-plane
+    :param normal: the outward normal of the half-plane
+    :return: the vertices of the clipped polygon
+    """
+
+    def inside(vertex):
+        return (vertex[0] - point[0]) * normal[0] + (
+            vertex[1] - point[1]
+        ) * normal[1] <= 0
+
+    clipped = []
+    for i, current in enumerate(polygon):
+        previous = polygon[i - 1]
+        if inside(current) != inside(previous):
+            # add the point where the edge crosses the boundary
+            dx, dy = current[0] - previous[0], current[1] - previous[1]
+            t = (
+                (point[0] - previous[0]) * normal[0]
+                + (point[1] - previous[1]) * normal[1]
+            ) / (dx * normal[0] + dy * normal[1])
+            clipped.append((previous[0] + t * dx, previous[1] + t * dy))
+        if inside(current):
+            clipped.append(current)
+    return clipped
+
+
+def voronoi(prefix, count, rng):
+    """
+    generates the Voronoi cells of random seed points, clipped to the extent
+    :param prefix: the prefix of the polygon IDs
+    :param count: the number of cells
+    :param rng: the numpy RandomState that generates the seed points
+    :return: the Voronoi layer
+    """
+
+    seeds = rng.uniform(size=(count, 2)) * [WIDTH, HEIGHT]
+    extent = [(0, 0), (WIDTH, 0), (WIDTH, HEIGHT), (0, HEIGHT)]
+
+    IDs, shapes = [], []
+    for i, seed in enumerate(seeds):
+        distances = np.hypot(*(seeds - seed).T)
+        polygon = list(extent)
+        # clip the cell by the bisectors of its nearest neighbors, until the next neighbor is too far away to affect it
+        for j in np.argsort(distances)[1:]:
+            radius = max(
+                math.hypot(vertex[0] - seed[0], vertex[1] - seed[1])
+                for vertex in polygon
+            )
+            if distances[j] > 2 * radius:
+                break
+            polygon = clip(polygon, (seeds[j] + seed) / 2, seeds[j] - seed)
+        IDs.append(f"{prefix}{i}")
+        shapes.append(Polygon(polygon))
+
+    return layer(IDs, shapes)
+
+
+def synthetic_layers(args):
+    """
+    :param args: the parsed command line arguments
+    :return: the abstract graph edges, and a dict mapping each granularity to its synthetic layer
+    """
+
+    rng = np.random.RandomState(args.seed)
+    shapefiles = {}
+    shapefiles["region"], shapefiles["subregion"] = nested_grids(
+        args.regions, args.subdivisions
+    )
+    if args.layout == "voronoi":
+        shapefiles["cells"] = voronoi("c", args.cells, rng)
+        shapefiles["zones"] = voronoi("z", args.cells, rng)
+    else:
+        shapefiles["cells"] = offset_grid("c", args.cells, 1 / 3)
+        shapefiles["zones"] = offset_grid("z", args.cells, 2 / 3)
+
+    abstract_edges = [
+        [ROOT, "region"],
+        ["region", "subregion"],
+        [ROOT, "cells"],
+        [ROOT, "zones"],
+    ]
+    return abstract_edges, shapefiles
+
+
+def hash_layer(shapefile):
+    """
+    :param shapefile: a synthetic layer
+    :return: a hex digest of the layer's IDs and geometries, the key of the layer in the intersection cache
+    """
+
+    digest = hashlib.sha256()
+    for ID, shape in zip(shapefile["ID"], shapefile.geometry):
+        digest.update(ID.encode())
+        digest.update(shape.wkb)
+    return digest.hexdigest()
+
+
+def run_mode(mode, config, shapefiles, args, connection):
+    """
+    builds the graphs in one build mode, in a child process so that each mode's memory usage is measured separately
+    :param mode: the build mode: serial, indexed, or parallel
+    :param config: the build parameters, without the build mode
+    :param shapefiles: the synthetic layers
+    :param args: the parsed command line arguments
+    :param connection: the pipe to send the results to
+    """
+
+    config = dict(config, build_mode=mode)
+    timer = PhaseTimer(trace_memory=args.memory, verbose=False)
+    parts_dir = tempfile.mkdtemp(prefix="simon-benchmark-")
+    store = (
+        MeetNodeStore(parts_dir, config["save_shapes"])
+        if config["streaming"]
+        else None
+    )
+
+    cache = (
+        IntersectionCache(
+            os.path.abspath(args.cache),
+            PROJECTION,
+            {
+                granularity: hash_layer(shapefile)
+                for granularity, shapefile in shapefiles.items()
+            },
+        )
+        if args.cache
+        else None
+    )
+
+    builder = GraphBuilder(
+        config, shapefiles, WIDTH * HEIGHT, cache=cache, timer=timer
+    )
+    abstract_graph, instance_graph, abstract_nodes = builder.build(store)
+    if cache:
+        cache.close()
+    if store:
+        store.close()
+    else:
+        os.rmdir(parts_dir)
+
+    connection.send(
+        {
+            "phases": timer.phases,
+            "total": time.perf_counter() - timer.start,
+            "counts": instance_graph.graph["counts"],
+            "areas": instance_graph.graph["areas"],
+            "nodes": instance_graph.graph["nodes"],
+            "links": instance_graph.graph["links"],
+            # the parallel build mode's worker processes
+            "workers_max_rss": resource.getrusage(
+                resource.RUSAGE_CHILDREN
+            ).ru_maxrss,
+        }
+    )
+    connection.close()
+
+
+def report(results):
+    """
+    prints the time and memory usage of each phase, side by side for each build mode
+    :param results: a dict mapping each build mode to its results
+    """
+
+    modes = list(results)
+    phases = [phase[0] for phase in results[modes[0]]["phases"]]
+    width = max(len(phase) for phase in phases + ["total"]) + 2
+
+    print("".ljust(width) + "".join(f"{mode:>24}" for mode in modes))
+    for i, phase in enumerate(phases):
+        row = phase.ljust(width)
+        for mode in modes:
+            name, seconds, peak, max_rss = results[mode]["phases"][i]
+            memory = (
+                f"{peak / 2**20:.1f} MiB"
+                if peak is not None
+                else f"{max_rss / 2**10:.0f} MiB rss"
+            )
+            row += f"{seconds:>9.2f} s {memory:>12}"
+        print(row)
+    print(
+        "total".ljust(width)
+        + "".join(
+            f"{results[mode]['total']:>9.2f} s{'':>13}" for mode in modes
+        )
+    )
+    for mode in modes:
+        if results[mode]["workers_max_rss"]:
+            print(
+                f"{mode}: worker processes max rss {results[mode]['workers_max_rss'] / 2**10:.0f} MiB"
+            )
+
+
+def check(results):
+    """
+    verifies that every build mode produced the same graphs
+    :param results: a dict mapping each build mode to its results
+    :return: whether the graphs are consistent
+    """
+
+    modes = list(results)
+    consistent = True
+    for mode in modes[1:]:
+        for key in ["nodes", "links", "counts"]:
+            if results[mode][key] != results[modes[0]][key]:
+                print(
+                    f"WARNING: {key} of {mode} build differ from {modes[0]} build: {results[mode][key]} != {results[modes[0]][key]}"
+                )
+                consistent = False
+        for granularity, area in results[modes[0]]["areas"].items():
+            if not math.isclose(
+                results[mode]["areas"][granularity], area, rel_tol=1e-9
+            ):
+                print(
+                    f"WARNING: area of {granularity} in {mode} build differs from {modes[0]} build"
+                )
+                consistent = False
+    return consistent
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark the graph build on synthetic granularities"
+    )
+    parser.add_argument(
+        "--regions",
+        type=int,
+        default=20,
+        help="the approximate number of regions in the coarse nested grid",
+    )
+    parser.add_argument(
+        "--subdivisions",
+        type=int,
+        default=4,
+        help="the number of subregions along each side of a region",
+    )
+    parser.add_argument(
+        "--cells",
+        type=int,
+        default=500,
+        help="the approximate number of polygons in each of the two overlapping layers",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=["grid", "voronoi"],
+        default="voronoi",
+        help="the shape of the overlapping layers: offset regular grids, or random Voronoi cells",
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["serial", "indexed", "parallel"],
+        default=["serial", "indexed", "parallel"],
+        help="the build modes to compare",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="the number of worker processes in the parallel build mode (default: the number of CPUs)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=10000,
+        help="the number of pairs of instance nodes to intersect at a time",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="build the meet nodes out of core",
+    )
+    parser.add_argument(
+        "--save-shapes",
+        action="store_true",
+        help="keep the geometries of the meet nodes (and cache them, with --cache)",
+    )
+    parser.add_argument(
+        "--cache",
+        help="the path of an intersection cache to build with. The first build mode fills it, and the other build "
+        "modes (and later runs with the same layers) read from it",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="record the peak memory allocated in each phase with tracemalloc (slows down the build)",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="the random seed of the layers"
+    )
+    parser.add_argument(
+        "--output", help="the path of a JSON file to save the results to"
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    abstract_edges, shapefiles = synthetic_layers(args)
+    print(
+        "generated layers in {:.2f} s: {}".format(
+            time.perf_counter() - start,
+            ", ".join(
+                f"{granularity} ({len(shapefile)})"
+                for granularity, shapefile in shapefiles.items()
+            ),
+        )
+    )
+
+    config = {
+        "projection": PROJECTION,
+        "scale_factor": 1000000,
+        "minimum_intersection_area": 1,
+        "abstract_edges": abstract_edges,
+        "save_shapes": args.save_shapes,
+        "streaming": args.streaming,
+        "chunk_size": args.chunk_size,
+        "workers": args.workers,
+    }
+
+    results = {}
+    failed = []
+    for mode in args.modes:
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=run_mode, args=(mode, config, shapefiles, args, sender)
+        )
+        process.start()
+
+        # close the parent's copy of the sending end, so that recv raises EOFError if the child exits without sending
+        sender.close()
+        try:
+            results[mode] = receiver.recv()
+        except EOFError:
+            process.join()
+            print(f"{mode}: failed with exit code {process.exitcode}")
+            failed.append(mode)
+            continue
+        finally:
+            receiver.close()
+        process.join()
+        print(f"{mode}: {results[mode]['total']:.2f} s")
+
+    if not results:
+        raise SystemExit("every build mode failed")
+
+    print()
+    report(results)
+    consistent = check(results)
+
+    if args.output:
+        with open(args.output, mode="w") as outfile:
+            json.dump(
+                {
+                    "parameters": vars(args),
+                    "layers": {
+                        granularity: len(shapefile)
+                        for granularity, shapefile in shapefiles.items()
+                    },
+                    "consistent": consistent,
+                    "failed": failed,
+                    "results": results,
+                },
+                outfile,
+                indent=4,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,24 +3,25 @@
 # Distributed under the terms of the MIT License.
 
 
-from datetime import datetime
-
-start = datetime.now()
-print(start)
-
-from geopandas import read_file, sjoin
+from geopandas import GeoSeries, read_file, sjoin
 import networkx as nx
 from networkx.readwrite import json_graph
 import geojson
+from shapely import wkb
+
+from cache import IntersectionCache, hash_shapefile
+from streaming import MeetNodeStore, chunks, write_node_link
+from writers import write_parquet
 
 import itertools
 from collections import defaultdict
+import multiprocessing
 import uuid
 import os
 import json
-
-with open(os.path.join(os.path.dirname(__file__), "config.json")) as f:
-    config = json.load(f)
+import resource
+import time
+import tracemalloc
 
 # where to save the graphs
 save_dir = os.path.join(os.path.dirname(__file__), "out")
@@ -28,66 +29,116 @@ save_dir = os.path.join(os.path.dirname(__file__), "out")
 # where the shapefiles are stored
 shapefile_dir = os.path.join(os.path.dirname(__file__), "shapefiles")
 
-# the coordinate reference system the shapefiles are defined on
-projection = config["projection"]
-
-# scale the areas calculated for shapefile geometries from square kilometers to square meters
-scale_factor = config["scale_factor"]
+# where the intersection cache is stored
+cache_path = os.path.join(
+    os.path.dirname(__file__), "cache", "intersections.sqlite"
+)
 
-# the minimum area of a meet node (a node formed by the interestion of two disparate geograophic granularities), in square kilometers
-minimum_intersection_area = config["minimum_intersection_area"]
+# where meet nodes are stored in streaming mode, until the graphs are saved
+parts_dir = os.path.join(os.path.dirname(__file__), "parts")
+
+
+class PhaseTimer:
+    def __init__(self, trace_memory=False, verbose=True):
+        """
+        records the time taken by each phase of the build
+        :param trace_memory: whether to also record the peak memory allocated by Python during each phase. Tracing
+                memory allocations slows down the build, so it is off by default
+        :param verbose: whether to print each phase as it ends
+        """
+
+        self.trace_memory = trace_memory
+        self.verbose = verbose
+        self.start = time.perf_counter()
+        self.last = self.start
+
+        # a list of (phase, seconds, peak traced bytes or None, max resident set size in kilobytes) tuples
+        self.phases = []
+
+        if trace_memory:
+            tracemalloc.start()
+
+    def lap(self, phase):
+        """
+        records the time since the end of the previous phase
+        :param phase: the name of the phase that just ended
+        """
+
+        now = time.perf_counter()
+        peak = None
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            # restart tracing so that the next phase has its own peak
+            tracemalloc.stop()
+            tracemalloc.start()
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.phases.append((phase, now - self.last, peak, max_rss))
+
+        if self.verbose:
+            if peak is None:
+                print(f"{phase}: {now - self.last:.2f} s")
+            else:
+                print(
+                    f"{phase}: {now - self.last:.2f} s, peak {peak / 2**20:.1f} MiB"
+                )
+        self.last = time.perf_counter()
 
-# Define the abstract graph with a list of tuples with the form (source, destination), where source is a higher lower resolution granularity that encompasses destination, a higher resolution granularity.
-abstract_edges = config["abstract_edges"]
+    def total(self):
+        if self.trace_memory:
+            tracemalloc.stop()
+        if self.verbose:
+            print(f"total: {time.perf_counter() - self.start:.2f} s")
 
-# Save the instance graph with its geometries included. This will create a very large graph.
-save_shapes = config["save_shapes"]
 
 # open the shapefiles for each granularity
-states = read_file(f"{shapefile_dir}/state.shp").to_crs(epsg=projection)
-counties = read_file(f"{shapefile_dir}/county.shp").to_crs(epsg=projection)
-nercs = read_file(f"{shapefile_dir}/nerc.shp").to_crs(epsg=projection)
-huc8s = read_file(f"{shapefile_dir}/huc8.shp").to_crs(epsg=projection)
-latlons = read_file(f"{shapefile_dir}/latlon.shp").to_crs(epsg=projection)
-
-# nerc regions
-nercs["country"] = nercs.apply(lambda x: 1, axis=1)
-nercs["area"] = nercs.apply(lambda row: row["geometry"].area, axis=1)
-
-# nerc shapefile has the smallest scope, so it is used to define the scope of the USA
-country = nercs.dissolve(by="country", aggfunc={"area": "sum"})
-country["NAME"] = "usa48"
-
-# counties
-counties["county_polygons"] = counties.geometry.copy()
-counties.geometry = counties.geometry.representative_point()
-counties = sjoin(counties, states, how="inner", op="within")
-counties.geometry = counties["county_polygons"]
-counties.drop("index_right", axis=1, inplace=True)
-counties.rename(columns={"ID_left": "ID"}, inplace=True)
-counties.rename(columns={"NAME_left": "NAME"}, inplace=True)
-counties.rename(columns={"ID_right": "parent_ID"}, inplace=True)
-
-# latitude-longitude grid squares
-latlons["parent_ID"] = "usa48"
-huc8s["parent_ID"] = "usa48"
-nercs["parent_ID"] = "usa48"
-states["parent_ID"] = "usa48"
-
-# each shapefile should have 4 attributes: ID, NAME, parent_ID, geometry
-shapefiles = {}
-shapefiles["state"] = states
-shapefiles["county"] = counties
-shapefiles["nerc"] = nercs
-shapefiles["huc8"] = huc8s
-shapefiles["latlon"] = latlons
-
-for granularity, shapefile in shapefiles.items():
-    for column in ["ID", "NAME", "geometry", "parent_ID"]:
-        if column not in shapefile.columns:
-            print(
-                f"WARNING: required column {column} not in shapefile {granularity}"
-            )
+def load_shapefiles(projection):
+    states = read_file(f"{shapefile_dir}/state.shp").to_crs(epsg=projection)
+    counties = read_file(f"{shapefile_dir}/county.shp").to_crs(epsg=projection)
+    nercs = read_file(f"{shapefile_dir}/nerc.shp").to_crs(epsg=projection)
+    huc8s = read_file(f"{shapefile_dir}/huc8.shp").to_crs(epsg=projection)
+    latlons = read_file(f"{shapefile_dir}/latlon.shp").to_crs(epsg=projection)
+
+    # nerc regions
+    nercs["country"] = 1
+    nercs["area"] = nercs.geometry.area
+
+    # nerc shapefile has the smallest scope, so it is used to define the scope of the USA
+    country = nercs.dissolve(by="country", aggfunc={"area": "sum"})
+    country["NAME"] = "usa48"
+
+    # counties
+    counties["county_polygons"] = counties.geometry.copy()
+    counties.geometry = counties.geometry.representative_point()
+    counties = sjoin(counties, states, how="inner", op="within")
+    counties.geometry = counties["county_polygons"]
+    counties.drop("index_right", axis=1, inplace=True)
+    counties.rename(columns={"ID_left": "ID"}, inplace=True)
+    counties.rename(columns={"NAME_left": "NAME"}, inplace=True)
+    counties.rename(columns={"ID_right": "parent_ID"}, inplace=True)
+
+    # latitude-longitude grid squares
+    latlons["parent_ID"] = "usa48"
+    huc8s["parent_ID"] = "usa48"
+    nercs["parent_ID"] = "usa48"
+    states["parent_ID"] = "usa48"
+
+    # each shapefile should have 4 attributes: ID, NAME, parent_ID, geometry
+    shapefiles = {}
+    shapefiles["state"] = states
+    shapefiles["county"] = counties
+    shapefiles["nerc"] = nercs
+    shapefiles["huc8"] = huc8s
+    shapefiles["latlon"] = latlons
+
+    for granularity, shapefile in shapefiles.items():
+        for column in ["ID", "NAME", "geometry", "parent_ID"]:
+            if column not in shapefile.columns:
+                print(
+                    f"WARNING: required column {column} not in shapefile {granularity}"
+                )
+
+    return shapefiles, float(country.area)
+
 
 # display the graph
 def draw_graph(graph, display=False):
@@ -129,47 +180,84 @@ def add_abstract_wedges(abstract_graph, original_nodes):
             abstract_graph.add_edge(combo[1], new_node)
 
 
-# add wedge nodes to an instance graph
-def add_instance_wedges(graph, combos, instance_graph_types):
+# the builder and instance graph of the parallel build mode, inherited by the worker processes when they are forked
+worker_builder = None
+worker_graph = None
 
-    for combo in combos:
 
+# calculate an intersection in a worker process of the parallel build mode
+def intersect_in_worker(combo):
+    combo, area, shape, failed = worker_builder.try_intersection(
+        worker_graph, combo
+    )
+    if shape is not None:
+        shape = wkb.dumps(shape) if worker_builder.save_shapes else None
+    return combo, area, shape, failed
+
+
+class GraphBuilder:
+    def __init__(self, config, shapefiles, root_area, cache=None, timer=None):
+        """
+        constructs an abstract graph and an instance graph from shapefiles
+        :param config: the build parameters, as defined in config.json
+        :param shapefiles: a dict mapping each granularity to a GeoDataFrame with ID, NAME, parent_ID, and geometry columns
+        :param root_area: the unscaled area of the root granularity's scope
+        :param cache: an optional IntersectionCache
+        :param timer: the PhaseTimer that records each phase of the build. Defaults to a new PhaseTimer
+        """
+
+        self.shapefiles = shapefiles
+        self.root_area = root_area
+        self.cache = cache
+        self.timer = timer or PhaseTimer()
+
+        # the coordinate reference system the shapefiles are defined on
+        self.projection = config["projection"]
+
+        # scale the areas calculated for shapefile geometries from square kilometers to square meters
+        self.scale_factor = config["scale_factor"]
+
+        # the minimum area of a meet node (a node formed by the interestion of two disparate geograophic granularities), in square kilometers
+        self.minimum_intersection_area = config["minimum_intersection_area"]
+
+        # Define the abstract graph with a list of tuples with the form (source, destination), where source is a higher lower resolution granularity that encompasses destination, a higher resolution granularity.
+        self.abstract_edges = config["abstract_edges"]
+
+        # Save the instance graph with its geometries included. This will create a very large graph.
+        self.save_shapes = config["save_shapes"]
+
+        # Write meet nodes to disk as they are computed, instead of keeping them in memory. Needed for fine granularities.
+        self.streaming = config["streaming"]
+
+        # the number of instance node pairs to intersect at a time
+        self.chunk_size = config["chunk_size"]
+
+        # serial: intersect every pair of instance nodes
+        # indexed: only intersect pairs of instance nodes whose bounding boxes intersect, using a spatial index
+        # parallel: like indexed, but intersect pairs of instance nodes in a pool of worker processes
+        self.build_mode = config["build_mode"]
+        self.workers = config["workers"] or os.cpu_count()
+        self.pool = None
+
+    # calculate the intersection of a pair of instance nodes
+    def compute_intersection(self, graph, combo):
         check_intersection = graph.nodes[combo[0]]["shape"].intersects(
             graph.nodes[combo[1]]["shape"]
         ) and not graph.nodes[combo[0]]["shape"].touches(
             graph.nodes[combo[1]]["shape"]
         )
         if not check_intersection:
-            continue
-
-        try:
+            return None, None
 
-            shape = graph.nodes[combo[1]]["shape"].intersection(
-                graph.nodes[combo[0]]["shape"]
-            )
-            area = shape.area / scale_factor
-
-            new_node = meet(combo[0], combo[1])
-            if area >= minimum_intersection_area:
-                graph.add_edge(combo[0], new_node)
-                graph.add_edge(combo[1], new_node)
-                instance_graph_types[
-                    meet(
-                        graph.nodes[combo[0]]["type"],
-                        graph.nodes[combo[1]]["type"],
-                    )
-                ].append(new_node)
-                graph.nodes[new_node]["shape"] = shape
-                graph.nodes[new_node]["area"] = area
-                graph.nodes[new_node]["type"] = meet(
-                    graph.nodes[combo[0]]["type"],
-                    graph.nodes[combo[1]]["type"],
-                )
-
-            else:
-                pass
-                # print(f"{new_node} is too small to be added. area = {area}")
+        shape = graph.nodes[combo[1]]["shape"].intersection(
+            graph.nodes[combo[0]]["shape"]
+        )
+        return shape.area, shape
 
+    # calculate the intersection of a pair of instance nodes, returning its unscaled area and shape, and whether it failed
+    def try_intersection(self, graph, combo):
+        try:
+            area, shape = self.compute_intersection(graph, combo)
         except Exception as e:
             print(
                 "ERROR: could not calculate intersection of {} with {}: {}".format(
@@ -178,230 +266,528 @@ def add_instance_wedges(graph, combos, instance_graph_types):
             )
             if not graph.nodes[combo[0]]["shape"].is_valid:
                 print(
-                    f"WARNING: {combo[0]} has invalid geometry, area = {graph.nodes[combo[0]]['shape'].area/scale_factor}"
+                    f"WARNING: {combo[0]} has invalid geometry, area = {graph.nodes[combo[0]]['shape'].area/self.scale_factor}"
                 )
                 # graph.remove_node(combo[0])
                 # print(f"removed {combo[0]} from graph")
             if not graph.nodes[combo[1]]["shape"].is_valid:
                 print(
-                    f"WARNING: {combo[1]} has invalid geometry, area = {graph.nodes[combo[1]]['shape'].area/scale_factor}"
+                    f"WARNING: {combo[1]} has invalid geometry, area = {graph.nodes[combo[1]]['shape'].area/self.scale_factor}"
                 )
                 # graph.remove_node(combo[1])
                 # print(f"removed {combo[1]} from graph")
-
-    return instance_graph_types
-
-
-# construct an instance graph
-def build_instance_graph(root):
-    instance_graph_types = defaultdict(list)
-    instance_graph = build_graph([])
-    instance_graph.add_node(root, name=root, type=root, shape=None, area=None)
-
-    abstract_nodes_bfs = [root] + [
-        v for u, v in nx.bfs_edges(abstract_graph, root)
-    ]
-    for node in abstract_nodes_bfs:
-        for child in abstract_graph.successors(node):
-            shapefile = shapefiles[child]
-            for index, row in shapefile.iterrows():
-                ID = str(row["ID"])
-                shape = row["geometry"]
-                area = row["geometry"].area / scale_factor
-                name = row["NAME"]
-                if not shape.is_valid:
-                    print(
-                        f"WARNING: instance node {name} has invalid geometry. area = {area}"
-                    )
-                if area < minimum_intersection_area:
-                    print(
-                        f"WARNING: instance node {name} is smaller than minimum intersection area. area = {area}"
+            return combo, None, None, True
+        return combo, area, shape, False
+
+    # calculate the intersections of a chunk of instance node pairs, returning the combo, area, and shape of each
+    # intersection that isn't empty, in the same order as the chunk
+    def intersect_chunk(self, graph, chunk, pair_cache=None):
+
+        intersections = {}
+        misses = []
+        if pair_cache:
+            pair_cache.load(chunk)
+        for combo in chunk:
+            cached = (
+                pair_cache.get(combo[0], combo[1], need_shape=self.save_shapes)
+                if pair_cache
+                else None
+            )
+            if cached:
+                area, shape = cached
+                if area is not None:
+                    intersections[combo] = (
+                        area / self.scale_factor,
+                        wkb.loads(shape) if shape else None,
                     )
-                instance_graph.add_node(
-                    ID, name=name, type=child, shape=shape, area=area
-                )
-                instance_graph_types[child].append(ID)
-                instance_graph.add_edge(str(row["parent_ID"]), ID)
+            else:
+                misses.append(combo)
 
-    instance_graph.add_node(
-        root,
-        name=root,
-        type=root,
-        shape=None,
-        area=float(country.area) / scale_factor,
-    )
-    return instance_graph, instance_graph_types
+        if self.pool:
+            computed = self.pool.imap(
+                intersect_in_worker,
+                misses,
+                chunksize=max(1, len(misses) // (4 * self.workers)),
+            )
+        else:
+            computed = (
+                self.try_intersection(graph, combo) for combo in misses
+            )
 
+        for combo, area, shape, failed in computed:
+            if failed:
+                if pair_cache:
+                    pair_cache.errors += 1
+                continue
+            if isinstance(shape, bytes):
+                shape = wkb.loads(shape)
+
+            # cache the unscaled area, so that the cache doesn't depend on the scale factor or the minimum area
+            if pair_cache:
+                pair_cache.put(
+                    combo[0],
+                    combo[1],
+                    area,
+                    wkb.dumps(shape)
+                    if self.save_shapes and shape is not None
+                    else None,
+                )
+            if area is not None:
+                intersections[combo] = (area / self.scale_factor, shape)
 
-# build the abstract graph
-abstract_graph = build_graph(abstract_edges, is_abstract=True)
-root = list(nx.topological_sort(abstract_graph))[0]
-abstract_nodes = [root] + [v for u, v in nx.bfs_edges(abstract_graph, root)]
+        return [
+            (combo,) + intersections[combo]
+            for combo in chunk
+            if combo in intersections
+        ]
 
-# build the instance graph
-instance_graph, instance_graph_types = build_instance_graph(root)
+    # add wedge nodes to an instance graph
+    def add_instance_wedges(
+        self, graph, combos, instance_graph_types, pair_cache=None
+    ):
+
+        for chunk in chunks(combos, self.chunk_size):
+            for combo, area, shape in self.intersect_chunk(
+                graph, chunk, pair_cache
+            ):
+
+                new_node = meet(combo[0], combo[1])
+                if area >= self.minimum_intersection_area:
+                    graph.add_edge(combo[0], new_node)
+                    graph.add_edge(combo[1], new_node)
+                    instance_graph_types[
+                        meet(
+                            graph.nodes[combo[0]]["type"],
+                            graph.nodes[combo[1]]["type"],
+                        )
+                    ].append(new_node)
+                    graph.nodes[new_node]["shape"] = shape
+                    graph.nodes[new_node]["area"] = area
+                    graph.nodes[new_node]["type"] = meet(
+                        graph.nodes[combo[0]]["type"],
+                        graph.nodes[combo[1]]["type"],
+                    )
 
-# add wedges to the abstract graph
-add_abstract_wedges(abstract_graph, abstract_nodes)
+                else:
+                    pass
+                    # print(f"{new_node} is too small to be added. area = {area}")
 
-# iterate through the abstract graph wedges, in BFS order
-abstract_graph_wedges = [
-    v for u, v in nx.bfs_edges(abstract_graph, root) if v not in abstract_nodes
-]
-for wedge in abstract_graph_wedges:
-    l, r = wedge.split("^")
+        return instance_graph_types
 
-    parents = [
-        parent
-        for parent in abstract_graph.predecessors(wedge)
-        if parent in abstract_graph_wedges
-    ]
+    # add wedge nodes to a store on disk, one chunk of instance node pairs at a time, leaving the instance graph unchanged
+    def stream_instance_wedges(
+        self, graph, combos, wedge, store, pair_cache=None
+    ):
 
-    if parents:
-        parent = sorted(
-            parents, key=lambda node: len(instance_graph_types[node])
-        )[0]
+        for chunk in chunks(combos, self.chunk_size):
+            records = [
+                (meet(combo[0], combo[1]), combo[0], combo[1], area, shape)
+                for combo, area, shape in self.intersect_chunk(
+                    graph, chunk, pair_cache
+                )
+                if area >= self.minimum_intersection_area
+            ]
+            store.write(wedge, records)
+            if pair_cache:
+                pair_cache.save()
 
-        ll, rr = parent.split("^")
-        combos = []
+    # find the pairs of instance nodes that may form a wedge, from the instance nodes of one of the wedge's parent wedges
+    def wedge_combos(self, graph, wedge, parent_instances):
+        l, r = wedge.split("^")
 
-        for instance in instance_graph_types[parent]:
+        for instance in parent_instances:
             instance_l, instance_r = instance.split("^")
 
-            if l == instance_graph.nodes[instance_l].get("type"):
-                for element in instance_graph.successors(instance_r):
-                    if instance_graph.nodes[element].get("type") == r:
-                        combos.append((instance_l, element))
+            if l == graph.nodes[instance_l].get("type"):
+                for element in graph.successors(instance_r):
+                    if graph.nodes[element].get("type") == r:
+                        yield (instance_l, element)
 
-            elif r == instance_graph.nodes[instance_r].get("type"):
-                for element in instance_graph.successors(instance_l):
-                    if instance_graph.nodes[element].get("type") == l:
-                        combos.append((element, instance_r))
+            elif r == graph.nodes[instance_r].get("type"):
+                for element in graph.successors(instance_l):
+                    if graph.nodes[element].get("type") == l:
+                        yield (element, instance_r)
 
-            elif l == instance_graph.nodes[instance_r].get("type"):
-                for element in instance_graph.successors(instance_l):
-                    if instance_graph.nodes[element].get("type") == r:
-                        combos.append((element, instance_r))
+            elif l == graph.nodes[instance_r].get("type"):
+                for element in graph.successors(instance_l):
+                    if graph.nodes[element].get("type") == r:
+                        yield (element, instance_r)
 
-            elif r == instance_graph.nodes[instance_l].get("type"):
-                for element in instance_graph.successors(instance_r):
-                    if instance_graph.nodes[element].get("type") == l:
-                        combos.append((instance_l, element))
+            elif r == graph.nodes[instance_l].get("type"):
+                for element in graph.successors(instance_r):
+                    if graph.nodes[element].get("type") == l:
+                        yield (instance_l, element)
 
             else:
                 print(f"ERROR: no match for instance {instance}")
 
-    else:
-        combos = list(
-            itertools.product(
-                *[instance_graph_types[l], instance_graph_types[r]]
+    # find the pairs of instance nodes whose bounding boxes intersect, using a spatial index of the right instances
+    def indexed_combos(self, graph, left_instances, right_instances):
+        sindex = GeoSeries(
+            [graph.nodes[instance]["shape"] for instance in right_instances]
+        ).sindex
+        for instance in left_instances:
+            for position in sorted(
+                sindex.intersection(graph.nodes[instance]["shape"].bounds)
+            ):
+                yield (instance, right_instances[position])
+
+    # construct an instance graph
+    def build_instance_graph(self, abstract_graph, root):
+        instance_graph_types = defaultdict(list)
+        instance_graph = build_graph([])
+        instance_graph.add_node(
+            root, name=root, type=root, shape=None, area=None
+        )
+
+        abstract_nodes_bfs = [root] + [
+            v for u, v in nx.bfs_edges(abstract_graph, root)
+        ]
+        for node in abstract_nodes_bfs:
+            for child in abstract_graph.successors(node):
+                shapefile = self.shapefiles[child]
+                IDs = shapefile["ID"].astype(str).tolist()
+                parent_IDs = shapefile["parent_ID"].astype(str).tolist()
+                names = shapefile["NAME"].tolist()
+                shapes = shapefile.geometry.tolist()
+                areas = (shapefile.geometry.area / self.scale_factor).tolist()
+                valid = shapefile.geometry.is_valid.tolist()
+
+                for name, area, is_valid in zip(names, areas, valid):
+                    if not is_valid:
+                        print(
+                            f"WARNING: instance node {name} has invalid geometry. area = {area}"
+                        )
+                    if area < self.minimum_intersection_area:
+                        print(
+                            f"WARNING: instance node {name} is smaller than minimum intersection area. area = {area}"
+                        )
+                instance_graph.add_nodes_from(
+                    (
+                        ID,
+                        {
+                            "name": name,
+                            "type": child,
+                            "shape": shape,
+                            "area": area,
+                        },
+                    )
+                    for ID, name, shape, area in zip(IDs, names, shapes, areas)
+                )
+                instance_graph_types[child].extend(IDs)
+                instance_graph.add_edges_from(zip(parent_IDs, IDs))
+
+        instance_graph.add_node(
+            root,
+            name=root,
+            type=root,
+            shape=None,
+            area=self.root_area / self.scale_factor,
+        )
+        return instance_graph, instance_graph_types
+
+    # build the wedge nodes of the instance graph, in BFS order of the abstract graph wedges
+    def build_instance_wedges(
+        self,
+        abstract_graph,
+        abstract_nodes,
+        root,
+        instance_graph,
+        instance_graph_types,
+        store=None,
+    ):
+        global worker_builder, worker_graph
+
+        if self.build_mode == "parallel":
+            # fork the workers after the instance graph is built, so that they inherit its shapes
+            worker_builder = self
+            worker_graph = instance_graph
+            self.pool = multiprocessing.get_context("fork").Pool(self.workers)
+
+        # iterate through the abstract graph wedges, in BFS order
+        abstract_graph_wedges = [
+            v
+            for u, v in nx.bfs_edges(abstract_graph, root)
+            if v not in abstract_nodes
+        ]
+        for wedge in abstract_graph_wedges:
+            l, r = wedge.split("^")
+
+            parents = [
+                parent
+                for parent in abstract_graph.predecessors(wedge)
+                if parent in abstract_graph_wedges
+            ]
+
+            if parents:
+                if self.streaming:
+                    parent = sorted(
+                        parents, key=lambda node: store.counts[node]
+                    )[0]
+                    combos = self.wedge_combos(
+                        instance_graph, wedge, store.instances(parent)
+                    )
+                else:
+                    parent = sorted(
+                        parents,
+                        key=lambda node: len(instance_graph_types[node]),
+                    )[0]
+                    combos = list(
+                        self.wedge_combos(
+                            instance_graph,
+                            wedge,
+                            instance_graph_types[parent],
+                        )
+                    )
+
+            elif self.build_mode in ["indexed", "parallel"]:
+                combos = self.indexed_combos(
+                    instance_graph,
+                    instance_graph_types[l],
+                    instance_graph_types[r],
+                )
+
+            else:
+                combos = itertools.product(
+                    *[instance_graph_types[l], instance_graph_types[r]]
+                )
+
+            # a wedge without wedge parents is built from every pair of its granularities' instances
+            # (or every pair whose bounding boxes intersect), so instance pairs missing from its cache are known not to intersect
+            pair_cache = (
+                self.cache.pair(l, r, record_empty=bool(parents))
+                if self.cache
+                else None
             )
+            if self.streaming:
+                self.stream_instance_wedges(
+                    instance_graph, combos, wedge, store, pair_cache
+                )
+            else:
+                instance_graph_types = self.add_instance_wedges(
+                    instance_graph, combos, instance_graph_types, pair_cache
+                )
+            if pair_cache:
+                pair_cache.save(complete=not parents)
+            self.timer.lap(f"adding instance wedges {wedge}")
+
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        return instance_graph_types
+
+    def build(self, store=None):
+        """
+        builds the abstract graph and the instance graph
+        :param store: the MeetNodeStore to write meet nodes to in streaming mode
+        :return: the abstract graph, the instance graph, and the non-wedge granularities in BFS order.
+                In streaming mode, the instance graph doesn't include the meet nodes, which are in the store.
+        """
+
+        # build the abstract graph
+        abstract_graph = build_graph(self.abstract_edges, is_abstract=True)
+        root = list(nx.topological_sort(abstract_graph))[0]
+        abstract_nodes = [root] + [
+            v for u, v in nx.bfs_edges(abstract_graph, root)
+        ]
+
+        # build the instance graph
+        instance_graph, instance_graph_types = self.build_instance_graph(
+            abstract_graph, root
+        )
+        self.timer.lap("building instance graph")
+
+        # add wedges to the abstract graph
+        add_abstract_wedges(abstract_graph, abstract_nodes)
+        self.timer.lap("adding abstract wedges")
+
+        self.build_instance_wedges(
+            abstract_graph,
+            abstract_nodes,
+            root,
+            instance_graph,
+            instance_graph_types,
+            store,
         )
 
-    instance_graph_types = add_instance_wedges(
-        instance_graph, combos, instance_graph_types
+        if self.cache:
+            self.cache.report()
+
+        # remove nodes without neighbors
+        no_neighbors = set(
+            [
+                node[0]
+                for node in instance_graph.nodes(data=True)
+                if node[1]["type"] in abstract_nodes
+                and not list(instance_graph.neighbors(node[0]))
+                and not (self.streaming and node[0] in store.linked)
+            ]
+        )
+        if no_neighbors:
+            print(f"removing non-wedge nodes without children: {no_neighbors}")
+        for node in no_neighbors:
+            print(f"removing {node}")
+            instance_graph.remove_node(node)
+
+        # add metadata to the graphs
+        meets = [
+            "^".join(sorted(combo))
+            for combo in list(itertools.combinations(abstract_nodes, 2))
+        ]
+        granularities = abstract_nodes + meets
+        counts = {granularity: 0 for granularity in granularities}
+        areas = {granularity: 0 for granularity in granularities}
+        for node, data in instance_graph.nodes(data=True):
+            if data["type"] in counts:
+                counts[data["type"]] += 1
+                areas[data["type"]] += data["area"]
+        if self.streaming:
+            for granularity in granularities:
+                counts[granularity] += store.counts[granularity]
+                areas[granularity] += store.areas[granularity]
+        metadata = {
+            "id": str(uuid.uuid4()),
+            "projection": self.projection,
+            "granularities": abstract_nodes,
+            "minimum_intersect_area": self.minimum_intersection_area,
+            "nodes": len(instance_graph.nodes()),
+            "links": len(instance_graph.edges()),
+            "counts": counts,
+            "areas": areas,
+        }
+        if self.streaming:
+            # each meet node has two links, one from each of its parents
+            metadata["nodes"] += sum(store.counts.values())
+            metadata["links"] += 2 * sum(store.counts.values())
+        abstract_graph.graph = metadata
+        instance_graph.graph = metadata
+        self.timer.lap("adding metadata")
+
+        return abstract_graph, instance_graph, abstract_nodes
+
+
+def main():
+
+    timer = PhaseTimer()
+
+    with open(os.path.join(os.path.dirname(__file__), "config.json")) as f:
+        config = json.load(f)
+
+    projection = config["projection"]
+    minimum_intersection_area = config["minimum_intersection_area"]
+
+    # Save the instance graph with its geometries included. This will create a very large graph.
+    save_shapes = config["save_shapes"]
+
+    # Also save the instance graph as Parquet tables of its nodes and links, and its geometries as GeoParquet if save_shapes is set.
+    save_parquet = config["save_parquet"]
+
+    shapefiles, root_area = load_shapefiles(projection)
+    timer.lap("loading shapefiles")
+
+    # open the intersection cache, to reuse the intersections computed by previous builds for granularity pairs whose shapefiles haven't changed
+    if config["use_cache"]:
+        cache = IntersectionCache(
+            cache_path,
+            projection,
+            {
+                granularity: hash_shapefile(shapefile_dir, granularity)
+                for granularity in shapefiles
+            },
+        )
+    else:
+        cache = None
+    timer.lap("opening intersection cache")
+
+    # store meet nodes on disk in streaming mode
+    store = (
+        MeetNodeStore(parts_dir, save_shapes) if config["streaming"] else None
     )
 
-# remove nodes without neighbors
-no_neighbors = set(
-    [
-        node[0]
-        for node in instance_graph.nodes(data=True)
-        if node[1]["type"] in abstract_nodes
-        and not list(instance_graph.neighbors(node[0]))
-    ]
-)
-if no_neighbors:
-    print(f"removing non-wedge nodes without children: {no_neighbors}")
-for node in no_neighbors:
-    print(f"removing {node}")
-    instance_graph.remove_node(node)
-
-# add metadata to the graphs
-meets = [
-    "^".join(sorted(combo))
-    for combo in list(itertools.combinations(abstract_nodes, 2))
-]
-granularities = abstract_nodes + meets
-counts = {
-    granularity: len(
-        [
-            node[1]["area"]
-            for node in instance_graph.nodes(data=True)
-            if node[1]["type"] == granularity
-        ]
+    builder = GraphBuilder(config, shapefiles, root_area, cache, timer)
+    abstract_graph, instance_graph, abstract_nodes = builder.build(store)
+    if cache:
+        cache.close()
+    print(instance_graph.graph)
+
+    # the paths of the graph files
+    abstract_graph_path = "{}/abstract-graph_{}_{}_{}_{}.geojson".format(
+        save_dir,
+        "-".join(abstract_nodes),
+        projection,
+        minimum_intersection_area,
+        config["tag"],
     )
-    for granularity in granularities
-}
-areas = {
-    granularity: sum(
-        [
-            node[1]["area"]
-            for node in instance_graph.nodes(data=True)
-            if node[1]["type"] == granularity
-        ]
+    instance_graph_path = "{}/instance-graph_{}_{}_{}_{}.geojson".format(
+        save_dir,
+        "-".join(abstract_nodes),
+        projection,
+        minimum_intersection_area,
+        config["tag"],
     )
-    for granularity in granularities
-}
-metadata = {
-    "id": str(uuid.uuid4()),
-    "projection": projection,
-    "granularities": abstract_nodes,
-    "minimum_intersect_area": minimum_intersection_area,
-    "nodes": len(instance_graph.nodes()),
-    "links": len(instance_graph.edges()),
-    "counts": counts,
-    "areas": areas,
-}
-abstract_graph.graph = metadata
-instance_graph.graph = metadata
-print(metadata)
-
-# save the instance graph with its geometries (very large)
-if save_shapes:
-    with open(
-        "{}/instance-graph_{}_{}_{}_{}_shapes.geojson".format(
-            save_dir,
-            "-".join(abstract_nodes),
-            projection,
-            minimum_intersection_area,
-            config["tag"],
-        ),
-        mode="w",
-    ) as outfile:
-        geojson.dump(json_graph.node_link_data(instance_graph), outfile)
-
-# remove geometries from the instance graph (much smaller)
-instance_graph_noshapes = json_graph.node_link_data(instance_graph)
-for node in instance_graph_noshapes["nodes"]:
-    if "shape" in node:
-        del node["shape"]
-
-# save graphs to JSON files
-with open(
-    "{}/abstract-graph_{}_{}_{}_{}.geojson".format(
+    instance_graph_shapes_path = "{}/instance-graph_{}_{}_{}_{}_shapes.geojson".format(
         save_dir,
         "-".join(abstract_nodes),
         projection,
         minimum_intersection_area,
         config["tag"],
-    ),
-    mode="w",
-) as outfile:
-    geojson.dump(json_graph.node_link_data(abstract_graph), outfile)
-with open(
-    "{}/instance-graph_{}_{}_{}_{}.geojson".format(
+    )
+    instance_graph_parquet_prefix = "{}/instance-graph_{}_{}_{}_{}".format(
         save_dir,
         "-".join(abstract_nodes),
         projection,
         minimum_intersection_area,
         config["tag"],
-    ),
-    mode="w",
-) as outfile:
-    geojson.dump(instance_graph_noshapes, outfile)
-
-print("done building graphs")
-end = datetime.now()
-print(end)
-print(end - start)
+    )
+
+    # save the abstract graph to a JSON file
+    with open(abstract_graph_path, mode="w") as outfile:
+        geojson.dump(json_graph.node_link_data(abstract_graph), outfile)
+
+    # save the instance graph to Parquet files, streaming the meet nodes from disk in streaming mode
+    if save_parquet:
+        write_parquet(
+            instance_graph_parquet_prefix,
+            instance_graph,
+            store,
+            shapes=save_shapes,
+            chunk_size=config["chunk_size"],
+        )
+
+    if store:
+        # assemble the instance graph files from the in-memory graph and the meet nodes on disk
+        if save_shapes:
+            write_node_link(
+                instance_graph_shapes_path, instance_graph, store, shapes=True,
+            )
+        write_node_link(instance_graph_path, instance_graph, store)
+        store.close()
+
+    else:
+        # save the instance graph with its geometries (very large)
+        if save_shapes:
+            with open(instance_graph_shapes_path, mode="w") as outfile:
+                geojson.dump(
+                    json_graph.node_link_data(instance_graph), outfile
+                )
+
+        # remove geometries from the instance graph (much smaller)
+        instance_graph_noshapes = json_graph.node_link_data(instance_graph)
+        for node in instance_graph_noshapes["nodes"]:
+            if "shape" in node:
+                del node["shape"]
+
+        # save the instance graph to a JSON file
+        with open(instance_graph_path, mode="w") as outfile:
+            geojson.dump(instance_graph_noshapes, outfile)
+
+    timer.lap("saving graphs")
+
+    print("done building graphs")
+    timer.total()
+
+
+if __name__ == "__main__":
+    main()
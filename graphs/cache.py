@@ -0,0 +1,210 @@
+# Copyright 2020 The Johns Hopkins University Applied Physics Laboratory LLC
+# All rights reserved.
+# Distributed under the terms of the MIT License.
+
+
+from collections import OrderedDict
+import hashlib
+import os
+import sqlite3
+
+
+def hash_shapefile(shapefile_dir, granularity):
+    """
+    hashes the contents of a granularity's shapefile, including its sidecar files
+    :param shapefile_dir: the directory where the shapefiles are stored
+    :param granularity: the name of the shapefile, without an extension
+    :return: a hex digest that changes whenever the shapefile's geometries or attributes change
+    """
+
+    digest = hashlib.sha256()
+    for extension in ["shp", "shx", "dbf", "prj"]:
+        path = os.path.join(shapefile_dir, f"{granularity}.{extension}")
+        if not os.path.exists(path):
+            continue
+        digest.update(extension.encode())
+        with open(path, mode="rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class PairCache:
+    def __init__(self, connection, key, wedge, record_empty=True):
+        """
+        the cached intersections of the instances of two granularities. Only the entries of the chunk of instance
+        pairs being built are kept in memory, so the cache doesn't grow with the number of meet nodes
+        :param connection: the sqlite connection of the intersection cache
+        :param key: the cache key of the granularity pair
+        :param wedge: the name of the wedge node formed by the granularity pair
+        :param record_empty: whether to cache instance pairs that don't intersect. Not needed when every instance pair
+                is computed, because the pair is then marked as complete
+        """
+
+        self.connection = connection
+        self.key = key
+        self.wedge = wedge
+        self.record_empty = record_empty
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.pending = []
+
+        row = connection.execute(
+            "SELECT complete FROM pairs WHERE pair = ?", (key,)
+        ).fetchone()
+        self.complete = bool(row and row[0])
+
+        # maps each (left, right) instance pair of the current chunk to its (area, wkb) tuple. area is None if the
+        # instances don't intersect
+        self.entries = {}
+
+    def load(self, combos):
+        """
+        loads the cached entries of a chunk of instance pairs, replacing the entries of the previous chunk
+        :param combos: the instance pairs of the chunk
+        """
+
+        with self.connection:
+            self.connection.execute("DELETE FROM lookup")
+            self.connection.executemany(
+                "INSERT INTO lookup VALUES (?, ?)",
+                (tuple(sorted(combo)) for combo in combos),
+            )
+        self.entries = {
+            (left, right): (area, shape)
+            for left, right, area, shape in self.connection.execute(
+                "SELECT lookup.left, lookup.right, area, shape FROM lookup JOIN intersections "
+                "ON intersections.pair = ? AND intersections.left = lookup.left "
+                "AND intersections.right = lookup.right",
+                (self.key,),
+            )
+        }
+
+    def get(self, a, b, need_shape=False):
+        """
+        looks up the intersection of two instances, from the chunk that was last loaded
+        :param a: an instance node
+        :param b: an instance node of the other granularity
+        :param need_shape: whether a cached entry without a geometry counts as a miss
+        :return: a tuple of (area, wkb) on a hit, where area is None if the instances don't intersect,
+                or None on a miss
+        """
+
+        entry = self.entries.get(tuple(sorted((a, b))))
+        if entry is None and self.complete:
+            entry = (None, None)
+        if entry is None or (
+            need_shape and entry[0] is not None and entry[1] is None
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, a, b, area, shape=None):
+        """
+        stages an intersection to be written to the cache
+        :param a: an instance node
+        :param b: an instance node of the other granularity
+        :param area: the unscaled area of the intersection, or None if the instances don't intersect
+        :param shape: the WKB of the intersection, if geometries are cached
+        """
+
+        if area is None and not self.record_empty:
+            return
+        key = tuple(sorted((a, b)))
+        self.pending.append((self.key, key[0], key[1], area, shape))
+
+    def save(self, complete=False):
+        """
+        writes the staged intersections to the cache
+        :param complete: whether every instance pair of the two granularities has been computed,
+                so that intersections missing from the cache are known to be empty
+        """
+
+        # an intersection that failed to compute is missing from the cache, but isn't known to be empty
+        complete = complete and not self.errors
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO intersections VALUES (?, ?, ?, ?, ?)",
+                self.pending,
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pairs VALUES (?, ?)",
+                (self.key, int(complete or self.complete)),
+            )
+        self.pending = []
+        self.entries = {}
+        self.complete = complete or self.complete
+
+
+class IntersectionCache:
+    def __init__(self, path, projection, hashes):
+        """
+        on-disk cache of the intersections computed for each pair of granularities
+        :param path: path to the sqlite database file
+        :param projection: the EPSG code that the shapefiles are projected to
+        :param hashes: a dict mapping each granularity to the hash of its shapefile
+        """
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.projection = projection
+        self.hashes = hashes
+        self.pairs = OrderedDict()
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS pairs (pair TEXT PRIMARY KEY, complete INTEGER)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS intersections "
+                "(pair TEXT, left TEXT, right TEXT, area REAL, shape BLOB, PRIMARY KEY (pair, left, right))"
+            )
+            # the instance pairs of the chunk being looked up
+            self.connection.execute(
+                "CREATE TEMP TABLE lookup (left TEXT, right TEXT)"
+            )
+
+    def pair(self, left, right, record_empty=True):
+        """
+        loads the cached intersections of two granularities
+        :param left: a granularity
+        :param right: another granularity, from a different branch of the abstract graph
+        :param record_empty: whether to cache instance pairs that don't intersect
+        :return: the PairCache of the two granularities
+        """
+
+        left, right = sorted((left, right))
+        key = "{}:{}^{}:{}@{}".format(
+            left,
+            self.hashes[left],
+            right,
+            self.hashes[right],
+            self.projection,
+        )
+        pair_cache = PairCache(
+            self.connection, key, f"{left}^{right}", record_empty
+        )
+        self.pairs[pair_cache.wedge] = pair_cache
+        return pair_cache
+
+    def report(self):
+        """
+        prints the number of cache hits and misses for each granularity pair
+        """
+
+        for wedge, pair_cache in self.pairs.items():
+            print(
+                f"intersection cache: {wedge}: {pair_cache.hits} hits, {pair_cache.misses} misses"
+            )
+        print(
+            "intersection cache: total: {} hits, {} misses".format(
+                sum(pair_cache.hits for pair_cache in self.pairs.values()),
+                sum(pair_cache.misses for pair_cache in self.pairs.values()),
+            )
+        )
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,197 @@
+# Copyright 2020 The Johns Hopkins University Applied Physics Laboratory LLC
+# All rights reserved.
+# Distributed under the terms of the MIT License.
+
+
+from collections import defaultdict
+import itertools
+import json
+import os
+import shutil
+import struct
+
+import geojson
+from shapely import wkb
+
+
+def chunks(iterable, size):
+    """
+    splits an iterable into lists, without materializing the iterable
+    :param iterable: the iterable to split
+    :param size: the maximum length of each list
+    :return: yields lists of up to size items
+    """
+
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+class MeetNodeStore:
+    def __init__(self, directory, save_shapes=False):
+        """
+        on-disk store of the meet nodes (wedge instance nodes) of an instance graph, written one chunk at a time.
+        Each wedge granularity has a file of JSON records, one per line, and optionally a file of WKB geometries
+        :param directory: the directory to write the wedge files to. Its previous contents are removed
+        :param save_shapes: whether to store the geometries of the meet nodes
+        """
+
+        self.directory = directory
+        self.save_shapes = save_shapes
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+        # the wedges in the order they were written
+        self.wedges = []
+
+        # the number of meet nodes and their total area, by wedge
+        self.counts = defaultdict(int)
+        self.areas = defaultdict(float)
+
+        # the non-wedge instance nodes that have a meet node as a child
+        self.linked = set()
+
+    def path(self, wedge, extension):
+        return os.path.join(self.directory, f"{wedge}.{extension}")
+
+    def write(self, wedge, records):
+        """
+        appends meet nodes to a wedge's files
+        :param wedge: the wedge granularity of the meet nodes
+        :param records: a list of (ID, left parent, right parent, area, shape) tuples
+        """
+
+        if wedge not in self.wedges:
+            self.wedges.append(wedge)
+            open(self.path(wedge, "jsonl"), mode="w").close()
+            if self.save_shapes:
+                open(self.path(wedge, "wkb"), mode="wb").close()
+
+        with open(self.path(wedge, "jsonl"), mode="a") as outfile:
+            for ID, left, right, area, shape in records:
+                outfile.write(
+                    json.dumps(
+                        {
+                            "id": ID,
+                            "type": wedge,
+                            "area": area,
+                            "parents": [left, right],
+                        }
+                    )
+                )
+                outfile.write("\n")
+                self.counts[wedge] += 1
+                self.areas[wedge] += area
+                self.linked.update((left, right))
+
+        if self.save_shapes:
+            with open(self.path(wedge, "wkb"), mode="ab") as outfile:
+                for record in records:
+                    shape = wkb.dumps(record[4])
+                    outfile.write(struct.pack("<I", len(shape)))
+                    outfile.write(shape)
+
+    def records(self, wedge):
+        """
+        reads a wedge's meet nodes back from disk, one at a time
+        :param wedge: the wedge granularity
+        :return: yields a dict for each meet node, with keys id, type, area, and parents
+        """
+
+        if wedge not in self.wedges:
+            return
+        with open(self.path(wedge, "jsonl")) as infile:
+            for line in infile:
+                yield json.loads(line)
+
+    def shapes(self, wedge):
+        """
+        reads a wedge's meet node geometries back from disk, one at a time, in the same order as its records
+        :param wedge: the wedge granularity
+        :return: yields a shapely geometry for each meet node
+        """
+
+        if wedge not in self.wedges:
+            return
+        with open(self.path(wedge, "wkb"), mode="rb") as infile:
+            header = infile.read(4)
+            while header:
+                (length,) = struct.unpack("<I", header)
+                yield wkb.loads(infile.read(length))
+                header = infile.read(4)
+
+    def instances(self, wedge):
+        """
+        :param wedge: the wedge granularity
+        :return: yields the ID of each of the wedge's meet nodes
+        """
+
+        for record in self.records(wedge):
+            yield record["id"]
+
+    def close(self):
+        """
+        removes the wedge files
+        """
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def write_node_link(path, graph, store, shapes=False):
+    """
+    writes an instance graph in the same JSON format as json_graph.node_link_data, one node and one link at a time,
+    combining the non-wedge nodes of an in-memory graph with the meet nodes of an on-disk store
+    :param path: the path of the JSON file to write
+    :param graph: the instance graph without its meet nodes, with its metadata in graph.graph
+    :param store: the MeetNodeStore with the graph's meet nodes
+    :param shapes: whether to include the geometries of the nodes
+    """
+
+    with open(path, mode="w") as outfile:
+        outfile.write('{"directed": true, "multigraph": false, "graph": ')
+        outfile.write(geojson.dumps(graph.graph))
+
+        outfile.write(', "nodes": [')
+        separator = ""
+        for node, data in graph.nodes(data=True):
+            node_data = dict(data)
+            if not shapes:
+                node_data.pop("shape", None)
+            node_data["id"] = node
+            outfile.write(separator + geojson.dumps(node_data))
+            separator = ", "
+        for wedge in store.wedges:
+            geometries = (
+                store.shapes(wedge) if shapes else itertools.repeat(None)
+            )
+            for record, shape in zip(store.records(wedge), geometries):
+                node_data = {
+                    "area": record["area"],
+                    "type": record["type"],
+                    "id": record["id"],
+                }
+                if shapes:
+                    node_data["shape"] = shape
+                outfile.write(separator + geojson.dumps(node_data))
+                separator = ", "
+
+        outfile.write('], "links": [')
+        separator = ""
+        for source, target in graph.edges():
+            outfile.write(
+                separator + json.dumps({"source": source, "target": target})
+            )
+            separator = ", "
+        for wedge in store.wedges:
+            for record in store.records(wedge):
+                for parent in record["parents"]:
+                    outfile.write(
+                        separator
+                        + json.dumps(
+                            {"source": parent, "target": record["id"]}
+                        )
+                    )
+                    separator = ", "
+        outfile.write("]}")
@@ -0,0 +1,318 @@
+# Copyright 2020 The Johns Hopkins University Applied Physics Laboratory LLC
+# All rights reserved.
+# Distributed under the terms of the MIT License.
+
+
+from collections import defaultdict
+import itertools
+import json
+
+from geopandas import GeoDataFrame
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyproj import CRS
+from shapely import wkb
+
+from streaming import chunks
+
+NODES_SCHEMA = pa.schema(
+    [
+        pa.field("id", pa.string()),
+        pa.field("name", pa.string()),
+        pa.field("type", pa.string()),
+        pa.field("area", pa.float64()),
+    ]
+)
+
+LINKS_SCHEMA = pa.schema(
+    [
+        pa.field("source", pa.string()),
+        pa.field("target", pa.string()),
+        pa.field("type", pa.string()),
+    ]
+)
+
+SHAPES_SCHEMA = pa.schema(
+    [
+        pa.field("id", pa.string()),
+        pa.field("type", pa.string()),
+        pa.field("geometry", pa.binary()),
+        pa.field("minx", pa.float64()),
+        pa.field("miny", pa.float64()),
+        pa.field("maxx", pa.float64()),
+        pa.field("maxy", pa.float64()),
+    ]
+)
+
+
+def graph_node_chunks(graph, store=None, shapes=False, chunk_size=10000):
+    """
+    groups the nodes of an instance graph by granularity, and splits each granularity into chunks
+    :param graph: the instance graph
+    :param store: the MeetNodeStore with the graph's meet nodes, if they were built in streaming mode
+    :param shapes: whether to include the geometries of the nodes
+    :param chunk_size: the maximum number of nodes in a chunk
+    :return: yields (granularity, nodes) tuples, where nodes is a list of (ID, name, area, parents, shape) tuples
+    """
+
+    granularities = defaultdict(list)
+    for node, data in graph.nodes(data=True):
+        granularities[data["type"]].append(node)
+    for granularity, nodes in granularities.items():
+        for chunk in chunks(nodes, chunk_size):
+            yield granularity, [
+                (
+                    node,
+                    graph.nodes[node].get("name"),
+                    graph.nodes[node]["area"],
+                    list(graph.predecessors(node)),
+                    graph.nodes[node].get("shape") if shapes else None,
+                )
+                for node in chunk
+            ]
+
+    if store:
+        for wedge in store.wedges:
+            geometries = (
+                store.shapes(wedge) if shapes else itertools.repeat(None)
+            )
+            for chunk in chunks(
+                zip(store.records(wedge), geometries), chunk_size
+            ):
+                yield wedge, [
+                    (
+                        record["id"],
+                        None,
+                        record["area"],
+                        record["parents"],
+                        shape,
+                    )
+                    for record, shape in chunk
+                ]
+
+
+def write_parquet(
+    path_prefix, graph, store=None, shapes=False, chunk_size=10000
+):
+    """
+    writes an instance graph to Parquet files, one chunk of nodes at a time. Each row group holds the nodes of a
+    single granularity, so that readers can load a subset of the granularities without reading the whole file.
+        {path_prefix}_nodes.parquet: the ID, name, granularity, and area of each node, with the graph's metadata
+        {path_prefix}_links.parquet: the source, target, and target granularity of each link
+        {path_prefix}_shapes.parquet: the geometry of each node in GeoParquet format (WKB), with bounding box columns
+            whose row group statistics act as a coarse spatial index
+    :param path_prefix: the path of the files, without the suffixes
+    :param graph: the instance graph, with its metadata in graph.graph
+    :param store: the MeetNodeStore with the graph's meet nodes, if they were built in streaming mode
+    :param shapes: whether to write the geometries of the nodes
+    :param chunk_size: the maximum number of nodes in a row group
+    """
+
+    nodes_writer = pq.ParquetWriter(
+        f"{path_prefix}_nodes.parquet",
+        NODES_SCHEMA.with_metadata({"simon": json.dumps(graph.graph)}),
+    )
+    links_writer = pq.ParquetWriter(
+        f"{path_prefix}_links.parquet", LINKS_SCHEMA
+    )
+    if shapes:
+        geo = {
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            "columns": {
+                "geometry": {
+                    "encoding": "WKB",
+                    "geometry_types": [],
+                    "crs": CRS.from_epsg(
+                        graph.graph["projection"]
+                    ).to_json_dict(),
+                    "bbox_columns": ["minx", "miny", "maxx", "maxy"],
+                }
+            },
+        }
+        shapes_writer = pq.ParquetWriter(
+            f"{path_prefix}_shapes.parquet",
+            SHAPES_SCHEMA.with_metadata({"geo": json.dumps(geo)}),
+        )
+
+    for granularity, nodes in graph_node_chunks(
+        graph, store, shapes, chunk_size
+    ):
+        nodes_writer.write_table(
+            pa.Table.from_arrays(
+                [
+                    pa.array([node[0] for node in nodes], pa.string()),
+                    pa.array([node[1] for node in nodes], pa.string()),
+                    pa.array([granularity] * len(nodes), pa.string()),
+                    pa.array([node[2] for node in nodes], pa.float64()),
+                ],
+                schema=NODES_SCHEMA,
+            )
+        )
+
+        links = [(parent, node[0]) for node in nodes for parent in node[3]]
+        if links:
+            links_writer.write_table(
+                pa.Table.from_arrays(
+                    [
+                        pa.array([link[0] for link in links], pa.string()),
+                        pa.array([link[1] for link in links], pa.string()),
+                        pa.array([granularity] * len(links), pa.string()),
+                    ],
+                    schema=LINKS_SCHEMA,
+                )
+            )
+
+        if shapes:
+            bounds = [
+                node[4].bounds
+                if node[4] is not None and not node[4].is_empty
+                else (None, None, None, None)
+                for node in nodes
+            ]
+            shapes_writer.write_table(
+                pa.Table.from_arrays(
+                    [
+                        pa.array([node[0] for node in nodes], pa.string()),
+                        pa.array([granularity] * len(nodes), pa.string()),
+                        pa.array(
+                            [
+                                wkb.dumps(node[4])
+                                if node[4] is not None
+                                else None
+                                for node in nodes
+                            ],
+                            pa.binary(),
+                        ),
+                    ]
+                    + [
+                        pa.array([bound[i] for bound in bounds], pa.float64())
+                        for i in range(4)
+                    ],
+                    schema=SHAPES_SCHEMA,
+                )
+            )
+
+    nodes_writer.close()
+    links_writer.close()
+    if shapes:
+        shapes_writer.close()
+
+
+def statistics_range(parquet_file, row_group, column):
+    """
+    :param parquet_file: a pyarrow ParquetFile
+    :param row_group: the index of the row group
+    :param column: the name of the column
+    :return: the (min, max) tuple of the column in the row group, or None if the statistics are missing
+    """
+
+    index = parquet_file.schema.names.index(column)
+    statistics = (
+        parquet_file.metadata.row_group(row_group).column(index).statistics
+    )
+    if statistics is None or not statistics.has_min_max:
+        return None
+    values = [statistics.min, statistics.max]
+    return tuple(
+        value.decode() if isinstance(value, bytes) else value
+        for value in values
+    )
+
+
+def row_group_granularity(parquet_file, row_group):
+    """
+    :param parquet_file: a pyarrow ParquetFile written by write_parquet
+    :param row_group: the index of the row group
+    :return: the granularity of the nodes in the row group
+    """
+
+    type_range = statistics_range(parquet_file, row_group, "type")
+    if type_range and type_range[0] == type_range[1]:
+        return type_range[0]
+
+    # fall back on reading the granularity column, which is much smaller than the rest of the row group
+    column = parquet_file.read_row_group(row_group, columns=["type"])
+    return column.column(0)[0].as_py() if column.num_rows else None
+
+
+def read_parquet(path, granularities=None, columns=None):
+    """
+    reads a Parquet file written by write_parquet, skipping the row groups of other granularities
+    :param path: the path of the Parquet file
+    :param granularities: the granularities to read, or None to read every granularity
+    :param columns: the columns to read, or None to read every column
+    :return: a pyarrow Table
+    """
+
+    parquet_file = pq.ParquetFile(path)
+    tables = [
+        parquet_file.read_row_group(row_group, columns=columns)
+        for row_group in range(parquet_file.metadata.num_row_groups)
+        if granularities is None
+        or row_group_granularity(parquet_file, row_group) in granularities
+    ]
+    if not tables:
+        schema = parquet_file.schema.to_arrow_schema()
+        if columns:
+            schema = pa.schema([schema.field(column) for column in columns])
+        return schema.empty_table()
+    return pa.concat_tables(tables)
+
+
+def read_shapes(path, granularities=None, bbox=None):
+    """
+    reads the node geometries written by write_parquet into a GeoDataFrame
+    :param path: the path of the GeoParquet file
+    :param granularities: the granularities to read, or None to read every granularity
+    :param bbox: an optional (minx, miny, maxx, maxy) tuple. Only geometries whose bounding box intersects it are read
+    :return: a GeoDataFrame with id, type, and geometry columns
+    """
+
+    parquet_file = pq.ParquetFile(path)
+    geo = json.loads(parquet_file.schema.to_arrow_schema().metadata[b"geo"])
+    crs = CRS.from_json_dict(geo["columns"]["geometry"]["crs"])
+
+    tables = []
+    for row_group in range(parquet_file.metadata.num_row_groups):
+        if (
+            granularities is not None
+            and row_group_granularity(parquet_file, row_group)
+            not in granularities
+        ):
+            continue
+        if bbox is not None:
+            # skip row groups whose bounding box doesn't intersect the bbox
+            ranges = [
+                statistics_range(parquet_file, row_group, column)
+                for column in ["minx", "miny", "maxx", "maxy"]
+            ]
+            if all(ranges) and (
+                ranges[0][0] > bbox[2]
+                or ranges[1][0] > bbox[3]
+                or ranges[2][1] < bbox[0]
+                or ranges[3][1] < bbox[1]
+            ):
+                continue
+        tables.append(parquet_file.read_row_group(row_group))
+
+    if tables:
+        df = pa.concat_tables(tables).to_pandas()
+    else:
+        df = SHAPES_SCHEMA.empty_table().to_pandas()
+    if bbox is not None:
+        df = df[
+            (df["minx"] <= bbox[2])
+            & (df["miny"] <= bbox[3])
+            & (df["maxx"] >= bbox[0])
+            & (df["maxy"] >= bbox[1])
+        ]
+
+    return GeoDataFrame(
+        df[["id", "type"]].reset_index(drop=True),
+        geometry=[
+            wkb.loads(geometry) if geometry is not None else None
+            for geometry in df["geometry"]
+        ],
+        crs=crs,
+    )
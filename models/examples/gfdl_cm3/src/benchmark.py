@@ -0,0 +1,96 @@
+# Copyright 2020 The Johns Hopkins University Applied Physics Laboratory LLC
+# All rights reserved.
+# Distributed under the terms of the MIT License.
+
+
+import argparse
+import math
+import os
+import time
+
+import numpy as np
+
+from climate_model import ClimateCube, temp_inc
+
+
+def synthetic_data(years, seed):
+    """
+    generates climate data with the same layout as the rcp26data config: a 2 degree latitude by 2.5 degree
+    longitude grid, nested as data[lat][lon][year] = [temp (K), pr (mm), ev (mm)]
+    :param years: the number of years of data
+    :param seed: the random seed
+    :return: the nested climate data
+    """
+
+    rng = np.random.RandomState(seed)
+    data = {}
+    for lat in np.arange(-89, 90, 2):
+        data[str(float(lat))] = {}
+        for lon in np.arange(-178.75, 180, 2.5):
+            values = np.column_stack(
+                [
+                    rng.normal(288, 15, years),
+                    rng.gamma(2, 40, years),
+                    rng.gamma(2, 30, years),
+                ]
+            )
+            data[str(float(lat))][str(float(lon))] = values.tolist()
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark the gfdl_cm3 increment: nested loop vs. array"
+    )
+    parser.add_argument(
+        "--years",
+        type=int,
+        default=100,
+        help="the number of years of synthetic data",
+    )
+    parser.add_argument(
+        "--increments",
+        type=int,
+        default=50,
+        help="the number of increments to run",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="the random seed of the data"
+    )
+    args = parser.parse_args()
+
+    weights_path = os.path.join(os.path.dirname(__file__), "weights.json")
+    data = synthetic_data(args.years, args.seed)
+    increments = range(min(args.increments, args.years))
+
+    start = time.perf_counter()
+    loop_results = [temp_inc(data, year, weights_path) for year in increments]
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cube = ClimateCube(data, weights_path)
+    configure_time = time.perf_counter() - start
+    start = time.perf_counter()
+    cube_results = [cube.temp_inc(year) for year in increments]
+    cube_time = time.perf_counter() - start
+
+    # the array version must produce the same outputs
+    for year, loop_result, cube_result in zip(
+        increments, loop_results, cube_results
+    ):
+        if not math.isclose(loop_result[0], cube_result[0], rel_tol=1e-9):
+            print(f"WARNING: year {year}: global temperatures differ")
+        if loop_result[1:] != cube_result[1:]:
+            print(f"WARNING: year {year}: precipitation or evaporation differ")
+
+    print(f"loop: {loop_time / len(increments) * 1000:.2f} ms per increment")
+    print(
+        f"cube: {cube_time / len(increments) * 1000:.2f} ms per increment, {configure_time * 1000:.2f} ms to configure"
+    )
+    print(
+        f"speedup: {loop_time / cube_time:.1f}x per increment, {loop_time / (cube_time + configure_time):.1f}x including configure"
+    )
+
+
+if __name__ == "__main__":
+    main()
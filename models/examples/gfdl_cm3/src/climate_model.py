@@ -7,10 +7,15 @@ import numpy as np
 import json
 
 
-def temp_inc(init_data, year):
+# contiguous United States boundaries
+CONUS_LATS = (23, 49)
+CONUS_LONS = (-128, -68)
+
+
+def temp_inc(init_data, year, weights_path="/opt/src/weights.json"):
     json1_data = init_data
     mean_glob_temps = []
-    with open("/opt/src/weights.json") as f:
+    with open(weights_path) as f:
         weights = json.load(f)
 
     single_year_US = {}
@@ -59,3 +64,78 @@ def temp_inc(init_data, year):
         translated_pr,
         translated_ev,
     )
+
+
+def instance_id(lat, lon):
+    # convert to format that plays nice with mongodb
+    if lon < 0:
+        lon += 180
+    return f"lat_{int(lat*100)}_lon_{int(lon*100)}"
+
+
+class ClimateCube:
+    def __init__(self, init_data, weights_path="/opt/src/weights.json"):
+        """
+        converts the raw climate data into an array once, so that each increment is a slice and a dot product
+        :param init_data: the rcp26data config, nested as init_data[lat][lon][year] = [temp (K), pr (mm), ev (mm)]
+        :param weights_path: the path of the global temperature weights, one per grid square in the order of init_data
+        """
+
+        lats = list(init_data)
+        lons = list(init_data[lats[0]])
+        for lat in lats:
+            if list(init_data[lat]) != lons:
+                raise ValueError(
+                    f"latitude {lat} does not have the same longitudes as latitude {lats[0]}"
+                )
+
+        # (lat, lon, year, variable)
+        self.cube = np.array(
+            [[init_data[lat][lon] for lon in lons] for lat in lats],
+            dtype=np.float64,
+        )[..., :3]
+        self.years = self.cube.shape[2]
+
+        with open(weights_path) as f:
+            self.weights = np.array(json.load(f), dtype=np.float64).reshape(
+                len(lats), len(lons)
+            )
+
+        # only get U.S squares
+        lat_values = [float(lat) for lat in lats]
+        lon_values = [float(lon) for lon in lons]
+        us_lats = np.array(
+            [CONUS_LATS[0] <= lat <= CONUS_LATS[1] for lat in lat_values]
+        )
+        us_lons = np.array(
+            [CONUS_LONS[0] <= lon <= CONUS_LONS[1] for lon in lon_values]
+        )
+        self.mask = np.outer(us_lats, us_lons)
+        self.ids = [
+            instance_id(lat_values[i], lon_values[j])
+            for i, j in zip(*np.nonzero(self.mask))
+        ]
+
+        # (U.S. square, year, variable), contiguous so that each increment reads a small block
+        self.us_cube = np.ascontiguousarray(self.cube[self.mask])
+
+    def temp_inc(self, year):
+        """
+        :param year: the index of the year in the climate data
+        :return: the global temperature (C), and the precipitation (mm) and evaporation (mm) of each U.S. square
+        """
+
+        # apply weights to get global average temperature, and convert Kelvin to Celsius
+        temperature = (
+            float(np.vdot(self.weights, self.cube[:, :, year, 0])) - 273.15
+        )
+
+        us_year = self.us_cube[:, year, :]
+        translated_pr = dict(zip(self.ids, us_year[:, 1].tolist()))
+        translated_ev = dict(zip(self.ids, us_year[:, 2].tolist()))
+
+        return (
+            temperature,
+            translated_pr,
+            translated_ev,
+        )
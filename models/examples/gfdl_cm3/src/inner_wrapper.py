@@ -9,29 +9,37 @@ import logging
 
 sys.path.append("/")
 from outer_wrapper import OuterWrapper
-from climate_model import temp_inc
+from climate_model import ClimateCube
 
 
 class InnerWrapper(OuterWrapper):
     def __init__(self):
         num_input_schemas = len(glob.glob("/opt/schemas/input/*.json"))
+
+        # without inputs, this model can run ahead: pass run_ahead=True and execution="process" to compute the outputs
+        # of every increment ahead of time, in a forked worker process
         super().__init__(
             model_id="gfdl_cm3", num_expected_inputs=num_input_schemas
         )
 
     def configure(self, **kwargs):
-        self.raw_data = kwargs["rcp26data"]
         if "rcp26data" in kwargs.keys():
-            self.global_temp, self.precipitation, self.evaporation = temp_inc(
-                self.raw_data, self.incstep
-            )
+            # convert the raw data once, instead of walking it on every increment
+            self.cube = ClimateCube(kwargs["rcp26data"])
+            (
+                self.global_temp,
+                self.precipitation,
+                self.evaporation,
+            ) = self.cube.temp_inc(self.incstep)
         else:
             logging.warning(f"incstep {self.incstep}: rcp26data not found")
 
     def increment(self, **kwargs):
-        self.global_temp, self.precipitation, self.evaporation = temp_inc(
-            self.raw_data, self.incstep
-        )
+        (
+            self.global_temp,
+            self.precipitation,
+            self.evaporation,
+        ) = self.cube.temp_inc(self.incstep)
 
         results = {
             "gfdl_cm3": {
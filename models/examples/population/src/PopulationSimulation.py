@@ -3,37 +3,179 @@
 # Distributed under the terms of the MIT License.
 
 
+from multiprocessing import Pool
+
 from statsmodels.tsa.holtwinters import Holt
-import pandas as pd
 import numpy as np
 
 
-def pop_sim(init_data, num_increments):
+class PopulationForecast:
+    def __init__(self, counties, first_year, values):
+        """
+        the population of each county in each year, stored year-major so that each increment is a single row
+        :param counties: the county IDs, in the order of the columns
+        :param first_year: the year of the first row
+        :param values: a (year, county) array
+        """
+
+        self.counties = counties
+        self.first_year = first_year
+        self.values = values
+
+    def year(self, year):
+        """
+        :param year: the year of the forecast
+        :return: a dict mapping each county to its population in the year
+        """
 
-    data = init_data
+        row = year - self.first_year
+        if not 0 <= row < len(self.values):
+            raise KeyError(year)
+        return dict(zip(self.counties, self.values[row].tolist()))
 
-    for key, county in init_data.items():
-        population = pd.Series(county)
 
-        # https://www.statsmodels.org/stable/examples/notebooks/generated/exponential_smoothing.html#Holt's-Method
-        fit1 = Holt(np.asarray(population)).fit(
-            smoothing_level=0.7, smoothing_slope=0.3
+def holt_states(population, smoothing_level, smoothing_slope, level, slope):
+    """
+    runs Holt's linear trend recursion over every county at once
+    :param population: a (county, year) array
+    :param smoothing_level: the level smoothing parameter (alpha)
+    :param smoothing_slope: the slope smoothing parameter (beta)
+    :param level: the initial level of each county
+    :param slope: the initial slope of each county
+    :return: the levels and the slopes, (county, year + 1) arrays whose column i is the state after i years
+    """
+
+    counties, years = population.shape
+    levels = np.empty((counties, years + 1))
+    slopes = np.empty((counties, years + 1))
+    levels[:, 0] = level
+    slopes[:, 0] = slope
+    for i in range(years):
+        levels[:, i + 1] = smoothing_level * population[:, i] + (
+            1 - smoothing_level
+        ) * (levels[:, i] + slopes[:, i])
+        slopes[:, i + 1] = (
+            smoothing_slope * (levels[:, i + 1] - levels[:, i])
+            + (1 - smoothing_slope) * slopes[:, i]
         )
-        future_pop = fit1.forecast(num_increments)
+    return levels, slopes
 
-        last_inc = int(max(data[key].keys()))
-        for inc, value in zip(range(num_increments), future_pop):
-            # round negative population values to 0
-            data[key][str(last_inc + 1 + inc)] = value if value > 0 else 0
 
-    return data
+def holt_forecast(
+    population, num_increments, smoothing_level, smoothing_slope
+):
+    """
+    forecasts every county at once with Holt's linear trend method and fixed smoothing parameters.
+    Like statsmodels' Holt.fit, the initial level and slope of each county minimize its sum of squared
+    one-step-ahead errors. With fixed smoothing parameters, the one-step-ahead forecasts are linear in the
+    initial level and slope, so they are found by least squares instead of a numerical optimizer
+    :param population: a (county, year) array of the historical population
+    :param num_increments: the number of years to forecast
+    :param smoothing_level: the level smoothing parameter (alpha)
+    :param smoothing_slope: the slope smoothing parameter (beta)
+    :return: a (county, num_increments) array of the forecast
+    """
 
+    years = population.shape[1]
+
+    # the states of each county with an initial level and slope of 0
+    levels, slopes = holt_states(
+        population, smoothing_level, smoothing_slope, 0, 0
+    )
+
+    # the states that a unit initial level, and a unit initial slope, add to every county
+    unit_levels, unit_slopes = holt_states(
+        np.zeros((2, years)),
+        smoothing_level,
+        smoothing_slope,
+        np.array([1, 0]),
+        np.array([0, 1]),
+    )
+
+    # least squares fit of the initial level and slope to the one-step-ahead errors
+    design = (unit_levels[:, :years] + unit_slopes[:, :years]).T
+    residuals = population - (levels[:, :years] + slopes[:, :years])
+    initial = np.linalg.lstsq(design, residuals.T, rcond=None)[0].T
+
+    level = levels[:, -1] + initial @ unit_levels[:, -1]
+    slope = slopes[:, -1] + initial @ unit_slopes[:, -1]
+    return level[:, np.newaxis] + slope[:, np.newaxis] * np.arange(
+        1, num_increments + 1
+    )
 
-def get_data(data, year):
 
-    current_year = {}
+def fit_county(args):
+    population, num_increments, smoothing_level, smoothing_slope = args
 
-    for county, values in data.items():
-        current_year[county] = values[str(year)]
+    # https://www.statsmodels.org/stable/examples/notebooks/generated/exponential_smoothing.html#Holt's-Method
+    fit = Holt(population).fit(
+        smoothing_level=smoothing_level, smoothing_slope=smoothing_slope
+    )
+    return fit.forecast(num_increments)
 
-    return current_year
+
+def pop_sim(
+    init_data,
+    num_increments,
+    smoothing_level=0.7,
+    smoothing_slope=0.3,
+    processes=None,
+):
+    """
+    forecasts the population of each county
+    :param init_data: the county_populations config, mapping each county to its population in each year
+    :param num_increments: the number of years to forecast
+    :param smoothing_level: the level smoothing parameter, or None to fit it for each county
+    :param smoothing_slope: the slope smoothing parameter, or None to fit it for each county
+    :param processes: the number of processes that fit the counties when the smoothing parameters are fitted
+    :return: a PopulationForecast of the historical and forecast population
+    """
+
+    counties = list(init_data)
+    years = sorted(init_data[counties[0]], key=int)
+    if [int(year) for year in years] != list(
+        range(int(years[0]), int(years[-1]) + 1)
+    ):
+        raise ValueError(f"county {counties[0]} is missing years")
+    for county in counties:
+        if sorted(init_data[county], key=int) != years:
+            raise ValueError(
+                f"county {county} does not have the same years as county {counties[0]}"
+            )
+    population = np.array(
+        [[init_data[county][year] for year in years] for county in counties],
+        dtype=np.float64,
+    )
+
+    if smoothing_level is not None and smoothing_slope is not None:
+        forecast = holt_forecast(
+            population, num_increments, smoothing_level, smoothing_slope
+        )
+    else:
+        # each county's smoothing parameters need a numerical optimizer, so fit the counties in parallel
+        with Pool(processes) as pool:
+            forecast = np.array(
+                pool.map(
+                    fit_county,
+                    [
+                        (
+                            row,
+                            num_increments,
+                            smoothing_level,
+                            smoothing_slope,
+                        )
+                        for row in population
+                    ],
+                    chunksize=64,
+                )
+            )
+
+    # round negative population values to 0
+    values = np.concatenate([population, np.maximum(forecast, 0)], axis=1)
+    return PopulationForecast(
+        counties, int(years[0]), np.ascontiguousarray(values.T)
+    )
+
+
+def get_data(data, year):
+    return data.year(year)
@@ -15,6 +15,9 @@ from PopulationSimulation import pop_sim, get_data
 class InnerWrapper(OuterWrapper):
     def __init__(self):
         num_input_schemas = len(glob.glob("/opt/schemas/input/*.json"))
+
+        # without inputs, this model can run ahead: pass run_ahead=True and execution="process" to compute the outputs
+        # of every increment ahead of time, in a forked worker process
         super().__init__(
             model_id="population", num_expected_inputs=num_input_schemas
         )
@@ -3,6 +3,7 @@
 # Distributed under the terms of the MIT License.
 
 
+import numpy as np
 import pandas as pd
 
 
@@ -38,3 +39,57 @@ def pow_dem_sim(pop, cons):
         temp[index] = row["demand"]
 
     return temp
+
+
+class DemandModel:
+    def __init__(self, cons):
+        """
+        computes the power demand of each county from aligned arrays, indexing the counties by state once
+        :param cons: the consumption per capita of each state, keyed by state FIPS code
+        """
+
+        self.cons = cons
+        self.counties = None
+
+    def index(self, counties):
+        """
+        maps each county to its state, and aligns the state consumption per capita with the states
+        :param counties: the county FIPS codes, in the order of the population data
+        """
+
+        self.counties = counties
+        states, self.county_states = np.unique(
+            [county[:-3] for county in counties], return_inverse=True
+        )
+        self.state_cons = np.array(
+            [self.cons.get(state, np.nan) for state in states],
+            dtype=np.float64,
+        )
+
+    def pow_dem_sim(self, pop):
+        """
+        :param pop: the population of each county, keyed by county FIPS code
+        :return: the power demand of each county
+        """
+
+        # the counties only need to be indexed again if the population data has different counties
+        if self.counties is None or not (
+            len(pop) == len(self.counties)
+            and all(a == b for a, b in zip(pop, self.counties))
+        ):
+            self.index(list(pop))
+
+        county_pops = np.fromiter(
+            pop.values(), dtype=np.float64, count=len(pop)
+        )
+        state_pops = np.bincount(
+            self.county_states,
+            weights=county_pops,
+            minlength=len(self.state_cons),
+        )[self.county_states]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            perc = county_pops / state_pops
+
+        # simply multiplies current pop by state consumption per capita
+        demand = (state_pops * self.state_cons[self.county_states]) * perc
+        return dict(zip(self.counties, demand.tolist()))
@@ -0,0 +1,84 @@
+# Copyright 2020 The Johns Hopkins University Applied Physics Laboratory LLC
+# All rights reserved.
+# Distributed under the terms of the MIT License.
+
+
+import argparse
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from DemandSimulation import DemandModel, pow_dem_sim
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark the power_demand increment: pandas apply vs. arrays"
+    )
+    parser.add_argument(
+        "--increments",
+        type=int,
+        default=50,
+        help="the number of increments to run",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="the random seed of the growth"
+    )
+    args = parser.parse_args()
+
+    config_dir = os.path.join(os.path.dirname(__file__), "..", "config")
+    with open(os.path.join(config_dir, "2016_populations.json")) as f:
+        initial_pop = json.load(f)
+    with open(
+        os.path.join(config_dir, "state_consumption_per_capita.json")
+    ) as f:
+        cons = json.load(f)
+
+    # a new population for each increment, like the population model sends
+    rng = np.random.RandomState(args.seed)
+    pops = []
+    for increment in range(args.increments):
+        growth = rng.normal(1.01, 0.01, len(initial_pop)) ** increment
+        pops.append(
+            {
+                county: value * factor
+                for (county, value), factor in zip(initial_pop.items(), growth)
+            }
+        )
+
+    start = time.perf_counter()
+    pandas_results = [pow_dem_sim(pop, cons) for pop in pops]
+    pandas_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model = DemandModel(cons)
+    array_results = [model.pow_dem_sim(pop) for pop in pops]
+    array_time = time.perf_counter() - start
+
+    # the array version must produce the same demands
+    for increment, pandas_result, array_result in zip(
+        range(args.increments), pandas_results, array_results
+    ):
+        for county, demand in pandas_result.items():
+            if not (
+                math.isclose(demand, array_result[county], rel_tol=1e-12)
+                or (math.isnan(demand) and math.isnan(array_result[county]))
+            ):
+                print(
+                    f"WARNING: increment {increment}: demand of {county} differs: {demand} != {array_result[county]}"
+                )
+
+    print(
+        f"pandas: {pandas_time / args.increments * 1000:.2f} ms per increment"
+    )
+    print(
+        f"arrays: {array_time / args.increments * 1000:.2f} ms per increment, including indexing the counties once"
+    )
+    print(f"speedup: {pandas_time / array_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,7 @@ import logging
 
 sys.path.append("/")
 from outer_wrapper import OuterWrapper
-from DemandSimulation import pow_dem_sim
+from DemandSimulation import DemandModel
 
 
 class InnerWrapper(OuterWrapper):
@@ -22,6 +22,7 @@ class InnerWrapper(OuterWrapper):
     def configure(self, **kwargs):
         if "state_consumption_per_capita" in kwargs.keys():
             self.cons = kwargs["state_consumption_per_capita"]
+            self.model = DemandModel(self.cons)
         else:
             logging.warning(
                 f"incstep {self.incstep}: state_consumption_per_capita not found"
@@ -39,7 +40,7 @@ class InnerWrapper(OuterWrapper):
         elif self.incstep > 1:
             logging.warning(f"incstep {self.incstep}: population not found")
 
-        demand = pow_dem_sim(self.pop, self.cons)
+        demand = self.model.pow_dem_sim(self.pop)
 
         results = {
             "power_demand": {
@@ -3,62 +3,99 @@
 # Distributed under the terms of the MIT License.
 
 
-import pandas as pd
+import numpy as np
 
 
-def gen_state(demand, prof):
+class ProfileRates:
+    def __init__(self, profiles, rates, default=0.0, region=None):
+        """
+        the rates of a set of energy profiles, aligned into vectors so that each increment is a multiply.
+        The profiles never change after configure, so the rates are only aligned again if the data's instances change
+        :param profiles: a dict mapping each region to its profile, a dict of rates
+        :param rates: the names of the rates to align
+        :param default: the rate of an instance without a profile, or of a profile without the rate
+        :param region: a function that maps an instance of the data to the region of its profile. Defaults to the
+                instance itself
+        """
 
-    counties = (
-        pd.DataFrame(demand, index=["demand"])
-        .T.reset_index()
-        .rename(columns={"index": "county"})
-    )
-    counties["state"] = counties.county.apply(lambda x: x[:-3])
-    state_demand = counties.groupby("state")["demand"].sum()
-    state_prof = (
-        pd.DataFrame(prof).T.reset_index().rename(columns={"index": "state"})
-    )
-    state_demand = state_demand.to_frame().reset_index()
-    counties = pd.merge(counties, state_demand, on="state", how="left")
-    counties = pd.merge(counties, state_prof, on="state", how="left")
-    counties["Fuel Used (MMBtu)"] = counties.apply(
-        lambda x: (x["MMBtu per MWh"]) * (x.demand_x), axis=1
-    )
-    counties["CO2 Emissions (tons)"] = counties.apply(
-        lambda x: (x["Tons CO2 per MWh"]) * (x.demand_x), axis=1
-    )
-    counties["Water Used (Mgal)"] = counties.apply(
-        lambda x: (x["Mgal_per_MWh"]) * (x.demand_x), axis=1
+        self.profiles = profiles
+        self.rates = rates
+        self.default = default
+        self.region = region or (lambda instance: instance)
+        self.instances = None
+        self.vectors = None
+
+    def align(self, data):
+        """
+        :param data: a dict mapping each instance to its value
+        :return: the values of the data, and a vector of each rate aligned with the values
+        """
+
+        if self.instances is None or not (
+            len(data) == len(self.instances)
+            and all(a == b for a, b in zip(data, self.instances))
+        ):
+            self.instances = list(data)
+            profiles = [
+                self.profiles.get(self.region(instance), {})
+                for instance in self.instances
+            ]
+            self.vectors = [
+                np.array(
+                    [profile.get(rate, self.default) for profile in profiles],
+                    dtype=np.float64,
+                )
+                for rate in self.rates
+            ]
+
+        values = np.fromiter(data.values(), dtype=np.float64, count=len(data))
+        return values, self.vectors
+
+
+def state_rates(prof):
+    """
+    :param prof: the state_energy_profiles config
+    :return: the CO2 and water rates of each county's state. A county whose state has no profile has NaN rates
+    """
+
+    return ProfileRates(
+        prof,
+        ["Tons CO2 per MWh", "Mgal_per_MWh"],
+        default=np.nan,
+        region=lambda county: county[:-3],
     )
-    counties = counties[
-        [
-            "county",
-            "Fuel Used (MMBtu)",
-            "CO2 Emissions (tons)",
-            "Water Used (Mgal)",
-        ]
-    ].set_index("county")
-
-    co2 = {}
-    h2o = {}
-    for index, row in counties.iterrows():
-        co2[index] = row["CO2 Emissions (tons)"]
-        h2o[index] = row["Water Used (Mgal)"]
 
-    return co2, h2o
 
+def nerc_rates(profile_rates):
+    """
+    :param profile_rates: the nerc_energy_profiles config
+    :return: the CO2 and water rates of each NERC region. A region without a profile has rates of 0
+    """
+
+    return ProfileRates(profile_rates, ["co2 (tons/MWh)", "water (Mgal/MWh)"])
 
-def gen_nerc(demand, profile_rates):
 
-    co2 = {}
-    h2o = {}
+def gen_state(demand, rates):
+    """
+    :param demand: the power demand of each county
+    :param rates: the ProfileRates of state_rates
+    :return: the CO2 emissions and water usage of each county
+    """
+
+    values, (co2_rates, h2o_rates) = rates.align(demand)
+    co2 = dict(zip(rates.instances, (co2_rates * values).tolist()))
+    h2o = dict(zip(rates.instances, (h2o_rates * values).tolist()))
+    return co2, h2o
+
 
-    for nerc in demand:
-        co2[nerc] = demand[nerc] * profile_rates.get(nerc, {}).get(
-            "co2 (tons/MWh)", 0
-        )
-        h2o[nerc] = demand[nerc] * profile_rates.get(nerc, {}).get(
-            "water (Mgal/MWh)", 0
-        )
+def gen_nerc(demand, rates):
+    """
+    :param demand: the power demand of each NERC region
+    :param rates: the ProfileRates of nerc_rates
+    :return: the CO2 emissions and water usage of each NERC region
+    """
 
+    values, (co2_rates, h2o_rates) = rates.align(demand)
+    co2 = dict(zip(rates.instances, (values * co2_rates).tolist()))
+    h2o = dict(zip(rates.instances, (values * h2o_rates).tolist()))
     return co2, h2o
@@ -9,7 +9,7 @@ import logging
 
 sys.path.append("/")
 from outer_wrapper import OuterWrapper
-from GenerationSimulation import gen_nerc
+from GenerationSimulation import gen_nerc, nerc_rates
 
 
 class InnerWrapper(OuterWrapper):
@@ -22,6 +22,7 @@ class InnerWrapper(OuterWrapper):
     def configure(self, **kwargs):
         if "nerc_energy_profiles" in kwargs.keys():
             self.prof = kwargs["nerc_energy_profiles"]
+            self.rates = nerc_rates(self.prof)
         else:
             logging.warning(
                 f"incstep {self.incstep}: nerc_energy_profiles not found"
@@ -42,7 +43,7 @@ class InnerWrapper(OuterWrapper):
         elif self.incstep > 1:
             logging.warning(f"incstep {self.incstep}: power_demand not found")
 
-        emissions, water = gen_nerc(self.dem, self.prof)
+        emissions, water = gen_nerc(self.dem, self.rates)
 
         results = {
             "power_supply": {
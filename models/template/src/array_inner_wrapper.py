@@ -0,0 +1,79 @@
+# Copyright 2020 The Johns Hopkins University Applied Physics Laboratory LLC
+# All rights reserved.
+# Distributed under the terms of the MIT License
+
+
+import glob
+import sys
+
+sys.path.append("/")
+from outer_wrapper import ArrayOuterWrapper
+
+# import helper functions
+from my_module import my_array_function
+
+
+# an alternative to inner_wrapper.py for models that compute with NumPy arrays. To use it, rename it to inner_wrapper.py
+class InnerWrapper(ArrayOuterWrapper):
+    def __init__(self):
+
+        # count the number of JSON files in the input schemas directory
+        num_input_schemas = len(glob.glob("/opt/schemas/input/*.json"))
+
+        # unique_model_name is the name of the model (must match the name of the model's directory)
+        super().__init__(
+            model_id="unique_model_name", num_expected_inputs=num_input_schemas
+        )
+
+    def configure(self, **kwargs):
+        # config_datax refers to the names of the JSON files in the config directory
+        # convert the config data to arrays aligned with the index of its granularity
+        self.input_data1 = self.to_array(kwargs["config_data1"], "state")
+        self.input_data2 = self.to_array(kwargs["config_data2"], "huc8")
+        self.input_data3 = self.to_array(kwargs["config_data3"], "huc8")
+
+    # this model has two input schemas, and so expects input from two other models
+    def increment_arrays(self, **kwargs):
+
+        # input_model_name1 matches the name of a JSON file in the input schemas directory
+        # each input is an array aligned with the index of the granularity in its input schema
+        if "input_model_name1" in kwargs.keys():
+            # example_input1 (state) and example_input2 (huc8) refer to fields in the input schema
+            self.input_data1 = kwargs["input_model_name1"]["example_input1"]
+            self.input_data2 = kwargs["input_model_name1"]["example_input2"]
+
+        # input_model_name2 matches the name of a JSON file in the input schemas directory
+        if "input_model_name2" in kwargs.keys():
+            # example_input3 (huc8) refers to a field in the input schema
+            self.input_data3 = kwargs["input_model_name2"]["example_input3"]
+
+        # calculate the model's outputs
+        # self.index(granularity).instances lists the instance of each array element
+        output1, output2 = my_array_function(
+            self.input_data1,
+            self.input_data2,
+            self.input_data3,
+            len(self.index("county")),
+            len(self.index("latlon")),
+        )
+
+        # template_output_schema matches the name of the JSON file in the output schemas directory
+        # example_output1 and example_output2 refer to fields in the output schema
+        # example_output1 is an array aligned with the county index
+        # example_output2 is an array aligned with the latlon index
+        # before it is published, each array will automatically be converted to a dict and translated to the granularities specified in template_output_schema
+        return {
+            "template_output_schema": {
+                "example_output1": {"data": output1, "granularity": "county"},
+                "example_output2": {"data": output2, "granularity": "latlon"},
+            }
+        }
+
+
+def main():
+    wrapper = InnerWrapper()
+    wrapper.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,19 @@
 # Distributed under the terms of the MIT License
 
 
+import numpy as np
+
+
 # use the input data to calculate output data
 def my_function(input1, input2, input3):
     output1 = {}
     output2 = {}
     return output1, output2
+
+
+# use the input arrays to calculate output arrays, for an inner wrapper based on ArrayOuterWrapper
+# each input array is aligned with the index of its granularity, and each output array must be aligned with the index of its granularity
+def my_array_function(input1, input2, input3, num_counties, num_latlons):
+    output1 = np.zeros(num_counties)
+    output2 = np.zeros(num_latlons)
+    return output1, output2
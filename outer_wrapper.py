@@ -8,14 +8,101 @@ import json
 from jsonschema import validate, ValidationError
 import time
 import glob
-from threading import Thread, Event
+from threading import Thread, Event, Lock, Condition, current_thread
+from threading import enumerate as enumerate_threads, get_ident
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from queue import Queue, Empty
 from abc import ABC, abstractmethod
 import os
 import sys
 import logging
+import multiprocessing
+import traceback
+import hashlib
 import networkx as nx
+import numpy as np
+from simon_common import (
+    Metrics,
+    Envelope,
+    configure_logging,
+    offer,
+    track_sequence,
+)
 from collections import defaultdict
+from contextlib import contextmanager
+
+# use a faster JSON parser if one is installed
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        fast_json = json
+
+# snapshots are stored with msgpack, which only encodes data (never code), so loading one cannot execute anything
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# JSON files at least this large are cached as binary snapshots
+SNAPSHOT_MIN_SIZE = 64 * 1024
+
+# the number of missing instances named in the summary warning of a translation
+MISSING_EXAMPLES = 5
+
+# translation functions that are linear in the data, so that a translation that only uses them is a fixed weighted
+# sum, and can be precomputed for each pair of granularities
+LINEAR_AGGREGATORS = {"simple_sum"}
+LINEAR_DISAGGREGATORS = {
+    "distribute_uniformly",
+    "distribute_identically",
+    "distribute_by_area",
+}
+
+# the broker's forwarder: models publish to its frontends, and subscribe to its backends. Control messages have
+# their own channel, so that they aren't queued behind bulk data messages
+DATA_FRONTEND = "tcp://broker:5555"
+DATA_BACKEND = "tcp://broker:5556"
+CONTROL_FRONTEND = "tcp://broker:5557"
+CONTROL_BACKEND = "tcp://broker:5558"
+
+# the broker's heartbeat port: models push their status messages to the broker only, instead of publishing them to
+# every other model
+HEARTBEAT = "tcp://broker:5559"
+
+# the broker's registration port: models register with a request at startup, and the broker boots as soon as every
+# model has registered
+REGISTRATION = "tcp://broker:5560"
+
+# the address of each of the broker's channels. A benchmark that runs the broker and the models in one process
+# passes its own, e.g., inproc:// addresses
+ENDPOINTS = {
+    "data_frontend": DATA_FRONTEND,
+    "data_backend": DATA_BACKEND,
+    "control_frontend": CONTROL_FRONTEND,
+    "control_backend": CONTROL_BACKEND,
+    "heartbeat": HEARTBEAT,
+    "registration": REGISTRATION,
+}
+
+
+def log_missing_instances(missing, granularity):
+    """
+    logs one warning for all of the instances of a translation that aren't in the instance graph, instead of one
+    warning per instance
+    :param missing: the missing instances
+    :param granularity: the granularity of the instances
+    """
+
+    if missing:
+        logging.warning(
+            "%d %s instances not in instance graph, e.g., %s",
+            len(missing),
+            granularity,
+            missing[:MISSING_EXAMPLES],
+        )
 
 
 class Graph(nx.DiGraph):
@@ -151,17 +238,281 @@ class Graph(nx.DiGraph):
         return distributed
 
 
+# the outer wrapper whose graphs the translation worker processes use, inherited when they are forked
+translation_wrapper = None
+
+
+def translate_in_process(data, src, dest, variable, agg_name, disagg_name):
+    return translation_wrapper.translate(
+        data, src, dest, variable, agg_name, disagg_name
+    )
+
+
+def translate_output_in_process(message):
+    return translation_wrapper.translate_output(message)
+
+
+def timed_call(function, *args):
+    """
+    calls a function in a pool worker, timing it on the monotonic clock, which is shared by the worker processes
+    :return: the function's result, the start of the call, its duration in seconds, and the name of the worker
+    """
+
+    start = time.monotonic()
+    result = function(*args)
+    worker = f"translation {os.getpid()} {current_thread().name}"
+    return result, start, time.monotonic() - start, worker
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.01):
+        """
+        a sampling profiler of every thread of the process. Every interval, it records the stack of each thread with
+        sys._current_frames(), so the profiled threads run unmodified, and only pay for the GIL while it samples
+        :param interval: the sampling interval in seconds
+        """
+
+        self.interval = interval
+        self.samples = defaultdict(int)
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.sample, name="profiler", daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        own = get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {
+                thread.ident: thread.name for thread in enumerate_threads()
+            }
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                self.samples[
+                    (names.get(ident, str(ident)), tuple(reversed(codes)))
+                ] += 1
+
+    def stop(self, root=None):
+        """
+        stops sampling
+        :param root: a frame to add to the root of every stack, e.g., the name of the process
+        :return: the collapsed stacks, a dict mapping "thread;function (file:line);..." to its number of samples.
+                The lines of "<stack> <samples>" are the input of flamegraph.pl and speedscope
+        """
+
+        self.stopped.set()
+        self.thread.join()
+
+        stacks = defaultdict(int)
+        for (thread, codes), count in self.samples.items():
+            frames = [thread] + [
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                for code in codes
+            ]
+            if root:
+                frames.insert(0, root)
+            stacks[
+                ";".join(frame.replace(";", ":") for frame in frames)
+            ] += count
+        return dict(stacks)
+
+
+class SpanRecorder:
+    def __init__(self, trace=False, metrics=None):
+        """
+        records monotonic-clock spans of the phases of each increment, e.g., translating an input, the model's
+        increment, or sending an output. The spans are summarized by incstep and phase, and the summaries are
+        drained into the status messages
+        :param trace: whether to also keep every span, to export them as a Chrome trace at the end of the run
+        :param metrics: the Metrics that the duration of each span is observed in, by phase
+        """
+
+        self.trace = trace
+        self.metrics = metrics
+        self.lock = Lock()
+        self.summaries = {}
+        self.spans = []
+
+        # places the monotonic spans on the wall clock in the trace, so that the traces of the models line up
+        self.origin = time.monotonic()
+        self.epoch = time.time()
+
+    @contextmanager
+    def span(self, phase, incstep, **args):
+        """
+        records the span of the body of a with statement
+        :param phase: the name of the phase
+        :param incstep: the increment step that the phase belongs to
+        :param args: details of the span, kept in the trace
+        """
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(
+                phase, incstep, start, time.monotonic() - start, **args
+            )
+
+    def record(self, phase, incstep, start, duration, thread=None, **args):
+        """
+        records a span that was timed elsewhere, e.g., in a pool worker
+        :param phase: the name of the phase
+        :param incstep: the increment step that the phase belongs to
+        :param start: the start of the span on the monotonic clock
+        :param duration: the duration of the span in seconds
+        :param thread: the name of the thread of the span in the trace. Defaults to the current thread
+        :param args: details of the span, kept in the trace
+        """
+
+        if self.metrics is not None:
+            self.metrics.observe("simon_phase_seconds", duration, phase=phase)
+        with self.lock:
+            summary = self.summaries.setdefault(str(incstep), {}).setdefault(
+                phase, {"count": 0, "total": 0.0, "max": 0.0}
+            )
+            summary["count"] += 1
+            summary["total"] += duration
+            summary["max"] = max(summary["max"], duration)
+            if self.trace:
+                self.spans.append(
+                    (
+                        phase,
+                        incstep,
+                        start,
+                        duration,
+                        thread or current_thread().name,
+                        args,
+                    )
+                )
+
+    def drain(self):
+        """
+        :return: the summaries of the spans recorded since the last drain, by incstep and phase: their count, and
+                their total and max durations in seconds. The spans of an incstep may span several drains
+        """
+
+        with self.lock:
+            summaries, self.summaries = self.summaries, {}
+        return summaries
+
+    def export_trace(self, path, process_name):
+        """
+        writes the spans as a Chrome trace (the trace event format), which chrome://tracing and Perfetto open
+        :param path: path to the .json file
+        :param process_name: the name of the process in the trace
+        """
+
+        pid = os.getpid()
+        events = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": pid,
+                "args": {"name": process_name},
+            }
+        ]
+        tids = {}
+        with self.lock:
+            spans = list(self.spans)
+        for phase, incstep, start, duration, thread, args in spans:
+            if thread not in tids:
+                tids[thread] = len(tids)
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": pid,
+                        "tid": tids[thread],
+                        "args": {"name": thread},
+                    }
+                )
+            events.append(
+                {
+                    "name": phase,
+                    "cat": "increment",
+                    "ph": "X",
+                    "ts": (self.epoch + start - self.origin) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": pid,
+                    "tid": tids[thread],
+                    "args": dict(args, incstep=incstep),
+                }
+            )
+
+        with open(path, mode="w") as trace_file:
+            json.dump(
+                {"traceEvents": events, "displayTimeUnit": "ms"}, trace_file
+            )
+
+
 class OuterWrapper(ABC):
-    def __init__(self, model_id, num_expected_inputs):
+    def __init__(
+        self,
+        model_id,
+        num_expected_inputs,
+        execution="thread",
+        translation_workers=1,
+        translation_pool="thread",
+        run_ahead=False,
+        data_hwm=1000,
+        queue_size=1000,
+        endpoints=None,
+        model_dir="/opt",
+        graph_dir="/",
+    ):
         """
         constructor for the outer wrapper, an abstract base class inherited by the inner wrapper
         :param model_id: the ID / unique name of the model, as defined in the inner wrapper
         :param num_expected_inputs: the number of unique types of input data messages the model needs in order to perform
                                 an increment, as defined in the inner wrapper. Should equal the number of input schemas,
                                 that is, the number of .json files in the model's schemas/input/ directory
+        :param execution: where the inner wrapper's configure() and increment() run.
+                                thread: in the outer wrapper's action thread, sharing the GIL with the messaging threads
+                                process: in a dedicated worker process, so that CPU-heavy models don't starve the
+                                messaging threads
+        :param translation_workers: the number of workers that validate and translate incoming data messages
+        :param translation_pool: whether the translation workers are threads or processes. Processes translate
+                                concurrently, but pickle the data to and from the workers
+        :param run_ahead: for a model without inputs, whether to compute and translate the outputs of every increment
+                                ahead of time, and publish each increment's outputs as soon as its pulse arrives.
+                                Requires the process execution mode, so that the model's increment step is separate from
+                                the outer wrapper's
+        :param data_hwm: the high-water mark of the data channel's sockets: the number of data messages queued for
+                                sending or receiving before zmq drops new ones. The control channel isn't limited
+        :param queue_size: the bound of each internal queue. When the frame queue is full, received data frames are
+                                left in the data socket until the dispatcher catches up; when the publish queue is full,
+                                the increment waits for it; status messages are dropped, and counted, when their queues
+                                are full
+        :param endpoints: the address of each of the broker's channels, by channel name. Defaults to ENDPOINTS
+        :param model_dir: the model's directory, with its schemas and config directories
+        :param graph_dir: the directory with the abstract and instance graphs
         """
 
+        if execution not in ["thread", "process"]:
+            raise ValueError(f"unknown execution mode {execution}")
+        if translation_pool not in ["thread", "process"]:
+            raise ValueError(f"unknown translation pool {translation_pool}")
+        if run_ahead:
+            if num_expected_inputs:
+                raise ValueError("only a model without inputs can run ahead")
+            if execution != "process":
+                raise ValueError(
+                    'a model that runs ahead needs execution="process"'
+                )
+
         self.model_id = model_id
+        self.endpoints = endpoints or ENDPOINTS
+        self.model_dir = model_dir
+        self.execution = execution
+        self.model_process = None
+        self.model_pipe = None
         self.num_expected_inputs = num_expected_inputs
         self.status = "booting"
         self.incstep = 1
@@ -169,18 +520,78 @@ class OuterWrapper(ABC):
         self.increment_flag = False
         self.connected_to_broker = False
 
-        self.pub_queue = Queue()
-        self.broker_queue = Queue()
-        self.action_queue = Queue()
+        # set once configure() has finished, which runs concurrently with the messaging threads
+        self.configured = Event()
+
+        # wakes up the status thread, to send a status message right away
+        self.status_wakeup = Event()
+
+        self.pub_queue = Queue(queue_size)
+        self.control_queue = Queue(queue_size)
+        self.data_hwm = data_hwm
+        self.broker_queue = Queue(queue_size)
+        self.action_queue = Queue(queue_size)
+
+        # frames received by the sub thread, to be decoded and routed by the dispatcher thread
+        self.frame_queue = Queue(queue_size)
 
-        self.abstract_graph = Graph("/abstract-graph.geojson")
-        self.instance_graph = Graph("/instance-graph.geojson")
+        # the sequence number of the last data message sent, and of the last one received from each source
+        self.data_seq = 0
+        self.data_seqs = {}
+
+        # incoming data messages are translated in a pool, decoupled from receiving them
+        self.translation_workers = translation_workers
+        self.translation_pool = translation_pool
+        self.translation_executor = None
+
+        # the outputs computed ahead of time, by incstep, in the run-ahead mode
+        self.run_ahead = run_ahead
+        self.run_ahead_results = {}
+        self.run_ahead_condition = Condition()
+
+        # the number of increments in the run, as reported by the broker
+        self.final_incstep = None
+
+        # the status and incstep of every model, as aggregated by the broker
+        self.system_state = {}
+
+        # spans of the phases of each increment. Every span is kept for a Chrome trace if SIMON_TRACE_DIR is set
+        self.trace_dir = os.environ.get("SIMON_TRACE_DIR")
+        self.metrics = Metrics()
+        self.spans = SpanRecorder(
+            trace=bool(self.trace_dir), metrics=self.metrics
+        )
+        self.increment_finished = None
+
+        # the sampling profiler started by a profile signal, and the stacks sampled in the worker process.
+        # Profiles are published to the broker, and also written to SIMON_PROFILE_DIR if it is set
+        self.profile_dir = os.environ.get("SIMON_PROFILE_DIR")
+        self.profiler = None
+        self.profile_request = None
+        self.profile_remaining = 0
+        self.profile_stacks = defaultdict(int)
+        self.profile_lock = Lock()
+
+        self.abstract_graph = Graph(
+            os.path.join(graph_dir, "abstract-graph.geojson")
+        )
+        self.instance_graph = Graph(
+            os.path.join(graph_dir, "instance-graph.geojson")
+        )
         self.default_agg = "simple_sum"
         self.default_dagg = "distribute_by_area"
 
+        # the precomputed translations, keyed by (src, dest, agg_name, disagg_name), built the first time each is used
+        self.translations = {}
+        self.translations_lock = Lock()
+
         self.input_schemas = None
         self.output_schemas = None
         self.validated_messages = {"this_incstep": {}, "next_incstep": {}}
+
+        # the input schemas whose messages are being translated, and the lock that guards validated_messages
+        self.translating = set()
+        self.messages_lock = Lock()
         self.generic_output_schema = (
             "{"
             '  "type": "object",'
@@ -196,11 +607,7 @@ class OuterWrapper(ABC):
             "}"
         )
 
-        logging.basicConfig(
-            level=logging.INFO,
-            stream=sys.stdout,
-            format="%(asctime)s - %(levelname)s - %(filename)s:%(funcName)s:%(lineno)d - %(message)s",
-        )
+        configure_logging(model=model_id)
 
     def meet(self, a, b):
         sort = sorted((a, b))
@@ -224,11 +631,10 @@ class OuterWrapper(ABC):
 
             # group the instances by their parent
             parents = defaultdict(list)
+            missing = []
             for instance, value in data.items():
                 if instance not in self.instance_graph.nodes:
-                    logging.warning(
-                        f"instance {instance} not in instance graph"
-                    )
+                    missing.append(instance)
                     continue
                 parent = [
                     parent
@@ -237,6 +643,7 @@ class OuterWrapper(ABC):
                 ]
                 assert len(parent) == 1
                 parents[parent[0]].append((instance, value))
+            log_missing_instances(missing, src)
 
             # aggregate each parent's child values
             translated = {}
@@ -268,17 +675,17 @@ class OuterWrapper(ABC):
 
             # iterate over each parent instance
             translated = {}
+            missing = []
             for instance, value in data.items():
                 if instance not in self.instance_graph.nodes:
-                    logging.warning(
-                        f"instance {instance} not in instance graph"
-                    )
+                    missing.append(instance)
                 else:
                     trans_func = self.instance_graph.functions.get(disagg_name)
                     # for this parent, create a dict of child instances mapped to disaggregated values
                     children = trans_func(value, instance, path[1])
                     # add this parent's dict of children to the flat dict
                     translated = {**translated, **children}
+            log_missing_instances(missing, src)
 
             # translate to the next granularity in the path
             return self.disaggregate(translated, path[1], dest, disagg_name)
@@ -287,6 +694,68 @@ class OuterWrapper(ABC):
                 f"error disaggregating from {src} to {dest}, no path found"
             )
 
+    def route(self, src, dest):
+        """
+        :param src: granularity of the data
+        :param dest: granularity to translate the data to
+        :return: the steps that translate() takes across the granularity graph, as a list of (direction, granularity)
+                tuples where direction is "down" (disaggregate) or "up" (aggregate), or None if there is no path
+        """
+
+        if nx.has_path(self.abstract_graph, src, dest):
+            return [
+                ("down", granularity)
+                for granularity in nx.shortest_path(
+                    self.abstract_graph, src, dest
+                )[1:]
+            ]
+        elif nx.has_path(self.abstract_graph, dest, src):
+            return [
+                ("up", granularity)
+                for granularity in reversed(
+                    nx.shortest_path(self.abstract_graph, dest, src)[:-1]
+                )
+            ]
+        elif nx.has_path(
+            self.abstract_graph, src, self.meet(src, dest)
+        ) and nx.has_path(self.abstract_graph, dest, self.meet(src, dest)):
+            return self.route(src, self.meet(src, dest)) + self.route(
+                self.meet(src, dest), dest
+            )
+        return None
+
+    def translation(self, src, dest, agg_name, disagg_name):
+        """
+        :param src: granularity of the data
+        :param dest: granularity to translate the data to
+        :param agg_name: the name of a linear aggregator
+        :param disagg_name: the name of a linear disaggregator
+        :return: the PrecomputedTranslation between the granularities, built the first time it is needed, or None if
+                there is no path between them
+        """
+
+        key = (src, dest, agg_name, disagg_name)
+        with self.translations_lock:
+            if key not in self.translations:
+                start = time.perf_counter()
+                route = self.route(src, dest)
+                self.translations[key] = (
+                    PrecomputedTranslation(
+                        self.instance_graph,
+                        src,
+                        dest,
+                        route,
+                        self.instance_graph.functions[agg_name],
+                        self.instance_graph.functions[disagg_name],
+                    )
+                    if route
+                    else None
+                )
+                logging.info(
+                    f"precomputed the translation from {src} to {dest} in {time.perf_counter() - start:.3f} s"
+                )
+            return self.translations[key]
+
     def translate(
         self, data, src, dest, variable, agg_name=None, disagg_name=None
     ):
@@ -308,8 +777,18 @@ class OuterWrapper(ABC):
         if src == dest:
             return data
 
+        # a translation with linear functions is a weighted sum, precomputed the first time it is used
+        if (
+            agg_name in LINEAR_AGGREGATORS
+            and disagg_name in LINEAR_DISAGGREGATORS
+        ):
+            translation = self.translation(src, dest, agg_name, disagg_name)
+            translated = translation.translate(data) if translation else None
+            if translated is not None:
+                return translated
+
         # disaggregate straight down a branch of the granularity graph
-        elif nx.has_path(self.abstract_graph, src, dest):
+        if nx.has_path(self.abstract_graph, src, dest):
             return self.disaggregate(data, src, dest, disagg_name)
 
         # aggregate straight up a branch of the granularity graph
@@ -342,12 +821,83 @@ class OuterWrapper(ABC):
         """
 
         schemas = {}
+        start = time.perf_counter()
         for schema in glob.glob(f"{dir_path}/*.json"):
-            with open(schema) as schema_file:
-                file_name = os.path.splitext(os.path.basename(schema))[0]
-                schemas[file_name] = json.load(schema_file)
+            file_name = os.path.splitext(os.path.basename(schema))[0]
+            schemas[file_name] = self.load_json_file(schema)
+        logging.info(
+            f"loaded {len(schemas)} JSON files from {dir_path} in {time.perf_counter() - start:.3f} s"
+        )
         return schemas
 
+    def load_json_file(self, path):
+        """
+        loads a JSON file. A large file is loaded from a binary (msgpack) snapshot of its parsed contents if there is
+        one, and otherwise parsed and snapshotted. Snapshots are keyed by the hash of the file's contents, so a changed
+        file is never loaded from a stale snapshot. Snapshots are only kept in the model's own subdirectory of the
+        directory in the SIMON_CONFIG_CACHE environment variable, never next to the file. Without SIMON_CONFIG_CACHE
+        or the msgpack package, the file is parsed every time
+        :param path: path to the .json file
+        :return: the JSON object
+        """
+
+        start = time.perf_counter()
+        with open(path, mode="rb") as json_file:
+            raw = json_file.read()
+        if (
+            len(raw) < SNAPSHOT_MIN_SIZE
+            or msgpack is None
+            or not os.environ.get("SIMON_CONFIG_CACHE")
+        ):
+            return fast_json.loads(raw)
+
+        digest = hashlib.sha256(raw).hexdigest()[:16]
+        base_name = os.path.basename(path)
+        snapshot_dir = os.path.join(
+            os.environ["SIMON_CONFIG_CACHE"], self.model_id
+        )
+        snapshot_path = os.path.join(
+            snapshot_dir, f"{base_name}.{digest}.msgpack"
+        )
+
+        # warm load
+        try:
+            with open(snapshot_path, mode="rb") as snapshot_file:
+                data = msgpack.unpackb(
+                    snapshot_file.read(), raw=False, strict_map_key=False
+                )
+            logging.info(
+                f"loaded {base_name} from snapshot in {time.perf_counter() - start:.3f} s"
+            )
+            return data
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"ignoring snapshot {snapshot_path}: {e}")
+
+        # cold load
+        data = fast_json.loads(raw)
+        logging.info(
+            f"parsed {base_name} with {fast_json.__name__} in {time.perf_counter() - start:.3f} s"
+        )
+        try:
+            os.makedirs(snapshot_dir, exist_ok=True)
+
+            # remove snapshots of previous versions of the file
+            for stale in glob.glob(
+                os.path.join(snapshot_dir, f"{base_name}.*.msgpack")
+            ):
+                os.remove(stale)
+
+            # write to a temporary file first, so that a concurrent load never reads a partial snapshot
+            temporary_path = f"{snapshot_path}.{os.getpid()}"
+            with open(temporary_path, mode="wb") as snapshot_file:
+                snapshot_file.write(msgpack.packb(data, use_bin_type=True))
+            os.replace(temporary_path, snapshot_path)
+        except OSError as e:
+            logging.info(f"could not snapshot {base_name}: {e}")
+        return data
+
     @abstractmethod
     def configure(self, **kwargs):
         """
@@ -372,74 +922,363 @@ class OuterWrapper(ABC):
             f"increment() has to be implemented in the {self.model_id} inner wrapper"
         )
 
-    def increment_handler(self, event, incstep):
+    def model_worker(self, pipe):
         """
-        Calls increment() after validating inputs, then validates the results of the increment
-        :param event: the shutdown event for managing threads
-        :param incstep: the increment number that is currently being performed, as understood by the broker
-        :return: if the increment is successful, returns its results in a dictionary
+        runs the inner wrapper's configure() and increment() in the worker process of the process execution mode.
+        The worker is forked before the outer wrapper starts its threads and its zmq context
+        :param pipe: the worker's end of the pipe to the outer wrapper
+        :return: runs until it receives a stop request, or the outer wrapper's end of the pipe is closed
         """
 
-        self.increment_flag = True
-        logging.info(
-            f"about to increment, incstep {incstep}, year {self.initial_year + incstep}"
+        while True:
+            try:
+                action, kwargs, incstep, initial_year, profile = pipe.recv()
+            except EOFError:
+                break
+            if action == "stop":
+                break
+
+            self.incstep = incstep
+            self.initial_year = initial_year
+
+            # sample the call if the outer wrapper is profiling
+            profiler = None
+            if profile:
+                profiler = SamplingProfiler(profile)
+                profiler.start()
+            try:
+                if action == "configure":
+                    result = self.configure(**kwargs)
+                else:
+                    result = self.increment(**kwargs)
+                success = True
+            except Exception:
+                result = traceback.format_exc()
+                success = False
+            stacks = profiler.stop(root="model process") if profiler else None
+            pipe.send((success, result, stacks))
+
+        pipe.close()
+
+    def start_model_process(self):
+        """
+        forks the worker process of the process execution mode
+        """
+
+        self.model_pipe, worker_pipe = multiprocessing.Pipe()
+        self.model_process = multiprocessing.get_context("fork").Process(
+            target=self.model_worker,
+            args=(worker_pipe,),
+            name=f"{self.model_id}-model",
         )
-        self.incstep = incstep
+        self.model_process.start()
+        worker_pipe.close()
 
-        # validate against input schemas
-        if (
-            incstep > 1
-            and len(self.validated_messages["this_incstep"])
-            != self.num_expected_inputs
-        ):
+    def stop_model_process(self):
+        """
+        stops the worker process of the process execution mode
+        """
+
+        try:
+            self.model_pipe.send(("stop", None, None, None, None))
+        except (BrokenPipeError, EOFError, OSError):
+            pass
+        self.model_process.join(timeout=5)
+        if self.model_process.is_alive():
+            self.model_process.terminate()
+        self.model_pipe.close()
+
+    def call_model(self, action, kwargs, event=None, incstep=None):
+        """
+        calls the inner wrapper's configure() or increment(), in the worker process in the process execution mode.
+        The inputs and results are pickled through a pipe: the target Python (3.6) has no multiprocessing.shared_memory
+        :param action: configure or increment
+        :param kwargs: the keyword arguments of the call
+        :param event: the shutdown event for managing threads, to stop waiting for the worker
+        :param incstep: the increment step of the call in the worker process, if it isn't the outer wrapper's
+        :return: the result of the call
+        """
+
+        if not self.model_process:
+            if action == "configure":
+                return self.configure(**kwargs)
+            return self.increment(**kwargs)
+
+        profiler = self.profiler
+        self.model_pipe.send(
+            (
+                action,
+                kwargs,
+                self.incstep if incstep is None else incstep,
+                self.initial_year,
+                profiler.interval if profiler else None,
+            )
+        )
+
+        # wait for the worker without holding the GIL, so that the messaging threads keep running
+        while not self.model_pipe.poll(0.1):
+            if event is not None and event.is_set():
+                raise RuntimeError(f"shut down during {action}")
+            if not self.model_process.is_alive():
+                raise RuntimeError(
+                    f"{self.model_id} worker process exited with code {self.model_process.exitcode} during {action}"
+                )
+        success, result, stacks = self.model_pipe.recv()
+        if stacks:
+            with self.profile_lock:
+                for stack, count in stacks.items():
+                    self.profile_stacks[stack] += count
+        if not success:
             logging.critical(
-                f"number of validated messages {len(self.validated_messages['this_incstep'])} != num_expected_inputs {self.num_expected_inputs}"
+                f"{action} failed in the {self.model_id} worker process:\n{result}"
             )
-            event.set()
-            raise RuntimeError
+            raise RuntimeError(f"{action} failed")
+        return result
 
-        # call the inner wrapper
-        payloads = {}
-        for schema, message in self.validated_messages["this_incstep"].items():
-            payloads[schema] = message["payload"]
-        results = self.increment(**payloads)
+    def validate_results(self, results):
+        """
+        validates the results of an increment against the output schemas
+        :param results: the results returned by increment()
+        :return: raises a RuntimeError if the results don't validate
+        """
 
-        # validate against output schemas
         for schema_name, data_msg in results.items():
             try:
                 validate(data_msg, json.loads(self.generic_output_schema))
                 validate(data_msg, self.output_schemas[schema_name])
             except Exception as e:
                 logging.critical(
-                    f"message {data_msg} failed to validate schema {schema_name}"
+                    "message %s failed to validate schema %s: %s",
+                    Envelope({"payload": data_msg}),
+                    schema_name,
+                    e,
                 )
-                event.set()
                 raise RuntimeError
 
         if len(results) != len(self.output_schemas):
             logging.critical("didn't validate against every output schema")
-            event.set()
             raise RuntimeError
 
-        self.increment_flag = False
+    def data_messages(self, results, incstep):
+        """
+        :param results: the validated results of an increment
+        :param incstep: the increment step of the results
+        :return: a data message for each output schema
+        """
+
+        data_msgs = []
         for schema, data in results.items():
             data_msg = {}
             data_msg["schema"] = schema
             data_msg["payload"] = data
             data_msg["signal"] = "data"
             data_msg["source"] = self.model_id
-            data_msg["incstep"] = self.incstep
-            data_msg["year"] = self.incstep + self.initial_year
+            data_msg["incstep"] = incstep
+            data_msg["year"] = incstep + self.initial_year
+            data_msgs.append(data_msg)
+        return data_msgs
+
+    def increment_handler(self, event, incstep):
+        """
+        Calls increment() after validating inputs, then validates the results of the increment
+        :param event: the shutdown event for managing threads
+        :param incstep: the increment number that is currently being performed, as understood by the broker
+        :return: if the increment is successful, returns its results in a dictionary
+        """
+
+        self.increment_flag = True
+        logging.info(
+            "about to increment, incstep %s, year %s",
+            incstep,
+            self.initial_year + incstep,
+        )
+        self.incstep = incstep
+
+        # the time between finishing the last increment and receiving this pulse
+        if self.increment_finished is not None:
+            now = time.monotonic()
+            self.spans.record(
+                "wait for pulse",
+                incstep,
+                self.increment_finished,
+                now - self.increment_finished,
+            )
+
+        if self.run_ahead:
+            self.publish_run_ahead(event, incstep)
+            self.increment_flag = False
+            self.incstep += 1
+            self.increment_finished = time.monotonic()
+            self.status_wakeup.set()
+            self.profiled_increment()
+            return
+
+        # validate against input schemas
+        with self.spans.span("validate inputs", incstep):
+            valid = (
+                incstep == 1
+                or len(self.validated_messages["this_incstep"])
+                == self.num_expected_inputs
+            )
+        if not valid:
+            logging.critical(
+                f"number of validated messages {len(self.validated_messages['this_incstep'])} != num_expected_inputs {self.num_expected_inputs}"
+            )
+            event.set()
+            raise RuntimeError
+
+        # call the inner wrapper. The inputs are consumed, so that the model isn't ready for the next increment
+        # until the next inputs arrive
+        payloads = {}
+        with self.messages_lock:
+            for schema, message in self.validated_messages[
+                "this_incstep"
+            ].items():
+                payloads[schema] = message["payload"]
+            self.validated_messages["this_incstep"].clear()
+        with self.spans.span("model", incstep):
+            results = self.call_model("increment", payloads, event)
+
+        # validate against output schemas
+        try:
+            with self.spans.span("validate outputs", incstep):
+                self.validate_results(results)
+        except RuntimeError:
+            event.set()
+            raise
+
+        self.increment_flag = False
+        for data_msg in self.data_messages(results, self.incstep):
             self.pub_queue.put(data_msg)
         logging.info(
-            f"finished increment {self.incstep}, year {self.incstep + self.initial_year}"
+            "finished increment %s, year %s",
+            self.incstep,
+            self.incstep + self.initial_year,
         )
         self.incstep += 1
+        self.increment_finished = time.monotonic()
+
+        # report the new status right away, e.g., a model without inputs is ready for the next increment
+        self.status_wakeup.set()
+        self.profiled_increment()
+
+    def run_ahead_worker(self, event):
+        """
+        computes, validates, and translates the outputs of every increment ahead of time, in the run-ahead mode.
+        The model computes the increments in order in its worker process, while the translation pool translates
+        the outputs of earlier increments
+        :param event: the shutdown event for managing threads
+        :return: returns once every increment has been computed, or the shutdown event is set
+        """
+
+        # wait for the model to be configured, and for the broker to report the number of increments
+        while not event.is_set() and not (
+            self.configured.is_set()
+            and self.connected_to_broker
+            and self.final_incstep is not None
+        ):
+            time.sleep(0.1)
+        if event.is_set():
+            return
+
+        for incstep in range(self.incstep, self.final_incstep + 1):
+            if event.is_set():
+                return
+            try:
+                with self.spans.span("model", incstep):
+                    results = self.call_model("increment", {}, event, incstep)
+                with self.spans.span("validate outputs", incstep):
+                    self.validate_results(results)
+            except Exception as e:
+                logging.critical(
+                    f"failed to run ahead to incstep {incstep}: {e}"
+                )
+                event.set()
+                return
+
+            futures = [
+                self.translation_executor.submit(
+                    timed_call,
+                    translate_output_in_process
+                    if self.translation_pool == "process"
+                    else self.translate_output,
+                    data_msg,
+                )
+                for data_msg in self.data_messages(results, incstep)
+            ]
+            with self.run_ahead_condition:
+                self.run_ahead_results[incstep] = futures
+                self.run_ahead_condition.notify_all()
+            logging.info(f"ran ahead to incstep {incstep}")
+
+    def publish_run_ahead(self, event, incstep):
+        """
+        publishes the outputs of an increment that were computed ahead of time, waiting for them if needed
+        :param event: the shutdown event for managing threads
+        :param incstep: the increment step to publish
+        """
+
+        start = time.monotonic()
+        with self.run_ahead_condition:
+            while incstep not in self.run_ahead_results:
+                if event.is_set():
+                    raise RuntimeError(
+                        f"shut down waiting for incstep {incstep}"
+                    )
+                self.run_ahead_condition.wait(0.1)
+            futures = self.run_ahead_results.pop(incstep)
+
+        for future in futures:
+            try:
+                (
+                    (matched, data_msg),
+                    translate_start,
+                    duration,
+                    worker,
+                ) = future.result()
+            except Exception as e:
+                logging.critical(
+                    f"failed to translate the outputs of incstep {incstep}: {e}"
+                )
+                event.set()
+                raise RuntimeError
+            self.spans.record(
+                "translate output",
+                incstep,
+                translate_start,
+                duration,
+                thread=worker,
+                schema=data_msg["schema"],
+            )
+            if matched == 1:
+                # already validated and translated, so the pub thread sends it as is
+                data_msg["translated"] = True
+                self.pub_queue.put(data_msg)
+            elif matched == 0:
+                logging.debug(
+                    "message didn't match any output schemas: %s",
+                    data_msg["source"],
+                )
+            else:
+                logging.critical(
+                    f"more than one output schema was matched: {data_msg['source']}"
+                )
+                event.set()
+                raise RuntimeError
+        self.spans.record(
+            "wait for run-ahead", incstep, start, time.monotonic() - start
+        )
+        logging.info(
+            "published increment %s, year %s, computed ahead of time",
+            incstep,
+            incstep + self.initial_year,
+        )
 
     def send_status(self, event):
         """
         creates a status message and puts it into the publish queue. A status message must include the model's ID,
         a signal / message type of "status", the increment step, and the current status:
+            configuring: model is loading its config and running configure(), concurrently with the messaging threads
             booting: model is waiting for the broker to boot (receive status messages from all models)
             waiting: model is waiting for its needed input data messages from other models
             ready: model can begin incrementing if it receives an increment pulse; it is at the first increment step,
@@ -452,38 +1291,43 @@ class OuterWrapper(ABC):
         count = 0
         while not event.is_set():
             count += 1
-            time.sleep(1)
+            self.status_wakeup.wait(1)
+            self.status_wakeup.clear()
 
-            if self.connected_to_broker:
+            if not self.configured.is_set():
+                # still configuring, but heartbeats keep flowing
+                self.status = "configuring"
+            elif self.connected_to_broker:
                 if self.increment_flag:
                     # waiting for the increment to finish
                     self.status = "incrementing"
                 else:
-                    if self.incstep == 1:
-                        # kickstart the model for the first increment
-                        self.status = "ready"
-
-                    elif (
-                        len(self.validated_messages["next_incstep"])
-                        == self.num_expected_inputs
-                    ):
-                        # ready for an increment
-                        self.validated_messages[
-                            "this_incstep"
-                        ] = self.validated_messages["next_incstep"].copy()
-                        self.validated_messages["next_incstep"].clear()
-                        self.status = "ready"
-
-                    elif (
-                        len(self.validated_messages["this_incstep"])
-                        == self.num_expected_inputs
-                    ):
-                        # ready for an increment
-                        self.status = "ready"
-
-                    else:
-                        # still waiting for messages from other models
-                        self.status = "waiting"
+                    with self.messages_lock:
+                        if self.incstep == 1:
+                            # kickstart the model for the first increment
+                            self.status = "ready"
+
+                        elif (
+                            len(self.validated_messages["next_incstep"])
+                            == self.num_expected_inputs
+                        ):
+                            # ready for an increment
+                            self.validated_messages[
+                                "this_incstep"
+                            ] = self.validated_messages["next_incstep"].copy()
+                            self.validated_messages["next_incstep"].clear()
+                            self.status = "ready"
+
+                        elif (
+                            len(self.validated_messages["this_incstep"])
+                            == self.num_expected_inputs
+                        ):
+                            # ready for an increment
+                            self.status = "ready"
+
+                        else:
+                            # still waiting for messages from other models
+                            self.status = "waiting"
             else:
                 self.status = "booting"
 
@@ -496,13 +1340,134 @@ class OuterWrapper(ABC):
             message["incstep"] = self.incstep
             message["year"] = self.incstep + self.initial_year
             message["status"] = self.status
-            self.pub_queue.put(message)
 
-            logging.debug(json.dumps(message))
+            # the spans of the phases recorded since the last status message
+            spans = self.spans.drain()
+            if spans:
+                message["spans"] = spans
+
+            # a snapshot of the metrics, for the broker to serve
+            for name, queue in [
+                ("pub", self.pub_queue),
+                ("control", self.control_queue),
+                ("action", self.action_queue),
+                ("frame", self.frame_queue),
+                ("broker", self.broker_queue),
+            ]:
+                self.metrics.set(
+                    "simon_queue_depth", queue.qsize(), queue=name
+                )
+            self.metrics.set("simon_translating", len(self.translating))
+            self.metrics.set("simon_incstep", self.incstep)
+            message["metrics"] = self.metrics.snapshot()
+
+            # the messages waiting to be received or sent, for the broker's backpressure
+            message["backlog"] = (
+                self.frame_queue.qsize()
+                + len(self.translating)
+                + self.pub_queue.qsize()
+            )
+            if not offer(self.control_queue, message, self.metrics, "control"):
+                logging.warning(
+                    "control queue is full, dropped status message"
+                )
+
+            logging.debug("status %s", Envelope(message))
+
+    def translate_output(self, message):
+        """
+        validates an outgoing data message against the output schemas, and translates each data variable to the
+        output schema's granularity
+        :param message: the data message
+        :return: the number of output schemas that the message matched, and the translated message
+        """
+
+        matched = []
+        for name, schema in self.output_schemas.items():
+            try:
+                validate(message["payload"], schema)
+                logging.info(
+                    "schema %s validated outgoing message from %s",
+                    name,
+                    message["source"],
+                )
+                matched.append(schema)
+
+                # translate each data variable to output schema's granularity
+                for item in message["payload"]:
+
+                    # get current granularity from the data message
+                    src_gran = message["payload"][item]["granularity"]
+
+                    # get granularity and translation functions from the schema
+                    dest_gran = schema["properties"][item]["properties"][
+                        "granularity"
+                    ].get("value", src_gran)
+                    agg = (
+                        schema["properties"][item]["properties"]
+                        .get("agg", {})
+                        .get("value")
+                    )
+                    dagg = (
+                        schema["properties"][item]["properties"]
+                        .get("dagg", {})
+                        .get("value")
+                    )
+
+                    # translate the data and update the data message
+                    logging.debug(
+                        "validating output: message from %s, translating variable %s, %s -> %s",
+                        name,
+                        item,
+                        src_gran,
+                        dest_gran,
+                    )
+                    data = self.translate(
+                        message["payload"][item]["data"],
+                        src_gran,
+                        dest_gran,
+                        item,
+                        agg_name=agg,
+                        disagg_name=dagg,
+                    )
+                    message["payload"][item]["data"] = data
+                    message["payload"][item]["unit"] = schema["properties"][
+                        item
+                    ]["properties"]["data"].get("unit", "")
+                    message["payload"][item]["granularity"] = dest_gran
+
+            except ValidationError:
+                logging.debug("validation error")
+            except json.JSONDecodeError:
+                logging.warning("json decode error")
+        return len(matched), message
+
+    def send_data(self, sock, message):
+        """
+        serializes and sends a data message, recording the spans of both
+        :param sock: the zmq socket
+        :param message: the data message
+        """
+
+        self.data_seq += 1
+        message["seq"] = self.data_seq
+        with self.spans.span(
+            "serialize", message["incstep"], schema=message["schema"]
+        ):
+            frame = json.dumps(message).encode("utf8")
+        with self.spans.span(
+            "send",
+            message["incstep"],
+            schema=message["schema"],
+            bytes=len(frame),
+        ):
+            sock.send(frame)
+        self.metrics.inc("simon_messages_sent_total", signal="data")
+        self.metrics.inc("simon_bytes_sent_total", len(frame), signal="data")
 
     def pub(self, event, context):
         """
-        publishes messages to the broker, including status messages and data messages
+        publishes data messages to the broker, on the data channel.
         Sets the shutdown event if an outgoing data message matches more than one output schema.
         :param event: the shutdown event for managing threads
         :return: runs continuously until shutdown event is set, then closes its zmq socket
@@ -511,7 +1476,8 @@ class OuterWrapper(ABC):
         # connect to zmq
         sock = context.socket(zmq.PUB)
         sock.setsockopt(zmq.LINGER, 1000)
-        sock.connect("tcp://broker:5555")
+        sock.setsockopt(zmq.SNDHWM, self.data_hwm)
+        sock.connect(self.endpoints["data_frontend"])
 
         while not event.is_set():
 
@@ -521,73 +1487,36 @@ class OuterWrapper(ABC):
             except Empty:
                 continue
 
-            # send status messages
-            if message.get("signal") == "status":
+            # send profile results
+            if message.get("signal") != "data":
                 sock.send_json(message)
+                self.metrics.inc(
+                    "simon_messages_sent_total", signal=message.get("signal")
+                )
                 continue
 
-            # validate data messages
-            matched = []
-            for name, schema in self.output_schemas.items():
-                try:
-                    validate(message["payload"], schema)
-                    logging.info(
-                        f"validated outgoing message from {message['source']}"
-                    )
-                    matched.append(schema)
+            # send data messages that were translated ahead of time
+            if message.pop("translated", False):
+                self.send_data(sock, message)
+                continue
 
-                    # translate each data variable to output schema's granularity
-                    for item in message["payload"]:
-
-                        # get current granularity from the data message
-                        src_gran = message["payload"][item]["granularity"]
-
-                        # get granularity and translation functions from the schema
-                        dest_gran = schema["properties"][item]["properties"][
-                            "granularity"
-                        ].get("value", src_gran)
-                        agg = (
-                            schema["properties"][item]["properties"]
-                            .get("agg", {})
-                            .get("value")
-                        )
-                        dagg = (
-                            schema["properties"][item]["properties"]
-                            .get("dagg", {})
-                            .get("value")
-                        )
-
-                        # translate the data and update the data message
-                        logging.info(
-                            f"validating output: message from {name}, translating variable {item}, {src_gran} -> {dest_gran}"
-                        )
-                        data = self.translate(
-                            message["payload"][item]["data"],
-                            src_gran,
-                            dest_gran,
-                            item,
-                            agg_name=agg,
-                            disagg_name=dagg,
-                        )
-                        message["payload"][item]["data"] = data
-                        message["payload"][item]["unit"] = schema[
-                            "properties"
-                        ][item]["properties"]["data"].get("unit", "")
-                        message["payload"][item]["granularity"] = dest_gran
-
-                except ValidationError:
-                    logging.debug("validation error")
-                except json.JSONDecodeError:
-                    logging.warning("json decode error")
-            if len(matched) == 0:
+            # validate and translate data messages
+            with self.spans.span(
+                "translate output",
+                message["incstep"],
+                schema=message["schema"],
+            ):
+                matched, message = self.translate_output(message)
+            if matched == 0:
                 logging.debug(
-                    f"message didn't match any output schemas: {message['source']}"
+                    "message didn't match any output schemas: %s",
+                    message["source"],
                 )
-            elif len(matched) == 1:
-                logging.info(
-                    f"message matched an output schema: {message['source']}"
+            elif matched == 1:
+                logging.debug(
+                    "message matched an output schema: %s", message["source"]
                 )
-                sock.send_json(message)
+                self.send_data(sock, message)
             else:
                 logging.critical(
                     f"more than one output schema was matched: {message['source']}"
@@ -596,107 +1525,214 @@ class OuterWrapper(ABC):
 
         sock.close()
 
-    def sub(self, event, context):
+    def pub_control(self, event, context):
         """
-        connects to the broker's PUB as a subscriber and receives all messages sent from the broker,
-        and all messages sent by other models and forwarded by the broker.
-        Status messages from the broker go into the broker queue, for the watchdog.
+        pushes status messages to the broker's heartbeat port. Only the broker receives them, so the cost of the
+        heartbeats grows with the number of models, not its square. Runs in its own thread, so that status messages
+        aren't delayed by translating and serializing data messages
         :param event: the shutdown event for managing threads
         :return: runs continuously until shutdown event is set, then closes its zmq socket
         """
 
-        # connect to zmq
-        sock = context.socket(zmq.SUB)
-        sock.setsockopt(zmq.SUBSCRIBE, b"")
-        sock.setsockopt(zmq.RCVTIMEO, 0)
+        sock = context.socket(zmq.PUSH)
         sock.setsockopt(zmq.LINGER, 1000)
-        sock.connect("tcp://broker:5556")
+        sock.setsockopt(zmq.SNDHWM, 10)
+        sock.connect(self.endpoints["heartbeat"])
 
         while not event.is_set():
             try:
-                message = sock.recv_json()
-            except zmq.ZMQError:
+                message = self.control_queue.get(timeout=0.1)
+            except Empty:
                 continue
-            logging.debug(json.dumps(message))
-
-            signal = message.get("signal")
-            if signal == "status" and message.get("source") == "broker":
-                self.broker_queue.put(message)
-            elif signal == "data":
-                if not self.insert_data_message(message):
-                    event.set()
-            else:
-                self.action_queue.put(message)
+            try:
+                # the next status message supersedes this one, so drop it rather than wait for the broker
+                sock.send_json(message, zmq.NOBLOCK)
+            except zmq.Again:
+                self.metrics.inc("simon_queue_drops_total", queue="heartbeat")
+                continue
+            self.metrics.inc(
+                "simon_messages_sent_total", signal=message.get("signal")
+            )
 
         sock.close()
 
-    def insert_data_message(self, message):
+    def sub(self, event, context):
+        """
+        connects to the broker's PUBs as a subscriber and receives all messages sent from the broker,
+        and all data messages sent by other models and forwarded by the broker.
+        Control messages are decoded and routed right away, and always before the next data frame.
+        Data frames are only received and put into the frame queue, so that the data socket is drained even while
+        data messages are being translated
+        :param event: the shutdown event for managing threads
+        :return: runs continuously until shutdown event is set, then closes its zmq sockets
+        """
+
+        # connect to zmq
+        control = context.socket(zmq.SUB)
+        control.setsockopt(zmq.SUBSCRIBE, b"")
+        control.setsockopt(zmq.LINGER, 1000)
+        control.connect(self.endpoints["control_backend"])
+
+        data = context.socket(zmq.SUB)
+        data.setsockopt(zmq.SUBSCRIBE, b"")
+        data.setsockopt(zmq.LINGER, 1000)
+        data.setsockopt(zmq.RCVHWM, self.data_hwm)
+        data.connect(self.endpoints["data_backend"])
+
+        poller = zmq.Poller()
+        poller.register(control, zmq.POLLIN)
+        poller.register(data, zmq.POLLIN)
+
+        while not event.is_set():
+            if self.frame_queue.full():
+                # backpressure: leave the data frames in the data socket until the dispatcher catches up.
+                # Once the socket reaches its high-water mark, the forwarder drops them, and the gap is counted
+                if control.poll(10):
+                    self.receive_control(control, event)
+                continue
+
+            if not poller.poll(100):
+                continue
+
+            # drain the control messages, then take one data frame at a time, checking for control messages between
+            while True:
+                self.receive_control(control, event)
+                if self.frame_queue.full():
+                    break
+                try:
+                    self.frame_queue.put_nowait(data.recv(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+
+        control.close()
+        data.close()
+
+    def receive_control(self, sock, event):
+        """
+        receives, decodes, and routes every waiting control message
+        :param sock: the control channel's socket
+        :param event: the shutdown event for managing threads
+        """
+
+        while True:
+            try:
+                frame = sock.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.decode_and_route(frame, event)
+
+    def dispatcher(self, event):
+        """
+        decodes the data frames received by the sub thread and routes the messages
+        :param event: the shutdown event for managing threads
+        :return: runs continuously until shutdown event is set
+        """
+
+        while not event.is_set():
+            try:
+                frame = self.frame_queue.get(timeout=0.1)
+            except Empty:
+                continue
+            self.decode_and_route(frame, event)
+
+    def decode_and_route(self, frame, event):
+        """
+        decodes a received frame and routes the message.
+        Status messages from the broker go into the broker queue, for the watchdog.
+        Data messages are validated, and submitted to the translation pool.
+        Profile signals start the profiler right away, so that a profile can start during a long increment.
+        Other messages, e.g., increment pulses, go into the action queue
+        :param frame: the frame
+        :param event: the shutdown event for managing threads
+        """
+
+        try:
+            message = json.loads(frame)
+        except ValueError:
+            logging.warning("json decode error")
+            return
+        logging.debug("received %s", Envelope(message))
+
+        signal = message.get("signal")
+        self.metrics.inc(
+            "simon_messages_received_total",
+            source=message.get("source"),
+            signal=signal,
+        )
+        self.metrics.inc(
+            "simon_bytes_received_total",
+            len(frame),
+            source=message.get("source"),
+        )
+        if signal == "status" and message.get("source") == "broker":
+            offer(self.broker_queue, message, self.metrics, "broker")
+        elif signal == "data":
+            track_sequence(self.data_seqs, message, self.metrics)
+            if not self.insert_data_message(message, event):
+                event.set()
+        elif signal == "profile":
+            if message.get("model") in [None, self.model_id]:
+                self.start_profile(message)
+        elif not offer(self.action_queue, message, self.metrics, "action"):
+            logging.critical(
+                "action queue is full, dropped %s", Envelope(message)
+            )
+
+    def insert_data_message(self, message, event=None):
         """
-        validates a data message against the input schemas
+        validates a data message against the input schemas, and submits it to the translation pool.
+        Once every variable of the message is translated, the message is inserted into the validated messages
         :param message: the data message to insert into the queue
+        :param event: the shutdown event for managing threads, set if a translation fails
         :return: False if message insertion throws an error, otherwise True.
                 returns True if the message is validated by 0 or 1 schemas
                 returns False if the data message is a duplicate
-                (was validated by a schema already used since the last increment)
+                (was validated by a schema already used since the last increment, including a message that is
+                still being translated)
         """
 
         # validate data messages
         matched = []
         for name, schema in self.input_schemas.items():
             try:
-                validate(message["payload"], schema)
+                with self.spans.span(
+                    "validate input",
+                    self.incstep,
+                    schema=name,
+                    source=message.get("source"),
+                ):
+                    validate(message["payload"], schema)
                 logging.info(
-                    f"schema {name} validated incoming message from {message['source']}"
+                    "schema %s validated incoming message from %s",
+                    name,
+                    message["source"],
                 )
-                if name in self.validated_messages["next_incstep"]:
+                with self.messages_lock:
+                    duplicate = (
+                        name in self.validated_messages["next_incstep"]
+                        or name in self.translating
+                    )
+                    if not duplicate:
+                        self.translating.add(name)
+                if duplicate:
+                    self.metrics.inc(
+                        "simon_duplicate_messages_total",
+                        source=message.get("source"),
+                    )
                     logging.error(
-                        f"schema {name} already validated a message: {self.validated_messages['next_incstep'][name]}"
+                        "schema %s already validated a message: %s",
+                        name,
+                        Envelope(
+                            self.validated_messages["next_incstep"].get(
+                                name, {"status": "still translating"}
+                            )
+                        ),
                     )
-                    logging.error(f"new message: {message}")
+                    logging.error("new message: %s", Envelope(message))
                     return False
                 else:
                     matched.append(schema)
-
-                    # translate each data variable to input schema's granularity
-                    for item in message["payload"]:
-
-                        # get current granularity from the data message
-                        src_gran = message["payload"][item]["granularity"]
-
-                        # get granularity and translation functions from the schema
-                        dest_gran = schema["properties"][item]["properties"][
-                            "granularity"
-                        ].get("value", src_gran)
-                        agg = (
-                            schema["properties"][item]["properties"]
-                            .get("agg", {})
-                            .get("value")
-                        )
-                        dagg = (
-                            schema["properties"][item]["properties"]
-                            .get("dagg", {})
-                            .get("value")
-                        )
-
-                        # translate the data and update the data message
-                        logging.info(
-                            f"validating input: message from {name}, translating variable {item}, {src_gran} -> {dest_gran}"
-                        )
-                        data = self.translate(
-                            message["payload"][item]["data"],
-                            src_gran,
-                            dest_gran,
-                            item,
-                            agg_name=agg,
-                            disagg_name=dagg,
-                        )
-                        message["payload"][item]["data"] = data
-                        message["payload"][item]["unit"] = schema[
-                            "properties"
-                        ][item]["properties"]["data"].get("unit", "")
-                        message["payload"][item]["granularity"] = dest_gran
-
-                    self.validated_messages["next_incstep"][name] = message
+                    self.submit_translation(name, schema, message, event)
 
             except ValidationError:
                 logging.debug("validation error")
@@ -705,10 +1741,147 @@ class OuterWrapper(ABC):
 
         if len(matched) == 0:
             logging.debug(
-                f"message didn't match any input schemas: {message['source']}"
+                "message didn't match any input schemas: %s", message["source"]
             )
         return True
 
+    def submit_translation(self, name, schema, message, event=None):
+        """
+        translates each data variable of a validated message to the input schema's granularity, concurrently in the
+        translation pool. Only one message per input schema is translated at a time, so messages of the same schema
+        stay in order
+        :param name: the name of the input schema that validated the message
+        :param schema: the input schema
+        :param message: the data message
+        :param event: the shutdown event for managing threads, set if a translation fails
+        """
+
+        # each schema gets its own copy of the payload, in case the message matches more than one schema
+        translated = dict(message)
+        translated["payload"] = {
+            item: dict(variable)
+            for item, variable in message["payload"].items()
+        }
+
+        # the inputs are for the model's next increment
+        incstep = self.incstep
+
+        futures = {}
+        for item in translated["payload"]:
+
+            # get current granularity from the data message
+            src_gran = translated["payload"][item]["granularity"]
+
+            # get granularity and translation functions from the schema
+            dest_gran = schema["properties"][item]["properties"][
+                "granularity"
+            ].get("value", src_gran)
+            agg = (
+                schema["properties"][item]["properties"]
+                .get("agg", {})
+                .get("value")
+            )
+            dagg = (
+                schema["properties"][item]["properties"]
+                .get("dagg", {})
+                .get("value")
+            )
+
+            # translate the data
+            logging.debug(
+                "validating input: message from %s, translating variable %s, %s -> %s",
+                name,
+                item,
+                src_gran,
+                dest_gran,
+            )
+            futures[item] = self.translation_executor.submit(
+                timed_call,
+                translate_in_process
+                if self.translation_pool == "process"
+                else self.translate,
+                translated["payload"][item]["data"],
+                src_gran,
+                dest_gran,
+                item,
+                agg,
+                dagg,
+            )
+            translated["payload"][item]["unit"] = schema["properties"][item][
+                "properties"
+            ]["data"].get("unit", "")
+            translated["payload"][item]["granularity"] = dest_gran
+
+        remaining = [len(futures)]
+        remaining_lock = Lock()
+
+        def finish(future=None):
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+
+            # update the data message, and record the span of each variable's translation
+            try:
+                for item, item_future in futures.items():
+                    data, start, duration, worker = item_future.result()
+                    translated["payload"][item]["data"] = data
+                    self.spans.record(
+                        "translate input",
+                        incstep,
+                        start,
+                        duration,
+                        thread=worker,
+                        schema=name,
+                        variable=item,
+                    )
+            except Exception as e:
+                logging.critical(
+                    f"failed to translate message from {name}: {e}"
+                )
+                if event is not None:
+                    event.set()
+                return
+
+            with self.messages_lock:
+                self.validated_messages["next_incstep"][name] = translated
+                self.translating.discard(name)
+                complete = (
+                    len(self.validated_messages["next_incstep"])
+                    == self.num_expected_inputs
+                )
+
+            # report the ready status right away, once every input has arrived
+            if complete:
+                self.status_wakeup.set()
+
+        if futures:
+            for item_future in futures.values():
+                item_future.add_done_callback(finish)
+        else:
+            remaining[0] = 1
+            finish()
+
+    def start_translation_pool(self):
+        """
+        starts the pool that translates incoming data messages. The worker processes of a process pool are forked
+        before any threads or zmq sockets exist, and inherit the graphs
+        """
+
+        global translation_wrapper
+
+        if self.translation_pool == "process":
+            translation_wrapper = self
+            self.translation_executor = ProcessPoolExecutor(
+                self.translation_workers
+            )
+            # the pool forks all of its workers on the first submission
+            self.translation_executor.submit(int).result()
+        else:
+            self.translation_executor = ThreadPoolExecutor(
+                self.translation_workers
+            )
+
     def action_worker(self, event):
         """
         gets messages from the action queue and performs the respective action. currently, just the increment action
@@ -730,53 +1903,263 @@ class OuterWrapper(ABC):
                     event.set()
                     raise RuntimeError
 
+    def register(self, event, context):
+        """
+        registers the model with the broker, retrying every second until the broker replies. A REQ socket can't send
+        again until it has received a reply, so each attempt uses a new socket
+        :param event: the shutdown event for managing threads
+        :return: returns once the broker replies, or when the shutdown event is set
+        """
+
+        message = {}
+        message["source"] = self.model_id
+        message["time"] = time.time()
+        message["signal"] = "register"
+        while not event.is_set():
+            sock = context.socket(zmq.REQ)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(self.endpoints["registration"])
+            sock.send_json(message)
+            reply = sock.recv_json() if sock.poll(1000) else None
+            sock.close()
+            if reply is None:
+                continue
+
+            if reply.get("status") == "rejected":
+                logging.critical(
+                    "the broker rejected the registration of %s",
+                    self.model_id,
+                )
+                event.set()
+            else:
+                logging.info("registered with the broker")
+                if reply.get("status") == "booted":
+                    self.boot(reply)
+            return
+
+    def boot(self, message):
+        """
+        sets the connected_to_broker flag, so that the model can safely receive increment pulses and publish its
+        data, and sends a status message right away
+        :param message: a status message from the broker, whose status is booted
+        """
+
+        self.initial_year = message.get("initial_year")
+        self.final_incstep = message.get("max_incstep")
+        if not self.connected_to_broker:
+            self.connected_to_broker = True
+            logging.info("the broker has booted")
+            self.status_wakeup.set()
+
     def watchdog(self, event):
         """
-        verifies that the broker is running by receiving its status messages. Sets the connected_to_broker flag
-        if the broker's status is booted, that is, if the broker has received status messages from all models,
-        so that models can safely receive increment pulses and publish their data.
+        verifies that the broker is running by receiving its status messages. Boots the model if the broker's status
+        is booted, that is, if all models have registered with the broker, in case the broker's booted status
+        message arrives before the reply to the model's registration.
         Will set the shutdown event if a status message has not been received within the timeout interval
         :param event: the shutdown event for managing threads
         :return: runs continuously until the shutdown event is set
         """
+        last_message = time.monotonic()
         while not event.is_set():
+            # wake up every second, to stop promptly at shutdown
             try:
-                message = self.broker_queue.get(timeout=10)
-                if message.get("status") == "booted":
-                    self.connected_to_broker = True
-                    self.initial_year = message.get("initial_year")
+                message = self.broker_queue.get(timeout=1)
             except Empty:
-                logging.critical("Timed out waiting for broker message")
-                event.set()
+                if time.monotonic() - last_message > 10:
+                    logging.critical("Timed out waiting for broker message")
+                    event.set()
+                continue
+            last_message = time.monotonic()
+            if message.get("status") == "booted":
+                self.boot(message)
+            self.system_state = message.get("models", {})
 
-    def run(self):
+    def configure_worker(self, event):
+        """
+        loads the config and initializes the model, concurrently with the messaging threads, so that the model
+        sends status messages while it configures
+        :param event: the shutdown event for managing threads
+        :return: returns once configure() has finished, setting the shutdown event if it failed
+        """
+
+        try:
+            start = time.time()
+            initial_conditions = self.load_json_objects(
+                os.path.join(self.model_dir, "config")
+            )
+            self.call_model("configure", initial_conditions, event)
+            logging.info(f"configured in {time.time() - start:.2f} s")
+        except Exception as e:
+            logging.critical(f"failed to configure: {e}")
+            event.set()
+            return
+
+        self.configured.set()
+
+        # report the new status right away, e.g. a model without inputs is now ready
+        self.status_wakeup.set()
+
+    def start_profile(self, message):
+        """
+        starts the sampling profiler for a number of increments, when the broker sends a profile signal. In the
+        process execution mode, the worker process samples each call of the model too
+        :param message: the profile message, with the number of increments to profile and the sampling interval
+        """
+
+        with self.profile_lock:
+            if self.profiler is not None:
+                logging.warning("already profiling, ignoring profile signal")
+                return
+            self.profile_request = message
+            self.profile_remaining = max(int(message.get("increments", 1)), 1)
+            self.profile_stacks = defaultdict(int)
+            self.profiler = SamplingProfiler(
+                float(message.get("interval", 0.01))
+            )
+            self.profiler.start()
+        logging.info(
+            f"profiling {self.profile_remaining} increments from incstep {self.incstep}"
+        )
+
+    def profiled_increment(self):
+        """
+        counts down the increments to profile, and finishes the profile after the last one
+        """
+
+        with self.profile_lock:
+            if self.profiler is None:
+                return
+            self.profile_remaining -= 1
+            if self.profile_remaining > 0:
+                return
+        self.finish_profile()
+
+    def finish_profile(self, publish=True):
+        """
+        stops the sampling profiler, and publishes the collapsed stacks of the outer wrapper's threads and the worker
+        process to the broker, which stores them in the profiles collection. Also writes them to
+        SIMON_PROFILE_DIR/<model_id>.<incstep>.collapsed if it is set
+        :param publish: whether to publish the profile, which isn't possible once the model is shutting down
+        """
+
+        with self.profile_lock:
+            profiler, self.profiler = self.profiler, None
+            request = self.profile_request
+        stacks = defaultdict(int, profiler.stop(root="outer wrapper"))
+        with self.profile_lock:
+            for stack, count in self.profile_stacks.items():
+                stacks[stack] += count
+            self.profile_stacks = defaultdict(int)
+        collapsed = "".join(
+            f"{stack} {count}\n" for stack, count in sorted(stacks.items())
+        )
+        logging.info(
+            f"profiled {sum(stacks.values())} samples until incstep {self.incstep}"
+        )
+
+        if publish:
+            message = {}
+            message["source"] = self.model_id
+            message["signal"] = "profile_result"
+            message["time"] = time.time()
+            message["incstep"] = self.incstep
+            message["request"] = request
+            message["interval"] = profiler.interval
+            message["samples"] = sum(stacks.values())
+            message["stacks"] = collapsed
+            self.pub_queue.put(message)
+
+        if self.profile_dir:
+            path = os.path.join(
+                self.profile_dir, f"{self.model_id}.{self.incstep}.collapsed"
+            )
+            try:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                with open(path, mode="w") as profile_file:
+                    profile_file.write(collapsed)
+                logging.info(f"wrote profile to {path}")
+            except OSError as e:
+                logging.error(f"failed to write profile to {path}: {e}")
+
+    def export_trace(self):
+        """
+        writes the spans of the run as a Chrome trace, to SIMON_TRACE_DIR/<model_id>.<start time>.trace.json
+        """
+
+        path = os.path.join(
+            self.trace_dir,
+            f"{self.model_id}.{int(self.spans.epoch)}.trace.json",
+        )
+        try:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            self.spans.export_trace(path, self.model_id)
+            logging.info(f"wrote trace to {path}")
+        except OSError as e:
+            logging.error(f"failed to write trace to {path}: {e}")
+
+    def run(self, context=None, shutdown=None):
         """
         main thread of the outer wrapper. Launches all sub threads. Called from the inner wrapper
+        :param context: the zmq context, shared with the broker to use inproc:// endpoints in one process.
+                A context created here is terminated at shutdown
+        :param shutdown: the shutdown event, to stop the outer wrapper from another thread
         :return: runs continuously until shutdown event is set
         """
 
-        # initialize the model
-        self.input_schemas = self.load_json_objects("/opt/schemas/input")
-        self.output_schemas = self.load_json_objects("/opt/schemas/output")
-        initial_conditions = self.load_json_objects("/opt/config")
-        self.configure(**initial_conditions)
+        # load the schemas, which the messaging threads need
+        self.input_schemas = self.load_json_objects(
+            os.path.join(self.model_dir, "schemas", "input")
+        )
+        self.output_schemas = self.load_json_objects(
+            os.path.join(self.model_dir, "schemas", "output")
+        )
+
+        # fork the worker process before any threads or zmq sockets exist. A caller that runs several outer wrappers
+        # in one process starts their worker processes itself, before it starts any of them
+        if self.execution == "process" and self.model_process is None:
+            self.start_model_process()
+        self.start_translation_pool()
 
         # start the threads
-        shutdown = Event()
-        context = zmq.Context()
+        if shutdown is None:
+            shutdown = Event()
+        own_context = context is None
+        if own_context:
+            context = zmq.Context()
+
+        # initialize the model, while the messaging threads send status messages
+        configure_thread = Thread(
+            target=self.configure_worker, args=(shutdown,)
+        )
+        configure_thread.start()
 
         # listen for messages
         subscribe_thread = Thread(target=self.sub, args=(shutdown, context,))
         subscribe_thread.start()
 
+        # route received messages, and validate and translate data messages
+        dispatcher_thread = Thread(target=self.dispatcher, args=(shutdown,))
+        dispatcher_thread.start()
+
         # publish messages
         publish_thread = Thread(target=self.pub, args=(shutdown, context,))
         publish_thread.start()
+        control_thread = Thread(
+            target=self.pub_control, args=(shutdown, context,)
+        )
+        control_thread.start()
 
         # handle increments
         action_thread = Thread(target=self.action_worker, args=(shutdown,))
         action_thread.start()
 
+        # register with the broker, once the sub thread is listening for its booted status message
+        register_thread = Thread(
+            target=self.register, args=(shutdown, context,)
+        )
+        register_thread.start()
+
         # check connectivity to broker
         watchdog_thread = Thread(target=self.watchdog, args=(shutdown,))
         watchdog_thread.start()
@@ -785,12 +2168,300 @@ class OuterWrapper(ABC):
         status_thread = Thread(target=self.send_status, args=(shutdown,))
         status_thread.start()
 
+        # compute the outputs of every increment ahead of time
+        if self.run_ahead:
+            run_ahead_thread = Thread(
+                target=self.run_ahead_worker, args=(shutdown,)
+            )
+            run_ahead_thread.start()
+
         try:
             while not shutdown.is_set():
                 time.sleep(1)
         except Exception as e:
             logging.critical(e)
         finally:
-            context.term()
+            if own_context:
+                context.term()
             shutdown.set()
+            if self.model_process:
+                self.stop_model_process()
+            self.translation_executor.shutdown(wait=False)
+            if self.trace_dir:
+                self.export_trace()
+            if self.profiler is not None:
+                self.finish_profile(publish=False)
             logging.critical(f"{self.model_id} model has shut down")
+
+
+class GranularityIndex:
+    def __init__(self, instance_graph, granularity):
+        """
+        the instances of a granularity, in a fixed order that the arrays of an ArrayOuterWrapper are aligned to
+        :param instance_graph: the instance graph
+        :param granularity: the granularity of the instances
+        """
+
+        self.granularity = granularity
+        self.instances = sorted(
+            instance
+            for instance, data in instance_graph.nodes(data=True)
+            if data.get("type") == granularity
+        )
+        self.positions = {
+            instance: position
+            for position, instance in enumerate(self.instances)
+        }
+
+    def __len__(self):
+        return len(self.instances)
+
+    def to_array(self, data, fill=np.nan):
+        """
+        converts a dict of data to an array aligned with the index
+        :param data: a dict mapping instances of the granularity to their values
+        :param fill: the value of instances that are missing from the data
+        :return: an array with one element per instance
+        """
+
+        # the data usually has the same instances in the same order
+        if len(data) == len(self.instances) and all(
+            a == b for a, b in zip(data, self.instances)
+        ):
+            return np.fromiter(
+                data.values(), dtype=np.float64, count=len(data)
+            )
+
+        array = np.full(len(self.instances), fill, dtype=np.float64)
+        missing = 0
+        for instance, value in data.items():
+            position = self.positions.get(instance)
+            if position is None:
+                missing += 1
+            else:
+                array[position] = value
+        if missing:
+            logging.warning(
+                f"{missing} instances not in the {self.granularity} index"
+            )
+        return array
+
+    def to_dict(self, array):
+        """
+        converts an array aligned with the index to a dict of data
+        :param array: an array with one element per instance
+        :return: a dict mapping instances of the granularity to their values. NaN values are left out
+        """
+
+        array = np.asarray(array, dtype=np.float64)
+        if array.shape != (len(self.instances),):
+            raise ValueError(
+                f"array of shape {array.shape} does not match the {len(self.instances)} instances of {self.granularity}"
+            )
+        values = array.tolist()
+        if np.isnan(array).any():
+            return {
+                instance: value
+                for instance, value in zip(self.instances, values)
+                if value == value
+            }
+        return dict(zip(self.instances, values))
+
+
+class PrecomputedTranslation:
+    def __init__(
+        self, instance_graph, src, dest, route, aggregator, disaggregator
+    ):
+        """
+        a translation between two granularities with linear translation functions, as a weighted sum from the
+        instances of src to the instances of dest. The weights are found by translating a unit value from each src
+        instance along the route with the translation functions themselves, so the results match translate()
+        :param instance_graph: the instance graph
+        :param src: granularity of the data
+        :param dest: granularity to translate the data to
+        :param route: the steps across the granularity graph, as returned by OuterWrapper.route
+        :param aggregator: a linear aggregator of the instance graph
+        :param disaggregator: a linear disaggregator of the instance graph
+        """
+
+        self.src_index = GranularityIndex(instance_graph, src)
+        self.dest_index = GranularityIndex(instance_graph, dest)
+
+        # src instances whose weights couldn't be computed (e.g., with an area of 0), translated by translate() instead
+        self.unsupported = set()
+
+        src_positions, dest_positions, weights = [], [], []
+        for src_position, instance in enumerate(self.src_index.instances):
+            shares = {instance: 1.0}
+            try:
+                for direction, granularity in route:
+                    next_shares = defaultdict(float)
+                    for node, share in shares.items():
+                        if direction == "down":
+                            for child, weight in disaggregator(
+                                1.0, node, granularity
+                            ).items():
+                                next_shares[child] += share * weight
+                        else:
+                            parent = [
+                                parent
+                                for parent in instance_graph.predecessors(node)
+                                if instance_graph.nodes[parent]["type"]
+                                == granularity
+                            ]
+                            assert len(parent) == 1
+                            next_shares[parent[0]] += share * aggregator(
+                                [(node, 1.0)]
+                            )
+                    shares = next_shares
+            except (ArithmeticError, TypeError):
+                self.unsupported.add(instance)
+                continue
+
+            # dest instances with a weight of 0 are kept, because translate() includes them in its results
+            for node, share in shares.items():
+                src_positions.append(src_position)
+                dest_positions.append(self.dest_index.positions[node])
+                weights.append(share)
+
+        self.src_positions = np.array(src_positions, dtype=np.intp)
+        self.dest_positions = np.array(dest_positions, dtype=np.intp)
+        self.weights = np.array(weights, dtype=np.float64)
+
+    def translate(self, data):
+        """
+        :param data: a dict mapping src instances to their values
+        :return: a dict mapping dest instances to their values, including only the dest instances that are translated
+                from at least one src instance in the data, like translate(). None if the data has instances that
+                aren't in the src index or whose weights couldn't be computed, or values that aren't numbers
+        """
+
+        instances = self.src_index.instances
+        try:
+            if len(data) == len(instances) and all(
+                a == b for a, b in zip(data, instances)
+            ):
+                if self.unsupported:
+                    return None
+                values = np.fromiter(
+                    data.values(), dtype=np.float64, count=len(data)
+                )
+                present = np.ones(len(instances), dtype=bool)
+            else:
+                values = np.zeros(len(instances), dtype=np.float64)
+                present = np.zeros(len(instances), dtype=bool)
+                for instance, value in data.items():
+                    position = self.src_index.positions.get(instance)
+                    if position is None or instance in self.unsupported:
+                        return None
+                    values[position] = value
+                    present[position] = True
+        except (TypeError, ValueError):
+            return None
+
+        translated = np.bincount(
+            self.dest_positions,
+            weights=values[self.src_positions] * self.weights,
+            minlength=len(self.dest_index),
+        )
+        included = (
+            np.bincount(
+                self.dest_positions,
+                weights=present[self.src_positions],
+                minlength=len(self.dest_index),
+            )
+            > 0
+        )
+        return {
+            instance: value
+            for instance, value, include in zip(
+                self.dest_index.instances, translated.tolist(), included
+            )
+            if include
+        }
+
+
+class ArrayOuterWrapper(OuterWrapper):
+    def __init__(self, model_id, num_expected_inputs, **kwargs):
+        """
+        an outer wrapper that hands the inner wrapper NumPy arrays instead of dicts. Each input variable is converted
+        to an array aligned with the GranularityIndex of its granularity, and each output array is converted back to a
+        dict, so the inner wrapper doesn't convert any data itself
+        :param model_id: the ID / unique name of the model, as defined in the inner wrapper
+        :param num_expected_inputs: the number of input schemas, as defined in the inner wrapper
+        :param kwargs: the execution and translation options of OuterWrapper
+        """
+
+        super().__init__(model_id, num_expected_inputs, **kwargs)
+        self.indexes = {}
+
+    def index(self, granularity):
+        """
+        :param granularity: a granularity of the instance graph
+        :return: the GranularityIndex of the granularity, built the first time it is needed
+        """
+
+        if granularity not in self.indexes:
+            self.indexes[granularity] = GranularityIndex(
+                self.instance_graph, granularity
+            )
+        return self.indexes[granularity]
+
+    def to_array(self, data, granularity):
+        """
+        converts a dict of data to an array, e.g. to load config data in configure()
+        :param data: a dict mapping instances of the granularity to their values
+        :param granularity: the granularity of the data
+        :return: an array aligned with the granularity's index
+        """
+
+        return self.index(granularity).to_array(data)
+
+    def increment(self, **kwargs):
+        """
+        converts the input data to arrays, calls increment_arrays(), and converts its output arrays to dicts
+        :param kwargs: the validated input messages, keyed by input schema name
+        :return: the output data, keyed by output schema name
+        """
+
+        inputs = {}
+        for schema, variables in kwargs.items():
+            inputs[schema] = {}
+            for variable, message in variables.items():
+                if message.get("granularity") is None:
+                    # data without a granularity, e.g. a global value, is passed through
+                    inputs[schema][variable] = message["data"]
+                else:
+                    inputs[schema][variable] = self.to_array(
+                        message["data"], message["granularity"]
+                    )
+
+        results = self.increment_arrays(**inputs)
+
+        for schema, variables in results.items():
+            for variable, message in variables.items():
+                if not isinstance(message["data"], np.ndarray):
+                    continue
+                if message.get("granularity") is None:
+                    # data without a granularity is passed through, as a list (or a scalar, from a 0-d array)
+                    message["data"] = message["data"].tolist()
+                else:
+                    message["data"] = self.index(
+                        message["granularity"]
+                    ).to_dict(message["data"])
+        return results
+
+    @abstractmethod
+    def increment_arrays(self, **kwargs):
+        """
+        implemented in the inner wrapper. Performs an increment on arrays
+        :param kwargs: the input data, keyed by input schema name and then by variable. Each variable with a
+                granularity is an array aligned with self.index(granularity)
+        :return: the output data, in the same form as the results of increment(), except that the data of each
+                variable with a granularity can be an array aligned with self.index(granularity). The data of a
+                variable without a granularity can be any array, and is converted to a list (or a scalar)
+        """
+
+        raise NotImplementedError(
+            f"increment_arrays() has to be implemented in the {self.model_id} inner wrapper"
+        )
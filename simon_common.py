@@ -0,0 +1,199 @@
+# Copyright 2020 The Johns Hopkins University Applied Physics Laboratory LLC
+# All rights reserved.
+# Distributed under the terms of the MIT License.
+
+
+import json
+import logging
+import os
+import sys
+from threading import Lock
+from queue import Full
+from bisect import bisect_left
+
+
+class Envelope:
+    def __init__(self, message):
+        """
+        a message's envelope, to log instead of the message: its metadata and the names of its payload's variables,
+        but not their data. It is only formatted if the log record is emitted, so debug logging of every message
+        costs nothing when DEBUG is off
+        :param message: the message
+        """
+
+        self.message = message
+
+    def __str__(self):
+        envelope = {
+            key: value
+            for key, value in self.message.items()
+            if key not in ["payload", "metrics", "spans", "stacks"]
+        }
+        if isinstance(self.message.get("payload"), dict):
+            envelope["payload"] = {
+                item: {
+                    key: value
+                    for key, value in variable.items()
+                    if key != "data"
+                }
+                if isinstance(variable, dict)
+                else type(variable).__name__
+                for item, variable in self.message["payload"].items()
+            }
+        return json.dumps(envelope, default=str)
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, **fields):
+        """
+        formats log records as JSON objects, one per line, for log aggregators
+        :param fields: fields added to every record, e.g., the model's ID
+        """
+
+        super().__init__()
+        self.fields = fields
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "file": record.filename,
+            "function": record.funcName,
+            "line": record.lineno,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update(self.fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(**fields):
+    """
+    configures the root logger: human-readable lines by default, or JSON objects if the SIMON_LOG_FORMAT environment
+    variable is json. The SIMON_LOG_LEVEL environment variable sets the level (default: INFO)
+    :param fields: fields added to every JSON record
+    """
+
+    level = os.environ.get("SIMON_LOG_LEVEL", "INFO").upper()
+    if os.environ.get("SIMON_LOG_FORMAT", "").lower() == "json":
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter(**fields))
+        logging.basicConfig(level=level, handlers=[handler])
+    else:
+        logging.basicConfig(
+            level=level,
+            stream=sys.stdout,
+            format="%(asctime)s - %(levelname)s - %(filename)s:%(funcName)s:%(lineno)d - %(message)s",
+        )
+
+
+def offer(queue, item, metrics, name):
+    """
+    puts an item into a bounded queue without blocking, for messages that can be dropped, e.g., periodic status
+    messages that the next one supersedes
+    :param queue: the queue
+    :param item: the item
+    :param metrics: the Metrics that count the dropped items
+    :param name: the name of the queue in the drop counter
+    :return: False if the queue was full, and the item was dropped
+    """
+
+    try:
+        queue.put_nowait(item)
+        return True
+    except Full:
+        metrics.inc("simon_queue_drops_total", queue=name)
+        return False
+
+
+def track_sequence(sequences, message, metrics):
+    """
+    checks the sequence number of a data message from its source. zmq's PUB sockets silently drop messages at
+    their high-water mark, so a gap in the sequence is the only trace of the lost messages
+    :param sequences: a dict mapping each source to the sequence number of its last data message
+    :param message: the data message
+    :param metrics: the Metrics that count the lost messages
+    """
+
+    source = message.get("source")
+    seq = message.get("seq")
+    if seq is None:
+        return
+    last = sequences.get(source)
+    sequences[source] = seq
+    if last is not None and seq > last + 1:
+        metrics.inc("simon_data_gaps_total", seq - last - 1, source=source)
+        logging.error(
+            "lost %d data messages from %s, before sequence number %d",
+            seq - last - 1,
+            source,
+            seq,
+        )
+
+
+class Metrics:
+    def __init__(
+        self, buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+    ):
+        """
+        counters, gauges, and histograms with fixed buckets, cheap enough to leave on: each update is a dict update
+        under a lock. Snapshots of the metrics ride along in the models' status messages, and the broker serves them
+        :param buckets: the upper bounds of the histogram buckets, in seconds
+        """
+
+        self.buckets = buckets
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                ]
+            histogram[0][bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+
+    def snapshot(self):
+        """
+        :return: the current value of every metric, as JSON: lists of [name, labels, value] for the counters and
+                gauges, and of [name, labels, bucket counts, sum] for the histograms. The bucket counts aren't
+                cumulative, and the last count is of the values above the last bucket
+        """
+
+        with self.lock:
+            return {
+                "buckets": list(self.buckets),
+                "counters": [
+                    [name, dict(labels), value]
+                    for (name, labels), value in self.counters.items()
+                ],
+                "gauges": [
+                    [name, dict(labels), value]
+                    for (name, labels), value in self.gauges.items()
+                ],
+                "histograms": [
+                    [name, dict(labels), list(counts), total]
+                    for (name, labels), (
+                        counts,
+                        total,
+                    ) in self.histograms.items()
+                ],
+            }